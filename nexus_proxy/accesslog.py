@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import math
+import os
+import re
+import select
+import socket
+import sys
+import time
+
+from .metrics import LabeledGauge, start_metrics_server, get_metrics_port
+
+logger = logging.getLogger('docker-alb')
+
+DEFAULT_INTERVAL = 60
+QUANTILES = (0.5, 0.9, 0.99)
+# Dimensions requests are grouped on
+KINDS = ('frontend', 'backend', 'host')
+# Names beyond this limit per kind are counted as OTHER, Host headers are chosen by clients
+DEFAULT_MAX_KEYS = 1000
+OTHER = '_other'
+
+# haproxy 1.7 'option httplog' line, the syslog header in front of it varies so it is searched for.
+# Timers are Tq/Tw/Tc/Tr/Tt in milliseconds, -1 if the stage was not reached.
+HTTPLOG_RE = re.compile(
+    r'(?P<client>\S+) \[(?P<accept_date>[^\]]+)\] (?P<frontend>\S+) (?P<backend>[^/\s]+)/(?P<server>\S+) '
+    r'(?P<tq>-?\d+)/(?P<tw>-?\d+)/(?P<tc>-?\d+)/(?P<tr>-?\d+)/\+?(?P<tt>-?\d+) '
+    r'(?P<status>-?\d+) \+?(?P<bytes>\d+) \S+ \S+ (?P<termination>\S+) \S+ \S+'
+    r'(?: \{(?P<request_headers>[^}]*)\})?(?: \{[^}]*\})?(?: "(?P<request>[^"]*))?')
+
+LOG_REQUESTS = LabeledGauge('nap_log_request_rate', "Requests per second in the last interval", ['kind', 'name'])
+LOG_ERRORS = LabeledGauge('nap_log_error_ratio', "Share of 5xx responses in the last interval", ['kind', 'name'])
+LOG_LATENCY = LabeledGauge('nap_log_latency_seconds', "Total request time quantiles in the last interval",
+                           ['kind', 'name', 'quantile'])
+
+
+class QuantileSketch(object):
+    __slots__ = ('relative_accuracy', 'gamma', 'log_gamma', 'max_bins', 'bins', 'zeros', 'count', 'total')
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        """
+        Mergeable quantile sketch with logarithmic buckets (DDSketch). Quantiles are within
+        relative_accuracy of the exact value and memory is bounded by max_bins.
+
+        :param relative_accuracy: Allowed relative error of quantiles, 0.01 is 1%.
+        :param max_bins: Max number of buckets, the lowest buckets are collapsed when reached.
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        # Values at or below zero, e.g. requests served from cache in 0 ms
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value <= 0:
+            self.zeros += 1
+            return
+        key = int(math.ceil(math.log(value) / self.log_gamma))
+        self.bins[key] = self.bins.get(key, 0) + 1
+        if len(self.bins) > self.max_bins:
+            self.collapse()
+
+    def collapse(self):
+        keys = sorted(self.bins)
+        lowest = keys[len(keys) - self.max_bins]
+        for key in keys[:len(keys) - self.max_bins]:
+            self.bins[lowest] += self.bins.pop(key)
+
+    def merge(self, other):
+        """
+        Adds the values of another sketch with the same accuracy.
+        """
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        while len(self.bins) > self.max_bins:
+            self.collapse()
+
+    def quantile(self, q):
+        """
+        :return: Estimated value at quantile q (0-1) or None if the sketch is empty.
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0.0
+        seen = self.zeros
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+
+class TrafficStats(object):
+    __slots__ = ('requests', 'errors', 'total_time', 'response_time')
+
+    def __init__(self):
+        """
+        Requests for a single frontend, backend or host.
+        """
+        self.requests = 0
+        self.errors = 0
+        self.total_time = QuantileSketch()
+        self.response_time = QuantileSketch()
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.errors += other.errors
+        self.total_time.merge(other.total_time)
+        self.response_time.merge(other.response_time)
+
+    def summary(self, seconds):
+        return {
+            'requests': self.requests,
+            'rate': round(self.requests / seconds, 3) if seconds else None,
+            'error_ratio': round(self.errors / self.requests, 4) if self.requests else 0,
+            'total_ms': {str(q): round_ms(self.total_time.quantile(q)) for q in QUANTILES},
+            'response_ms': {str(q): round_ms(self.response_time.quantile(q)) for q in QUANTILES},
+        }
+
+
+def round_ms(value):
+    return round(value, 1) if value is not None else None
+
+
+def parse_line(line):
+    """
+    Parses a haproxy HTTP log line.
+
+    :return: Dictionary of fields with timers and status as integers, host is taken from the first
+             captured request header and path from the request line. None if the line is not an
+             HTTP log line.
+    """
+    match = HTTPLOG_RE.search(line)
+    if match is None:
+        return None
+    entry = match.groupdict()
+    for name in ('tq', 'tw', 'tc', 'tr', 'tt', 'status', 'bytes'):
+        entry[name] = int(entry[name])
+    headers = entry.pop('request_headers')
+    host = headers.split('|', 1)[0] if headers else ''
+    entry['host'] = host.rsplit(':', 1)[0].lower() if host else None
+    # Request line, e.g. GET /path?query HTTP/1.1, the path is used to verify routing
+    request = (entry.pop('request') or '').split(' ')
+    entry['path'] = request[1].split('?', 1)[0] if len(request) > 1 else None
+    return entry
+
+
+class LogAnalyzer(object):
+    def __init__(self, max_keys=DEFAULT_MAX_KEYS):
+        """
+        Keeps request rates and latency sketches per frontend, backend and host. Raw lines are not kept,
+        memory is bounded by the number of names and the sketch size.
+
+        :param max_keys: Max number of names tracked per kind.
+        """
+        self.max_keys = max_keys
+        self.window = {kind: {} for kind in KINDS}
+        self.totals = {kind: {} for kind in KINDS}
+        self.window_start = time.monotonic()
+        self.start = self.window_start
+        self.lines = 0
+        self.skipped = 0
+
+    def feed(self, line):
+        entry = parse_line(line)
+        self.lines += 1
+        if entry is None:
+            self.skipped += 1
+            return
+        for kind in KINDS:
+            name = entry[kind]
+            if name is None:
+                continue
+            stats = self.window[kind]
+            traffic = stats.get(name)
+            if traffic is None:
+                if len(stats) >= self.max_keys:
+                    name = OTHER
+                    traffic = stats.get(name)
+                if traffic is None:
+                    traffic = stats[name] = TrafficStats()
+            traffic.requests += 1
+            if entry['status'] >= 500 or entry['status'] < 0:
+                traffic.errors += 1
+            if entry['tt'] >= 0:
+                traffic.total_time.add(entry['tt'])
+            if entry['tr'] >= 0:
+                traffic.response_time.add(entry['tr'])
+
+    def rotate(self, now=None):
+        """
+        Ends the current window, its sketches are merged in to the totals.
+
+        :return: Summary of the window.
+        """
+        now = now or time.monotonic()
+        seconds = now - self.window_start
+        summary = {
+            'seconds': round(seconds, 3),
+            'lines': self.lines,
+            'skipped': self.skipped,
+        }
+        for kind in KINDS:
+            summary[kind] = {name: traffic.summary(seconds) for name, traffic in sorted(self.window[kind].items())}
+            totals = self.totals[kind]
+            for name, traffic in self.window[kind].items():
+                if name not in totals:
+                    totals[name] = TrafficStats()
+                totals[name].merge(traffic)
+        export_summary(summary)
+        self.window = {kind: {} for kind in KINDS}
+        self.window_start = now
+        self.lines = 0
+        self.skipped = 0
+        return summary
+
+    def total_summary(self, now=None):
+        seconds = (now or time.monotonic()) - self.start
+        return {kind: {name: traffic.summary(seconds) for name, traffic in sorted(self.totals[kind].items())}
+                for kind in KINDS}
+
+
+def export_summary(summary):
+    requests, errors, latency = {}, {}, {}
+    for kind in KINDS:
+        for name, values in summary[kind].items():
+            requests[(kind, name)] = values['rate'] or 0
+            errors[(kind, name)] = values['error_ratio']
+            for q, value in values['total_ms'].items():
+                if value is not None:
+                    latency[(kind, name, q)] = value / 1000.0
+    LOG_REQUESTS.replace(requests)
+    LOG_ERRORS.replace(errors)
+    LOG_LATENCY.replace(latency)
+
+
+def read_file(filename, follow=False, timeout=1.0):
+    """
+    Yields lines from a file, or None when there is nothing to read for timeout seconds while following.
+    """
+    with open(filename, encoding='utf8', errors='replace') as log_file:
+        while True:
+            line = log_file.readline()
+            if line:
+                yield line
+            elif follow:
+                yield None
+                time.sleep(timeout)
+            else:
+                return
+
+
+def read_datagrams(sock: socket.socket, timeout=1.0):
+    """
+    Yields messages received on a datagram socket, or None every timeout seconds without messages.
+    """
+    while True:
+        readable, _, _ = select.select([sock], [], [], timeout)
+        if not readable:
+            yield None
+            continue
+        data = sock.recv(65536)
+        yield data.decode('utf8', 'replace')
+
+
+def open_source(args):
+    """
+    :return: Iterator of log lines, None is yielded when no data has arrived for a while.
+    """
+    if args.socket:
+        # Unix datagram socket, the same kind haproxy logs to with the log sidecar
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(args.socket)
+        return read_datagrams(sock)
+    if args.udp:
+        host, _, port = args.udp.rpartition(':')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host or '0.0.0.0', int(port)))
+        return read_datagrams(sock)
+    if args.file in (None, '-'):
+        return sys.stdin
+    return read_file(args.file, follow=args.follow)
+
+
+def write_summary(summary, stream=sys.stdout, output_format='json'):
+    if output_format == 'json':
+        stream.write(json.dumps(summary, sort_keys=True) + "\n")
+        stream.flush()
+        return
+    for kind in KINDS:
+        for name, values in summary.get(kind, {}).items():
+            total_ms = values['total_ms']
+            stream.write("{:<8} {:<40} {:>8} req {:>9} req/s {:>6.2f}% 5xx  p50 {} p90 {} p99 {} ms\n".format(
+                kind, name, values['requests'], values['rate'], values['error_ratio'] * 100,
+                total_ms['0.5'], total_ms['0.9'], total_ms['0.99']))
+    stream.flush()
+
+
+def cli_log_stats(args):
+    analyzer = LogAnalyzer(max_keys=args.max_keys)
+    metrics_port = args.metrics_port or get_metrics_port()
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    deadline = time.monotonic() + args.interval
+    try:
+        for line in open_source(args):
+            if line is not None:
+                analyzer.feed(line)
+            if time.monotonic() >= deadline:
+                write_summary(analyzer.rotate(), output_format=args.format)
+                deadline = time.monotonic() + args.interval
+    except KeyboardInterrupt:
+        pass
+    # Input ended, e.g. a file which is not followed, report what is left and the totals
+    if analyzer.lines:
+        write_summary(analyzer.rotate(), output_format=args.format)
+    if args.format == 'json':
+        write_summary({'total': analyzer.total_summary()}, output_format='json')
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import json
+import logging
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+
+import etcd
+
+from .register import WriteBatch, StateMirror, etcd_client
+
+logger = logging.getLogger('docker-alb')
+
+ARCHIVE_FORMAT = 'nap-alb'
+ARCHIVE_VERSION = 1
+# Certificate keys which contain PEM data, only exported when asked for
+PEM_KEYS = ('cert', 'data')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+@contextmanager
+def open_archive(filename, mode='r'):
+    """
+    Opens an archive file for text reading or writing, - is stdin/stdout and .gz files are compressed.
+    """
+    if filename in (None, '-'):
+        yield sys.stdin if mode == 'r' else sys.stdout
+        return
+    if filename.endswith('.gz'):
+        stream = io.TextIOWrapper(gzip.open(filename, mode + 'b'), encoding='utf8')
+    else:
+        stream = open(filename, mode, encoding='utf8')
+    with stream:
+        yield stream
+
+
+def read_tree(client: etcd.Client, prefix):
+    """
+    Reads all leaf keys below prefix with a single recursive read.
+
+    :return: Dictionary of key to value.
+    """
+    try:
+        return {node.key: node.value for node in client.read(prefix, recursive=True).leaves if not node.dir}
+    except (etcd.EtcdKeyNotFound, KeyError):
+        return {}
+
+
+def iter_alb_keys(client: etcd.Client, alb_id, with_pem=False):
+    """
+    Yields (key, value) for all keys which make up an ALB: the ALB tree, the target groups
+    referenced by its rules and the certificates referenced by its listeners and listener groups.
+    """
+    alb_prefix = '/alb/{name}/'.format(name=alb_id)
+    alb_keys = read_tree(client, alb_prefix.rstrip('/'))
+    target_group_ids = set()
+    certificate_names = set()
+    for key, value in sorted(alb_keys.items()):
+        parts = key[len(alb_prefix):].split('/')
+        if parts[0] == 'certbot':
+            # Certbot routes are temporary and tied to a running renewal
+            continue
+        if parts[0] == 'listeners' and parts[-1] == 'config':
+            try:
+                action = json.loads(value).get('action') or ''
+            except (ValueError, AttributeError):
+                action = ''
+            if action.startswith('tg:'):
+                target_group_ids.add(action[3:])
+        elif parts[-1] == 'certificate_name' and value and value != 'None':
+            certificate_names.add(value)
+        yield key, value
+
+    for key, value in sorted(read_tree(client, '/target_group').items()):
+        if key.split('/')[2] in target_group_ids:
+            yield key, value
+
+    for key, value in sorted(read_tree(client, '/certs').items()):
+        parts = key.split('/')
+        if parts[2] not in certificate_names:
+            continue
+        if not with_pem and parts[-1] in PEM_KEYS:
+            continue
+        yield key, value
+
+
+def export_alb(client: etcd.Client, alb_id, stream, with_pem=False, output_format='ndjson'):
+    """
+    Writes an ALB to stream.
+
+    The ndjson format starts with a header object followed by one object per key, which allows
+    streaming very large configurations. The json format writes a single document.
+
+    :return: Number of keys exported.
+    """
+    header = {
+        'format': ARCHIVE_FORMAT,
+        'version': ARCHIVE_VERSION,
+        'alb': alb_id,
+        'exported': datetime.now().isoformat(),
+        'with_pem': with_pem,
+    }
+    count = 0
+    if output_format == 'json':
+        document = dict(header, keys={})
+        for key, value in iter_alb_keys(client, alb_id, with_pem=with_pem):
+            document['keys'][key] = value
+            count += 1
+        json.dump(document, stream, ensure_ascii=False, indent=1, sort_keys=True)
+        stream.write("\n")
+        return count
+
+    stream.write(json.dumps(header, sort_keys=True) + "\n")
+    for key, value in iter_alb_keys(client, alb_id, with_pem=with_pem):
+        stream.write(json.dumps({'k': key, 'v': value}, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def read_archive(stream):
+    """
+    Reads an archive written by export_alb, the format is detected from the content.
+
+    :return: Tuple of header dictionary and iterator of (key, value).
+    """
+    first = stream.readline()
+    if not first.strip():
+        raise ArchiveError("Archive is empty")
+    try:
+        header = json.loads(first)
+        is_document = False
+    except ValueError:
+        # Not a single line, must be an indented json document
+        header = json.loads(first + stream.read())
+        is_document = True
+    if header.get('format') != ARCHIVE_FORMAT:
+        raise ArchiveError("Not an ALB archive")
+    if header.get('version', 0) > ARCHIVE_VERSION:
+        raise ArchiveError("Unsupported archive version: {}".format(header.get('version')))
+
+    if is_document or 'keys' in header:
+        return header, iter(sorted(header.pop('keys', {}).items()))
+
+    def iter_records():
+        for line in stream:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield record['k'], record['v']
+    return header, iter_records()
+
+
+def import_alb(client: etcd.Client, stream, alb_id=None, replace=False, dry_run=False):
+    """
+    Imports an ALB archive as a single batch. The current state is loaded with one read per tree so
+    importing does not need any per-entity reads, unchanged keys are not written.
+
+    :param alb_id: Identifier of ALB to import in to, defaults to the one in the archive.
+    :param replace: If True then keys in the ALB tree which are not in the archive are removed.
+    :param dry_run: If True then nothing is written.
+    :return: List of planned mutations, see WriteBatch.plan.
+    """
+    header, records = read_archive(stream)
+    source_prefix = '/alb/{name}'.format(name=header['alb'])
+    alb_id = alb_id or header['alb']
+    target_prefix = '/alb/{name}'.format(name=alb_id)
+
+    mirror = StateMirror(client, [target_prefix, '/target_group', '/certs'])
+    mirror.load()
+    batch = WriteBatch(client, mirror=mirror)
+    if replace:
+        batch.delete(target_prefix, recursive=True)
+    alb_records = []
+    for key, value in records:
+        if key == source_prefix or key.startswith(source_prefix + '/'):
+            alb_records.append((target_prefix + key[len(source_prefix):], value))
+        elif key.startswith(('/target_group/', '/certs/')):
+            batch.write(key, value)
+        else:
+            logger.warning("Skipping key outside of ALB configuration: %s", key)
+    # Listeners are written after the target groups and certificates they refer to
+    for key, value in alb_records:
+        batch.write(key, value)
+    mutations = batch.plan()
+    if not dry_run:
+        batch.apply(mutations)
+    return mutations
+
+
+def cli_export_alb(args):
+    client = etcd_client(args.etcd_host)
+    with open_archive(args.output, 'w') as stream:
+        count = export_alb(client, args.alb_id, stream, with_pem=args.with_pem, output_format=args.format)
+    if args.verbosity >= 1:
+        print("Exported {} keys".format(count), file=sys.stderr)
+
+
+def cli_import_alb(args):
+    client = etcd_client(args.etcd_host)
+    with open_archive(args.input, 'r') as stream:
+        mutations = import_alb(client, stream, alb_id=args.alb_id, replace=args.replace, dry_run=args.dry_run)
+    if args.dry_run:
+        for operation, key, value in mutations:
+            print("write {} = {}".format(key, value) if operation == 'write' else "delete {}".format(key))
+    elif args.verbosity >= 0:
+        print("Imported with {} mutations".format(len(mutations)), file=sys.stderr)
@@ -16,13 +16,17 @@ def process_verbosity(args):
 
 
 def setup_common_args(parser: argparse.ArgumentParser):
-    parser.set_defaults(verbosity=0, etcd_host=None)
+    parser.set_defaults(verbosity=0, etcd_host=None, spans=False, profile=None)
     parser.add_argument("--verbose", "-v", dest="verbosity", action='count',
                         help="increase verbosity level")
     parser.add_argument("--quiet", "-q", dest="verbosity", action='store_const', const=-1,
                         help="suppress non-error messages")
     parser.add_argument("--etcd-host", dest="etcd_host", metavar="HOST",
                         help="hostname for etcd server, if unset uses ETCD_HOST env variable")
+    parser.add_argument("--spans", action='store_true',
+                        help="log the time spent in each stage, also enabled with NAP_SPANS=1")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write a cProfile profile of the command to FILE")
 
 
 def setup_listener_cmd(command_parsers: argparse._SubParsersAction):
@@ -34,6 +38,12 @@ def setup_listener_cmd(command_parsers: argparse._SubParsersAction):
     command_parsers = parser.add_subparsers(dest="listener_cmd")
     setup_register_cmd(command_parsers)
     setup_register_vhost_cmd(command_parsers)
+    setup_register_batch_cmd(command_parsers)
+    setup_watch_docker_cmd(command_parsers)
+    setup_daemon_cmd(command_parsers)
+    setup_heartbeat_cmd(command_parsers)
+    setup_drain_cmd(command_parsers, 'drain', help='Drain targets of a virtual-host before they are removed')
+    setup_drain_cmd(command_parsers, 'undrain', help='Put draining targets of a virtual-host back in service')
 
 
 def setup_register_cmd(command_parsers: argparse._SubParsersAction):
@@ -44,6 +54,70 @@ def setup_register_cmd(command_parsers: argparse._SubParsersAction):
         'register-docker', help='Register listeners from docker-gen configuration')  # type: argparse.ArgumentParser
     setup_common_args(parser)
 
+    parser.add_argument("--manifest", default="/tmp/etcd_config.py",
+                        help="Path to configuration written by docker-gen, defaults to /tmp/etcd_config.py")
+    parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
+                        help="Identifier for application load balancer to register in, defaults to vhost")
+    parser.add_argument("--dry-run", action="store_true", default=False,
+                        help="Print the planned changes without writing them")
+
+
+def setup_watch_docker_cmd(command_parsers: argparse._SubParsersAction):
+    """
+    Setup 'listener watch-docker' command, register containers by following docker events.
+    """
+    parser = command_parsers.add_parser(
+        'watch-docker', help='Register listeners by watching docker events')  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    parser.add_argument("--docker-socket", default=None,
+                        help="Path to docker socket, if unset uses DOCKER_HOST env variable or "
+                             "/var/run/docker.sock")
+    parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
+                        help="Identifier for application load balancer to register in, defaults to vhost")
+    parser.add_argument("--dry-run", action="store_true", default=False,
+                        help="Log the planned changes without writing them")
+    parser.add_argument("--ttl", type=int, default=None,
+                        help="Register targets under a lease which expires after this many seconds if the watcher "
+                             "stops, the lease is refreshed while watching")
+
+
+def setup_daemon_cmd(command_parsers: argparse._SubParsersAction):
+    """
+    Setup 'listener daemon' command, long-running process which handles registration requests.
+    """
+    parser = command_parsers.add_parser(
+        'daemon', help='Handle registration requests as NDJSON from a socket or stdin'
+    )  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    parser.add_argument("--socket", default=None,
+                        help="Path to unix socket to listen on, if unset requests are read from stdin")
+    parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
+                        help="Identifier for application load balancer to register in, defaults to vhost")
+    parser.add_argument("--max-batch", type=int, default=500,
+                        help="Max number of requests to apply in one batch, defaults to 500")
+    parser.add_argument("--batch-window", type=float, default=10,
+                        help="Milliseconds to wait for more requests before applying a batch, defaults to 10")
+
+
+def setup_heartbeat_cmd(command_parsers: argparse._SubParsersAction):
+    """
+    Setup 'listener heartbeat' command, keeps the lease for targets registered with a TTL alive.
+    """
+    parser = command_parsers.add_parser(
+        'heartbeat', help='Keep leased targets of this host alive')  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    parser.add_argument("--lease", default=None,
+                        help="Name of lease to refresh, defaults to the hostname")
+    parser.add_argument("--ttl", type=int, default=30,
+                        help="Seconds until the lease expires if not refreshed, defaults to 30")
+    parser.add_argument("--interval", type=float, default=None,
+                        help="Seconds between refreshes, defaults to a third of the TTL")
+    parser.add_argument("--once", action="store_true", default=False,
+                        help="Refresh once and exit, e.g. when run from cron")
+
 
 def setup_register_vhost_cmd(command_parsers: argparse._SubParsersAction):
     """
@@ -67,6 +141,21 @@ def setup_register_vhost_cmd(command_parsers: argparse._SubParsersAction):
                         help="Auto creation of certificate using letsencrypt")
     parser.add_argument("--certificate-name", default=None,
                         help="Name of certificate entry to use, default is to use ID of listener group")
+    parser.add_argument("--ttl", type=int, default=None,
+                        help="Register targets under a lease which expires after this many seconds unless "
+                             "kept alive with 'listener heartbeat'")
+    parser.add_argument("--lease", default=None,
+                        help="Name of lease to register targets under, defaults to the hostname")
+    parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
+                        help="Identifier for application load balancer or shard pool to register in, "
+                             "defaults to vhost")
+    setup_limit_args(parser)
+    setup_capacity_args(parser)
+    parser.add_argument("--slowstart", type=int, default=None, metavar="SECONDS",
+                        help="Seconds over which new targets ramp up to their full share of requests")
+    parser.add_argument("--drain-timeout", type=int, default=30, metavar="SECONDS",
+                        help="Seconds targets removed with -<host> are drained before they are deleted, "
+                             "0 deletes them at once. Defaults to 30")
     parser.add_argument("virtual_host",
                         help="domains to register")
     parser.add_argument("target",
@@ -75,6 +164,83 @@ def setup_register_vhost_cmd(command_parsers: argparse._SubParsersAction):
                              "a comma separated list")
 
 
+def setup_drain_cmd(command_parsers: argparse._SubParsersAction, name, help):
+    """
+    Setup 'listener drain' or 'listener undrain' command, changes whether targets get new requests.
+    """
+    parser = command_parsers.add_parser(name, help=help)  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    parser.add_argument("--id", default=None,
+                        help="ID of target group, defaults to vhost-<first domain>")
+    parser.add_argument("--lease", default=None,
+                        help="Name of lease the targets are registered under, if registered with --ttl")
+    if name == 'drain':
+        parser.add_argument("--drain-timeout", type=int, default=30, metavar="SECONDS",
+                            help="Seconds until the drained targets are deleted, defaults to 30")
+    parser.add_argument("virtual_host",
+                        help="domains of the virtual-host, the primary domain first")
+    parser.add_argument("target",
+                        help="The hostname/ip of target, either use <host>:<port> or just <host>. "
+                             "Defaults to port 80 if no port is set. Specify multiple targets with "
+                             "a comma separated list")
+
+
+def setup_limit_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--rate-limit", type=int, default=None, metavar="REQUESTS",
+                        help="Max requests per second from a single client IP, averaged over 10 seconds")
+    parser.add_argument("--conn-limit", type=int, default=None, metavar="CONNECTIONS",
+                        help="Max concurrent connections from a single client IP")
+    parser.add_argument("--max-connections", type=int, default=None, metavar="CONNECTIONS",
+                        help="Max concurrent connections to the virtual-host from all clients, requests over it "
+                             "get a 503")
+    parser.add_argument("--limit-action", choices=('deny', 'tarpit'), default=None,
+                        help="What to do with requests over --rate-limit or --conn-limit, deny answers with 429 "
+                             "and tarpit holds the connection before answering. Defaults to deny")
+
+
+def setup_capacity_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--target-maxconn", type=int, default=None, metavar="REQUESTS",
+                        help="Max concurrent requests sent to each target, further requests wait in haproxy")
+    parser.add_argument("--target-maxqueue", type=int, default=None, metavar="REQUESTS",
+                        help="Max requests waiting for each target, further requests go to other targets")
+    parser.add_argument("--queue-timeout", type=int, default=None, metavar="SECONDS",
+                        help="Seconds a request may wait for a target before it gets a 503, defaults to the "
+                             "connect timeout (5s)")
+
+
+def setup_register_batch_cmd(command_parsers: argparse._SubParsersAction):
+    """
+    Setup 'listener register-batch' command, register many virtual-hosts from a manifest file.
+    """
+    parser = command_parsers.add_parser(
+        'register-batch', help='Register virtual-hosts from a JSON, NDJSON or YAML manifest'
+    )  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
+                        help="Identifier for application load balancer or shard pool to register in, "
+                             "defaults to vhost")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Number of virtual-hosts to apply in one batch, defaults to 100")
+    parser.add_argument("--resolvers", type=int, default=16,
+                        help="Number of target hostnames to resolve concurrently, defaults to 16")
+    parser.add_argument("--ttl", type=int, default=None,
+                        help="Register targets under a lease which expires after this many seconds unless "
+                             "kept alive with 'listener heartbeat'")
+    parser.add_argument("--lease", default=None,
+                        help="Name of lease to register targets under, defaults to the hostname")
+    parser.add_argument("--keep-going", action="store_true", default=False,
+                        help="Register the valid entries even if some entries of the manifest are invalid")
+    parser.add_argument("--dry-run", action="store_true", default=False,
+                        help="Print the planned changes without writing them")
+    parser.add_argument("--format", choices=('text', 'json'), default='text',
+                        help="Output format for the result of each virtual-host, json writes one object per line")
+    parser.add_argument("manifest",
+                        help="Manifest file with a list of virtual-hosts, each with domains and optionally id, "
+                             "port, targets, certificate, certificate_name and certbot. Use - for stdin")
+
+
 def setup_certificate_cmd(command_parsers: argparse._SubParsersAction):
     """
     Setup 'certificate' command, contains sub-commands.
@@ -126,6 +292,21 @@ def setup_renew_certificate_cmd(command_parsers: argparse._SubParsersAction):
                         help="Identifier for application load balancer to check for certs, if unset renews all ALBs")
     parser.add_argument("--email", default=None,
                         help="Email address to register certificates to")
+    parser.add_argument("--batch", action="store_true", default=False,
+                        help="Renew all due certificates in one pass, registers all certbot routes at once and "
+                             "issues certificates concurrently")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Max number of certbot processes to run at the same time in batch mode, defaults to 4")
+    parser.add_argument("--renew-after-days", type=int, default=60,
+                        help="Renew certificates older than this number of days in batch mode, defaults to 60")
+    parser.add_argument("--force", action="store_true", default=False,
+                        help="Renew all certbot managed certificates in batch mode, even if they are not due")
+    parser.add_argument("--listen-port", type=int, default=80,
+                        help="Port to serve ACME challenges on in batch mode, defaults to 80")
+    parser.add_argument("--work-dir", default="/etc/letsencrypt/nap",
+                        help="Directory where certbot keeps per-certificate state in batch mode")
+    parser.add_argument("--ready-timeout", type=int, default=3*60,
+                        help="Seconds to wait for the ALB to set up certbot routes, defaults to 180")
 
 
 def setup_alb_cmd(command_parsers: argparse._SubParsersAction):
@@ -138,6 +319,14 @@ def setup_alb_cmd(command_parsers: argparse._SubParsersAction):
     command_parsers = parser.add_subparsers(dest="alb_cmd")
     setup_alb_run_cmd(command_parsers)
     setup_alb_show_cmd(command_parsers)
+    setup_alb_export_cmd(command_parsers)
+    setup_alb_import_cmd(command_parsers)
+    setup_alb_diff_cmd(command_parsers)
+    setup_alb_stats_cmd(command_parsers)
+    setup_alb_log_stats_cmd(command_parsers)
+    setup_alb_fleet_cmd(command_parsers)
+    setup_alb_shards_cmd(command_parsers)
+    setup_alb_route_cmd(command_parsers)
 
 
 def setup_alb_run_cmd(command_parsers: argparse._SubParsersAction):
@@ -147,6 +336,26 @@ def setup_alb_run_cmd(command_parsers: argparse._SubParsersAction):
 
     parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
                         help="Identifier for application load balancer to setup, defaults to vhost")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port at /metrics, if unset uses METRICS_PORT env "
+                             "variable. Disabled by default")
+    parser.add_argument("--stats-interval", type=float, default=None,
+                        help="Seconds between scrapes of the haproxy stats socket, if unset uses STATS_INTERVAL env "
+                             "variable. Per target group traffic is added to the metrics and a rollup is written "
+                             "to etcd. Disabled by default")
+    parser.add_argument("--profile-cycles", type=int, default=5,
+                        help="Number of poll cycles to profile with --profile, defaults to 5")
+    parser.add_argument("--api-port", type=int, default=None,
+                        help="Serve the control API (status, applied config, health checks) on this port, if unset "
+                             "uses API_PORT env variable. Disabled by default")
+    parser.add_argument("--api-address", default='127.0.0.1',
+                        help="Address to bind the control API to, defaults to 127.0.0.1")
+    parser.add_argument("--fleet", action='store_true', default=False,
+                        help="Share one rendered configuration between all controllers of the ALB, one is elected "
+                             "leader and the others apply what it publishes. Also enabled with ALB_FLEET=1")
+    parser.add_argument("--leader-ttl", type=int, default=None,
+                        help="Seconds until the leader key expires when the leader stops, if unset uses "
+                             "FLEET_LEADER_TTL env variable. Defaults to 6")
 
 
 def setup_alb_show_cmd(command_parsers: argparse._SubParsersAction):
@@ -158,3 +367,249 @@ def setup_alb_show_cmd(command_parsers: argparse._SubParsersAction):
                         help="Identifier for application load balancer to setup, defaults to vhost")
     parser.add_argument("--haproxy", dest="show_haproxy", action='store_true', default=False,
                         help="Show haproxy configuration")
+
+
+def setup_alb_export_cmd(command_parsers: argparse._SubParsersAction):
+    parser = command_parsers.add_parser(
+        'export', help='Export configuration for an Application Load Balancer')  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
+                        help="Identifier for application load balancer to export, defaults to vhost")
+    parser.add_argument("--output", "-o", default='-',
+                        help="File to write to, use .gz extension for compression. Defaults to stdout")
+    parser.add_argument("--format", choices=('ndjson', 'json'), default='ndjson',
+                        help="ndjson writes one key per line, json writes a single document. Defaults to ndjson")
+    parser.add_argument("--with-pem", action='store_true', default=False,
+                        help="Include certificate PEM data")
+
+
+def setup_alb_import_cmd(command_parsers: argparse._SubParsersAction):
+    parser = command_parsers.add_parser(
+        'import', help='Import configuration for an Application Load Balancer')  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    parser.add_argument("input",
+                        help="File written by 'alb export', .gz files are decompressed. Use - for stdin")
+    parser.add_argument("--alb-identifier", dest="alb_id", default=None,
+                        help="Identifier for application load balancer to import to, defaults to the exported one")
+    parser.add_argument("--replace", action='store_true', default=False,
+                        help="Remove existing ALB configuration which is not in the export")
+    parser.add_argument("--dry-run", action='store_true', default=False,
+                        help="Print the planned changes without writing them")
+
+
+def setup_alb_diff_cmd(command_parsers: argparse._SubParsersAction):
+    parser = command_parsers.add_parser(
+        'diff', help='Show changes between etcd and the running configuration')  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
+                        help="Identifier for application load balancer to compare, defaults to vhost")
+    parser.add_argument("--snapshot", default=None,
+                        help="Snapshot file to compare with, defaults to the one written by 'alb run' "
+                             "(ALB_SNAPSHOT env or /etc/haproxy.snapshot.json)")
+    parser.add_argument("--save", default=None, metavar="FILE",
+                        help="Write the configuration in etcd to a snapshot file instead of comparing")
+    parser.add_argument("--format", choices=('text', 'json'), default='text',
+                        help="Output format, defaults to text")
+    parser.add_argument("--exit-code", action='store_true', default=False,
+                        help="Exit with 1 if there are changes")
+
+
+def setup_alb_stats_cmd(command_parsers: argparse._SubParsersAction):
+    parser = command_parsers.add_parser(
+        'stats', help='Show traffic per target group reported by all nodes')  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
+                        help="Identifier for application load balancer to show, defaults to vhost")
+    parser.add_argument("--format", choices=('text', 'json'), default='text',
+                        help="Output format, defaults to text")
+
+
+def setup_alb_fleet_cmd(command_parsers: argparse._SubParsersAction):
+    parser = command_parsers.add_parser(
+        'fleet', help='Show the fleet leader and the published generation')  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
+                        help="Identifier for application load balancer to show, defaults to vhost")
+    parser.add_argument("--format", choices=('text', 'json'), default='text',
+                        help="Output format, defaults to text")
+
+
+def setup_alb_shards_cmd(command_parsers: argparse._SubParsersAction):
+    parser = command_parsers.add_parser(
+        'shards', help='Spread listener groups over several Application Load Balancers'
+    )  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+    shards_parsers = parser.add_subparsers(dest="shards_cmd")
+
+    show_parser = shards_parsers.add_parser(
+        'show', help='Show what each ALB of a pool carries')  # type: argparse.ArgumentParser
+    set_parser = shards_parsers.add_parser(
+        'set', help='Set the ALBs listener groups of a pool are spread over')  # type: argparse.ArgumentParser
+    place_parser = shards_parsers.add_parser(
+        'place', help='Pin a listener group to an ALB')  # type: argparse.ArgumentParser
+    rebalance_parser = shards_parsers.add_parser(
+        'rebalance', help='Move listener groups to the ALB they are placed on')  # type: argparse.ArgumentParser
+    for sub_parser in (show_parser, set_parser, place_parser, rebalance_parser):
+        setup_common_args(sub_parser)
+        sub_parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
+                                help="Pool which virtual-hosts are registered in, defaults to vhost")
+
+    show_parser.add_argument("--format", choices=('text', 'json'), default='text',
+                             help="Output format, defaults to text")
+    set_parser.add_argument("albs", nargs='*',
+                            help="ALB identifiers, the pool itself may be one of them. None turns sharding off")
+    place_parser.add_argument("listener_group",
+                              help="Identifier of listener group")
+    place_parser.add_argument("alb", nargs='?', default=None,
+                              help="ALB to pin it to, leave out to remove the pin")
+    rebalance_parser.add_argument("--dry-run", action='store_true', default=False,
+                                  help="Only print the listener groups which would move")
+
+
+def setup_alb_route_cmd(command_parsers: argparse._SubParsersAction):
+    parser = command_parsers.add_parser(
+        'route', help='Show which rule and backend haproxy uses for a request'
+    )  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    parser.add_argument("--alb-identifier", dest="alb_id", default='vhost',
+                        help="Identifier for application load balancer to route with, defaults to vhost")
+    parser.add_argument("--snapshot", default=None,
+                        help="Route with a snapshot file instead of the configuration in etcd, e.g. "
+                             "/etc/haproxy.snapshot.json")
+    parser.add_argument("--port", type=int, default=80,
+                        help="Port the request arrives on, defaults to 80")
+    parser.add_argument("--file", "-f", default=None,
+                        help="Verify many requests, each line is a haproxy HTTP log line or 'host path [port]'. "
+                             "Use - for stdin. Exits with 1 if a logged backend differs from the routed one")
+    parser.add_argument("--max-mismatches", type=int, default=20,
+                        help="Max number of mismatching lines to print with --file, defaults to 20")
+    parser.add_argument("--format", choices=('text', 'json'), default='text',
+                        help="Output format, defaults to text")
+    parser.add_argument("host", nargs='?', default=None,
+                        help="Host header of the request")
+    parser.add_argument("path", nargs='?', default='/',
+                        help="Path of the request, defaults to /")
+
+
+def setup_alb_log_stats_cmd(command_parsers: argparse._SubParsersAction):
+    parser = command_parsers.add_parser(
+        'log-stats', help='Summarize haproxy access logs per frontend, backend and host'
+    )  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--file", "-f", default=None,
+                        help="Log file to read, defaults to stdin")
+    source.add_argument("--socket", default=None,
+                        help="Path to unix datagram socket to receive logs on, e.g. the log sidecar path")
+    source.add_argument("--udp", default=None, metavar="[HOST:]PORT",
+                        help="Receive syslog messages on this UDP address")
+    parser.add_argument("--follow", action='store_true', default=False,
+                        help="Keep reading the file as it grows")
+    parser.add_argument("--interval", type=float, default=60,
+                        help="Seconds between summaries, defaults to 60")
+    parser.add_argument("--format", choices=('text', 'json'), default='json',
+                        help="Summary format, json writes one object per interval. Defaults to json")
+    parser.add_argument("--max-keys", type=int, default=1000,
+                        help="Max number of frontends, backends and hosts to track each, others are counted "
+                             "as _other. Defaults to 1000")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve the latest summary as Prometheus metrics on this port")
+
+
+def setup_bench_cmd(command_parsers: argparse._SubParsersAction):
+    """
+    Setup 'bench' command, contains sub-commands.
+    """
+    parser = command_parsers.add_parser(
+        'bench', help='Benchmarks with synthetic configurations')  # type: argparse.ArgumentParser
+    command_parsers = parser.add_subparsers(dest="bench_cmd")
+    setup_bench_control_plane_cmd(command_parsers)
+    setup_bench_data_plane_cmd(command_parsers)
+    setup_bench_startup_cmd(command_parsers)
+
+
+def setup_bench_results_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--output", "-o", default=None,
+                        help="Write results as JSON to this file, can be used as a baseline later")
+    parser.add_argument("--baseline", default=None,
+                        help="Results file to compare with, exits with 1 if a stage is slower than the tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown compared with the baseline, defaults to 0.25 (25%%)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of timed runs per stage, defaults to 5")
+
+
+def setup_bench_control_plane_cmd(command_parsers: argparse._SubParsersAction):
+    parser = command_parsers.add_parser(
+        'control-plane', help='Time loading, rendering and certificate sync with an in-memory etcd'
+    )  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+    setup_bench_results_args(parser)
+
+    parser.add_argument("--vhosts", type=int, default=1000,
+                        help="Number of virtual-hosts to generate, defaults to 1000")
+    parser.add_argument("--targets", type=int, default=3,
+                        help="Number of targets per virtual-host, defaults to 3")
+    parser.add_argument("--certificates", type=int, default=100,
+                        help="Number of https virtual-hosts with an uploaded certificate, defaults to 100")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Seed for the port mode mix, defaults to 1")
+    parser.add_argument("--haproxy-check", action='store_true', default=False,
+                        help="Also time 'haproxy -c' on the rendered configuration, needs haproxy installed")
+    parser.add_argument("--no-memory", action='store_true', default=False,
+                        help="Skip the tracemalloc run of each stage")
+
+
+def setup_bench_data_plane_cmd(command_parsers: argparse._SubParsersAction):
+    parser = command_parsers.add_parser(
+        'data-plane', help='Measure throughput and latency through a local haproxy with stub backends'
+    )  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+    setup_bench_results_args(parser)
+    parser.set_defaults(repeat=3)
+
+    parser.add_argument("--vhosts", type=int, default=100,
+                        help="Number of virtual-hosts, requests rotate over their Host headers. Defaults to 100")
+    parser.add_argument("--targets", type=int, default=2,
+                        help="Number of targets per virtual-host, defaults to 2")
+    parser.add_argument("--backends", type=int, default=4,
+                        help="Number of stub backends on loopback, defaults to 4")
+    parser.add_argument("--concurrency", "-c", type=int, default=32,
+                        help="Number of concurrent connections, defaults to 32")
+    parser.add_argument("--duration", "-d", type=float, default=10,
+                        help="Seconds per run, defaults to 10")
+    parser.add_argument("--warmup", type=float, default=1,
+                        help="Seconds of load before the measured runs, defaults to 1")
+    parser.add_argument("--no-keep-alive", action='store_true', default=False,
+                        help="Open a new connection for each request")
+    parser.add_argument("--listen-port", type=int, default=18080,
+                        help="Port for the haproxy listener, defaults to 18080")
+    parser.add_argument("--template", default=None,
+                        help="haproxy template variant to render, defaults to templates/haproxy/haproxy.cfg")
+    parser.add_argument("--haproxy", default='haproxy',
+                        help="haproxy binary to run, defaults to haproxy in PATH")
+    parser.add_argument("--direct", action='store_true', default=False,
+                        help="Skip haproxy and send the load straight to a stub backend, shows the ceiling of "
+                             "the load generator")
+
+
+def setup_bench_startup_cmd(command_parsers: argparse._SubParsersAction):
+    parser = command_parsers.add_parser(
+        'startup', help='Measure the import time of each command in a fresh interpreter'
+    )  # type: argparse.ArgumentParser
+    setup_common_args(parser)
+    setup_bench_results_args(parser)
+
+    parser.add_argument("--command", dest="commands", action='append', default=None,
+                        help="Command to measure, e.g. 'listener register-docker', may be repeated. Also 'parser' "
+                             "for only parsing arguments and 'python' for a bare interpreter. Defaults to all")
+    parser.add_argument("--budget-ms", type=float, default=None,
+                        help="Max median import time in milliseconds for each command, exits with 1 if a "
+                             "command is over budget")
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import logging
+import os
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import etcd
+
+from .register import etcd_client, WriteBatch, StateMirror, register_vhost_config, parse_targets, \
+    normalize_port_mode, normalize_limits, normalize_capacity, normalize_seconds, keep_lease_alive, \
+    DEFAULT_DRAIN_TIMEOUT
+from .shards import pool_albs
+from .timing import span
+from .utils import HostResolver
+
+logger = logging.getLogger('docker-alb')
+
+BATCH_SIZE = 100
+RESOLVE_WORKERS = 16
+
+
+class ManifestError(Exception):
+    pass
+
+
+class VhostEntry(object):
+    __slots__ = ('index', 'identifier', 'domains', 'port_mode', 'targets', 'certificate_name', 'certificate',
+                 'use_certbot', 'limits', 'capacity', 'slowstart', 'drain_timeout', 'error')
+
+    def __init__(self, index, data: dict):
+        """
+        A virtual-host from a batch manifest, uses the same fields as requests to 'listener daemon'
+        plus certificate for a PEM file to upload.
+
+        :param index: Position in the manifest, starting at 1.
+        :raises ValueError: If the entry is invalid.
+        """
+        self.index = index
+        self.error = None
+        if not isinstance(data, dict):
+            raise ValueError("Entry {} must be an object".format(index))
+        domains = data.get('domains')
+        if isinstance(domains, str):
+            domains = domains.split(',')
+        if not domains:
+            raise ValueError("Entry {} is missing domains".format(index))
+        self.domains = [str(domain) for domain in domains]
+        self.identifier = str(data.get('id') or ('vhost-' + self.domains[0]))
+        self.port_mode = normalize_port_mode(str(data.get('port') or 'https'))
+        targets = data.get('targets') or ''
+        if isinstance(targets, list):
+            targets = ','.join(str(target) for target in targets)
+        self.targets = targets
+        self.certificate_name = data.get('certificate_name') or self.identifier
+        self.certificate = data.get('certificate')
+        self.use_certbot = bool(data.get('certbot'))
+        self.limits = normalize_limits(data.get('limits'))
+        self.capacity = normalize_capacity(data.get('capacity'))
+        self.slowstart = normalize_seconds(data.get('slowstart'), 'Slowstart')
+        self.drain_timeout = normalize_seconds(data.get('drain_timeout', DEFAULT_DRAIN_TIMEOUT), 'Drain timeout')
+
+    def __repr__(self):
+        return "VhostEntry({!r},domains={!r})".format(self.identifier, self.domains)
+
+    @property
+    def target_hosts(self):
+        """
+        Hostnames of the targets which must be resolved, see parse_targets.
+        """
+        hosts = set()
+        for target in self.targets.split(',') if self.targets else []:
+            host = target.split(':', 1)[0]
+            if host[:1] == '-':
+                host = host[1:]
+            if host != 'dockerhost':
+                hosts.add(host)
+        return hosts
+
+
+def parse_manifest(text, filename=None):
+    """
+    Parses a batch manifest, either a JSON list, a JSON object with a vhosts list, NDJSON with
+    one virtual-host per line or the same structures as YAML (needs PyYAML).
+
+    :param filename: Used to pick the format from the extension, otherwise it is detected.
+    :return: List of dictionaries, one per virtual-host.
+    :raises ManifestError: If the manifest cannot be parsed.
+    """
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ManifestError("YAML manifests need PyYAML, install it or use JSON")
+        try:
+            data = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ManifestError("Invalid YAML manifest: {}".format(e))
+    elif extension in ('.ndjson', '.jsonl'):
+        data = parse_ndjson(text)
+    else:
+        try:
+            data = json.loads(text)
+        except ValueError:
+            data = parse_ndjson(text)
+        else:
+            if isinstance(data, dict) and 'vhosts' not in data:
+                # A single line of NDJSON
+                data = [data]
+    if isinstance(data, dict):
+        data = data.get('vhosts')
+    if not isinstance(data, list):
+        raise ManifestError("Manifest must be a list of virtual-hosts or an object with a vhosts list")
+    return data
+
+
+def parse_ndjson(text):
+    entries = []
+    for line_number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            entries.append(json.loads(line))
+        except ValueError as e:
+            raise ManifestError("Invalid JSON on line {}: {}".format(line_number, e))
+    return entries
+
+
+def load_entries(data: list):
+    """
+    :return: Tuple of list of valid VhostEntry and list of (index, error) for invalid entries.
+    """
+    entries = []
+    errors = []
+    identifiers = set()
+    for index, item in enumerate(data, 1):
+        try:
+            entry = VhostEntry(index, item)
+        except ValueError as e:
+            errors.append((index, str(e)))
+            continue
+        if entry.identifier in identifiers:
+            errors.append((index, "Entry {} repeats id {}".format(index, entry.identifier)))
+            continue
+        identifiers.add(entry.identifier)
+        entries.append(entry)
+    return entries, errors
+
+
+def resolve_hosts(hosts, resolve=socket.gethostbyname, workers=RESOLVE_WORKERS):
+    """
+    Resolves hostnames concurrently, each name is only looked up once.
+
+    :return: Dictionary of hostname to IP address, or to the OSError if the lookup failed.
+    """
+    resolver = HostResolver(resolve=resolve)
+
+    def lookup(host):
+        try:
+            return host, resolver(host)
+        except OSError as e:
+            return host, e
+
+    hosts = sorted(set(hosts))
+    if not hosts:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(hosts)))) as executor:
+        return dict(executor.map(lookup, hosts))
+
+
+def prepare_entry(entry: VhostEntry, addresses: dict, dockerhost_ip=None):
+    """
+    Does everything which may fail for an entry before anything is queued, so a bad entry never
+    leaves a partial virtual-host in a batch.
+
+    :return: Dictionary of keyword arguments for register_vhost_config.
+    :raises ValueError, OSError: If targets cannot be resolved or the certificate cannot be read.
+    """
+    def resolve(host):
+        address = addresses.get(host)
+        if isinstance(address, Exception):
+            raise ValueError("Cannot resolve target {}: {}".format(host, address))
+        if address is None:
+            raise ValueError("Target {} was not resolved".format(host))
+        return address
+
+    targets, removed_targets = parse_targets(entry.targets, dockerhost_ip=dockerhost_ip, resolve=resolve) \
+        if entry.targets else ([], [])
+    certificate = None
+    if entry.certificate and not entry.use_certbot:
+        with open(entry.certificate) as cert_fh:
+            certificate = io.StringIO(cert_fh.read())
+    return {
+        'identifier': entry.identifier,
+        'domains': entry.domains,
+        'port_mode': entry.port_mode,
+        'targets': targets,
+        'removed_targets': removed_targets,
+        'certificate_name': entry.certificate_name,
+        'use_certbot': entry.use_certbot,
+        'certificate': certificate,
+        'limits': entry.limits,
+        'capacity': entry.capacity,
+        'slowstart': entry.slowstart,
+        'drain_timeout': entry.drain_timeout,
+    }
+
+
+def register_entries(client: etcd.Client, alb, entries, batch_size=BATCH_SIZE, dockerhost_ip=None, lease=None,
+                     resolve=socket.gethostbyname, workers=RESOLVE_WORKERS, dry_run=False, progress=None):
+    """
+    Registers virtual-hosts in batches. Targets of all entries are resolved up front, then
+    batch_size entries at a time are queued in one WriteBatch backed by a mirror of the ALBs of
+    the pool and the target groups, so etcd is read once instead of once per entity.
+
+    :param progress: Called with the entries of each batch after it is applied (or planned).
+    :return: List of (operation, key, value) mutations that were applied or, with dry_run, planned.
+             Entries which failed have their error set.
+    """
+    with span('resolve_targets', entries=len(entries)):
+        addresses = resolve_hosts(set().union(*(entry.target_hosts for entry in entries)) if entries else (),
+                                  resolve=resolve, workers=workers)
+
+    mirror = StateMirror(client, ['/alb/' + pool_alb for pool_alb in pool_albs(client, alb)] + ['/target_group'])
+    all_mutations = []
+    for start in range(0, len(entries), batch_size):
+        chunk = entries[start:start + batch_size]
+        if mirror.loaded is None:
+            with span('load_mirror'):
+                mirror.load()
+        batch = WriteBatch(client, mirror=mirror)
+        queued = []
+        for entry in chunk:
+            try:
+                config = prepare_entry(entry, addresses, dockerhost_ip=dockerhost_ip)
+            except (ValueError, OSError) as e:
+                entry.error = str(e)
+                continue
+            register_vhost_config(batch, alb=alb, lease=lease, **config)
+            queued.append(entry)
+
+        with span('apply_batch', entries=len(queued)):
+            try:
+                mutations = batch.plan()
+                if not dry_run:
+                    batch.apply(mutations)
+            except etcd.EtcdException as e:
+                logger.error("Failed to apply batch of %d virtual-hosts: %s", len(queued), e)
+                # Some keys may be written, start over from etcd for the next batch
+                mirror.loaded = None
+                for entry in queued:
+                    entry.error = str(e)
+                mutations = []
+        all_mutations.extend(mutations)
+        if progress is not None:
+            progress(chunk)
+    return all_mutations
+
+
+def register_batch(args):
+    """
+    Registers all virtual-hosts from a manifest file with one etcd client and batched writes.
+    """
+    try:
+        if args.manifest == '-':
+            text = sys.stdin.read()
+        else:
+            with open(args.manifest, encoding='utf8') as manifest_file:
+                text = manifest_file.read()
+        data = parse_manifest(text, filename=None if args.manifest == '-' else args.manifest)
+    except (OSError, ManifestError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    entries, errors = load_entries(data)
+    for index, error in errors:
+        print("error entry {}: {}".format(index, error), file=sys.stderr)
+    if errors and not args.keep_going:
+        sys.exit(1)
+
+    client = etcd_client(args.etcd_host)
+    alb_identifier = os.environ.get('ALB_ID', args.alb_id)
+    lease = None
+    if args.ttl:
+        lease = args.lease or socket.gethostname()
+        if not args.dry_run:
+            keep_lease_alive(client, lease, ttl=args.ttl)
+
+    done = [0]
+
+    def progress(chunk):
+        done[0] += len(chunk)
+        for entry in chunk:
+            if args.format == 'json':
+                print(json.dumps({'ref': entry.index, 'id': entry.identifier, 'ok': entry.error is None,
+                                  'error': entry.error}, sort_keys=True))
+            elif entry.error is not None:
+                print("error {}: {}".format(entry.identifier, entry.error))
+            elif args.verbosity >= 1:
+                print("ok {}".format(entry.identifier))
+        if args.verbosity >= 0:
+            print("{}/{} virtual-hosts".format(done[0], len(entries)), file=sys.stderr)
+
+    mutations = register_entries(client, alb_identifier, entries, batch_size=args.batch_size,
+                                 dockerhost_ip=os.environ.get("DOCKERHOST_IP"), lease=lease,
+                                 workers=args.resolvers, dry_run=args.dry_run, progress=progress)
+    if args.dry_run:
+        for operation, key, value in mutations:
+            if operation == 'write':
+                print("write {} = {}".format(key, value))
+            else:
+                print("delete {}".format(key))
+
+    registered = sum(1 for entry in entries if entry.error is None)
+    failed = len(entries) - registered + len(errors)
+    if args.verbosity >= 0:
+        print("{} {} virtual-hosts with {} mutations, {} failed".format(
+            'Planned' if args.dry_run else 'Registered', registered, len(mutations), failed), file=sys.stderr)
+    if failed:
+        sys.exit(1)
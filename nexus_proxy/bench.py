@@ -0,0 +1,805 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import gc
+import http.server
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import etcd
+
+from .accesslog import QuantileSketch
+from .cli import COMMANDS
+from .dockerapi import VIRTUAL_HOST_LABEL
+from .generator import generate_config, write_config
+from .manager import get_alb, transfer_certificates
+from .register import register_vhost_config, register_certificate
+from .services import LoadBalancerConfig, Listener, Rule, TargetGroup, Target, HealthCheck
+
+BENCH_FORMAT = 'nap-bench'
+BENCH_VERSION = 1
+# Port modes used for synthetic virtual-hosts, in the proportions they are picked
+PORT_MODES = ('https', 'https', 'http', 'mixed', '8080')
+DEFAULT_TOLERANCE = 0.25
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+# Directory with 503sorry.http, relative to the repository like the haproxy template
+ERRORFILES_PATH = 'compose/loadbalancer'
+# Run by each startup measurement: build the argument parser like nap.py, then import the module of
+# the command given as arguments. Commands are not run, so nothing needs etcd or haproxy.
+STARTUP_SCRIPT = "import sys; import nexus_proxy.cli as cli; cli.build_parser(); sys.argv[1:] and cli.load_command(*sys.argv[1:])"
+
+logger = logging.getLogger('docker-alb')
+
+
+class MemoryClient(object):
+    def __init__(self):
+        """
+        In-memory stand-in for the parts of the etcd v2 client NAP uses: read (also recursive),
+        get, write, set and delete. Directories are implicit and TTLs are ignored.
+        Recursive reads return a flat list of leaves, which is all that .leaves needs.
+        """
+        self.values = {}  # type: Dict[str, str]
+        self.dirs = set()
+        self.requests = 0
+        self._sorted = None
+
+    def _keys(self):
+        if self._sorted is None:
+            self._sorted = sorted(self.values)
+        return self._sorted
+
+    def _not_found(self, key):
+        raise etcd.EtcdKeyNotFound("Key not found : " + key, payload={'cause': key})
+
+    def read(self, key, recursive=False, **kwargs):
+        self.requests += 1
+        key = '/' + key.strip('/')
+        if key in self.values:
+            return etcd.EtcdResult('get', {'key': key, 'value': self.values[key]})
+        if key not in self.dirs:
+            self._not_found(key)
+        prefix = key.rstrip('/') + '/'
+        keys = self._keys()
+        nodes = []
+        for idx in range(bisect_left(keys, prefix), len(keys)):
+            child = keys[idx]
+            if not child.startswith(prefix):
+                break
+            if recursive:
+                nodes.append({'key': child, 'value': self.values[child]})
+            elif '/' not in child[len(prefix):]:
+                nodes.append({'key': child, 'value': self.values[child]})
+        if not recursive:
+            nodes.extend({'key': prefix + name, 'dir': True}
+                         for name in sorted({child[len(prefix):].split('/', 1)[0] for child in self.dirs
+                                             if child.startswith(prefix)}))
+        return etcd.EtcdResult('get', {'key': key, 'dir': True, 'nodes': nodes})
+
+    def get(self, key):
+        return self.read(key)
+
+    def write(self, key, value, ttl=None, dir=False, **kwargs):
+        self.requests += 1
+        key = '/' + key.strip('/')
+        parts = key.split('/')
+        for idx in range(2, len(parts)):
+            self.dirs.add('/'.join(parts[:idx]))
+        if dir:
+            self.dirs.add(key)
+        else:
+            if key not in self.values:
+                self._sorted = None
+            self.values[key] = value
+        return etcd.EtcdResult('set', {'key': key, 'value': value})
+
+    def set(self, key, value, ttl=None):
+        return self.write(key, value, ttl=ttl)
+
+    def delete(self, key, recursive=None, dir=None, **kwargs):
+        self.requests += 1
+        key = '/' + key.strip('/')
+        if key not in self.values and key not in self.dirs:
+            self._not_found(key)
+        prefix = key + '/'
+        for child in [child for child in self.values if child == key or child.startswith(prefix)]:
+            del self.values[child]
+        self.dirs = {child for child in self.dirs if child != key and not child.startswith(prefix)}
+        self._sorted = None
+        return etcd.EtcdResult('delete', {'key': key})
+
+
+class ReplayDockerEngine(object):
+    def __init__(self, containers=None, events=None, interval=0.0):
+        """
+        Stand-in for the Docker Engine API on a local unix socket, runs DockerWatcher without docker.
+        The first event stream replays events and is then closed, like a restarted engine, later
+        streams stay open without events until the engine is stopped.
+
+        :param containers: Inspect results of the containers which exist at the start.
+        :param events: List of (event, container) tuples, container is the inspect result after the
+                       event or None if the container is gone.
+        :param interval: Seconds between replayed events.
+        """
+        self.containers = {container['Id']: container for container in containers or []}
+        self.events = list(events or [])
+        self.interval = interval
+        self.replayed = 0
+        self.streams = 0
+        self.socket_path = None
+        self.server = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        :return: Path of the socket to pass to DockerClient.
+        """
+        engine = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                engine.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.socket_path = os.path.join(tempfile.mkdtemp(prefix='nap-docker-'), 'docker.sock')
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='docker-replay', daemon=True).start()
+        return self.socket_path
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            shutil.rmtree(os.path.dirname(self.socket_path), ignore_errors=True)
+            self.server = None
+
+    def handle(self, request: http.server.BaseHTTPRequestHandler):
+        path = urlsplit(request.path).path
+        if path == '/events':
+            self.stream_events(request)
+            return
+        with self.lock:
+            if path == '/containers/json':
+                body = [{'Id': container_id, 'Labels': (container.get('Config') or {}).get('Labels') or {}}
+                        for container_id, container in sorted(self.containers.items())
+                        if VIRTUAL_HOST_LABEL in ((container.get('Config') or {}).get('Labels') or {})]
+            elif path.startswith('/containers/') and path.endswith('/json'):
+                body = self.containers.get(path[len('/containers/'):-len('/json')])
+            else:
+                body = None
+        if body is None:
+            request.send_error(404, "No such container")
+            return
+        data = json.dumps(body).encode('utf8')
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def stream_events(self, request: http.server.BaseHTTPRequestHandler):
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/json')
+        request.end_headers()
+        with self.lock:
+            self.streams += 1
+            replay = self.streams == 1
+        if not replay:
+            self.stopped.wait()
+            return
+        for event, container in self.events:
+            container_id = event.get('id') or (event.get('Actor') or {}).get('ID')
+            with self.lock:
+                if container is None:
+                    self.containers.pop(container_id, None)
+                else:
+                    self.containers[container_id] = container
+            request.wfile.write(json.dumps(event).encode('utf8') + b"\n")
+            request.wfile.flush()
+            self.replayed += 1
+            if self.interval:
+                time.sleep(self.interval)
+
+
+def fake_pem(name):
+    return "-----BEGIN CERTIFICATE-----\n{}\n-----END CERTIFICATE-----\n".format(name * 20)
+
+
+def populate(client, alb_id, vhosts, targets, certificates, seed=1):
+    """
+    Registers a synthetic configuration through the regular register functions.
+
+    :param vhosts: Number of virtual-hosts, port modes are a mix of http, https, mixed and a custom port.
+    :param targets: Number of targets per virtual-host.
+    :param certificates: Number of https virtual-hosts which get an uploaded certificate.
+    :return: Dictionary describing the generated configuration.
+    """
+    rng = random.Random(seed)
+    counts = {}
+    with_certificate = 0
+    for idx in range(vhosts):
+        main_domain = 'vhost{}.example.com'.format(idx)
+        domains = [main_domain, 'www.' + main_domain]
+        if idx % 7 == 0:
+            domains.append('api.example.com/v{}'.format(idx))
+        port_mode = PORT_MODES[rng.randrange(len(PORT_MODES))]
+        counts[port_mode] = counts.get(port_mode, 0) + 1
+        identifier = 'vhost-' + main_domain
+        if port_mode in ('https', 'mixed') and with_certificate < certificates:
+            register_certificate(client, identifier, domains=domains, email='bench@example.com',
+                                 data=fake_pem(identifier), modified=datetime(2020, 1, 1))
+            with_certificate += 1
+        vhost_targets = [{'host': '10.{}.{}.{}'.format(idx // 65536 % 256, idx // 256 % 256, idx % 256),
+                          'port': 8000 + target} for target in range(targets)]
+        register_vhost_config(client, alb=alb_id, identifier=identifier, domains=domains, port_mode=port_mode,
+                              targets=vhost_targets)
+    return {
+        'vhosts': vhosts,
+        'targets_per_vhost': targets,
+        'certificates': with_certificate,
+        'port_modes': counts,
+        'keys': len(client.values),
+    }
+
+
+class Timer(object):
+    def __init__(self, repeat=5, measure_memory=True):
+        """
+        Runs benchmark stages and collects timing and memory results.
+
+        :param repeat: Number of timed runs per stage, the median and min are reported.
+        :param measure_memory: If True a separate run of each stage is traced with tracemalloc.
+        """
+        self.repeat = repeat
+        self.measure_memory = measure_memory
+        self.results = {}
+
+    def run(self, name, func, client=None):
+        """
+        :param func: Function to benchmark, called without arguments.
+        :param client: MemoryClient used by func, requests of a single run are reported.
+        :return: Value returned by the last run.
+        """
+        durations = []
+        result = None
+        requests = None
+        try:
+            for _ in range(self.repeat):
+                gc.collect()
+                before = client.requests if client is not None else 0
+                start = time.perf_counter()
+                result = func()
+                durations.append(time.perf_counter() - start)
+                if client is not None:
+                    requests = client.requests - before
+            peak = None
+            if self.measure_memory:
+                gc.collect()
+                tracemalloc.start()
+                func()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        except (OSError, subprocess.SubprocessError) as e:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            self.results[name] = {'error': str(e)}
+            return None
+        durations.sort()
+        self.results[name] = {
+            'median_ms': round(durations[len(durations) // 2] * 1000, 3),
+            'min_ms': round(durations[0] * 1000, 3),
+            'runs': len(durations),
+            'peak_kb': round(peak / 1024, 1) if peak is not None else None,
+            'etcd_requests': requests,
+        }
+        return result
+
+
+def run_control_plane(vhosts=1000, targets=3, certificates=100, repeat=5, haproxy_check=False, seed=1,
+                      measure_memory=True):
+    """
+    Benchmarks loading, rendering and certificate sync of a synthetic configuration.
+
+    :return: Result document, see write_results.
+    """
+    alb_id = 'bench'
+    client = MemoryClient()
+    timer = Timer(repeat=repeat, measure_memory=measure_memory)
+    start = time.perf_counter()
+    config = populate(client, alb_id, vhosts=vhosts, targets=targets, certificates=certificates, seed=seed)
+    config['populate_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+    work_dir = tempfile.mkdtemp(prefix='nap-bench-')
+    environ = dict(os.environ)
+    os.environ['CERTS_PATH'] = os.path.join(work_dir, 'crt')
+    os.environ['CERTS_TEMP_PATH'] = os.path.join(work_dir, 'crt.new')
+    try:
+        alb_config = timer.run('get_alb', lambda: get_alb(alb_id, with_listener_group=True, client=client),
+                               client=client)
+        timer.run('port_groups', lambda: alb_config.port_groups)
+        timer.run('target_groups', lambda: alb_config.target_groups)
+        # The poll loop compares each load with the running configuration
+        other_config = get_alb(alb_id, with_listener_group=True, client=client)
+        timer.run('compare_equal', lambda: alb_config.listeners_map == other_config.listeners_map and
+                  alb_config.target_groups_map == other_config.target_groups_map)
+        timer.run('generate_config', lambda: generate_config(alb_config))
+        timer.run('transfer_certificates', lambda: transfer_certificates(alb_config, client=client), client=client)
+        if haproxy_check:
+            config_filename = os.path.join(work_dir, 'haproxy.cfg')
+            write_config(alb_config, filename=config_filename)
+            timer.run('haproxy_check', lambda: subprocess.run(
+                ['haproxy', '-c', '-q', '-f', config_filename], check=True, stdout=subprocess.DEVNULL))
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    config.update({
+        'listeners': len(alb_config.listeners_map),
+        'target_groups': len(alb_config.target_groups_map),
+        'rules': sum(len(listener.rules) for listener in alb_config.listeners),
+    })
+    return {
+        'format': BENCH_FORMAT,
+        'version': BENCH_VERSION,
+        'suite': 'control-plane',
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'config': config,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'results': timer.results,
+    }
+
+
+class BenchError(Exception):
+    pass
+
+
+async def serve_stub(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    Minimal HTTP/1.1 backend, answers every request with a tiny 200 response and keeps the connection
+    open unless asked to close it.
+    """
+    try:
+        while True:
+            request = await reader.readuntil(b'\r\n\r\n')
+            close = b'connection: close' in request.lower() or b'HTTP/1.0' in request[:request.find(b'\r\n')]
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n' +
+                         (b'Connection: close\r\n' if close else b'') + b'\r\nok')
+            await writer.drain()
+            if close:
+                break
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_stub_backends(count, ports_queue):
+    """
+    Runs stub backends on loopback until terminated, meant to run in its own process so the backends
+    do not compete with the load generator. The bound ports are put on ports_queue.
+    """
+    async def serve():
+        ports = []
+        for _ in range(count):
+            server = await asyncio.start_server(serve_stub, '127.0.0.1', 0)
+            ports.append(server.sockets[0].getsockname()[1])
+        ports_queue.put(ports)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def synthetic_alb(vhosts, targets, backend_ports, listen_port):
+    """
+    Builds a configuration with one http listener which routes vhost<N>.bench.local to a target
+    group per virtual-host, targets are spread over the stub backends.
+
+    :return: Tuple of LoadBalancerConfig and list of host names.
+    """
+    targets = min(targets, len(backend_ports))
+    target_groups = {}
+    rules = []
+    hosts = []
+    for idx in range(vhosts):
+        host = 'vhost{}.bench.local'.format(idx)
+        tg_id = 'vhost-' + host
+        target_groups[tg_id] = TargetGroup(tg_id, protocol='http', health_check=HealthCheck(), targets=[
+            Target(host='127.0.0.1', port=backend_ports[(idx + offset) % len(backend_ports)])
+            for offset in range(targets)])
+        rules.append(Rule(host=host, action='tg:' + tg_id, target_group=target_groups[tg_id]))
+        hosts.append(host)
+    listener = Listener('http-bench', port=listen_port, protocol='http', rules=rules)
+    return LoadBalancerConfig('bench', listeners={listener.identifier: listener},
+                              target_groups=target_groups), hosts
+
+
+def wait_for_port(port, timeout=10.0, process: subprocess.Popen = None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise BenchError("haproxy exited with {}: {}".format(
+                process.returncode, process.stderr.read().decode('utf8', 'replace').strip()))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise BenchError("Nothing is listening on port {} after {} seconds".format(port, timeout))
+
+
+def start_haproxy(config_filename, listen_port, haproxy='haproxy'):
+    """
+    Starts haproxy in the foreground with the rendered configuration and waits until it accepts connections.
+    """
+    try:
+        process = subprocess.Popen([haproxy, '-db', '-f', config_filename], stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE)
+    except OSError as e:
+        raise BenchError("Cannot start {}: {}".format(haproxy, e))
+    try:
+        wait_for_port(listen_port, process=process)
+    except BenchError:
+        process.kill()
+        raise
+    return process
+
+
+async def drive_load(port, hosts, concurrency, duration, keep_alive=True):
+    """
+    Sends GET requests to 127.0.0.1:port from concurrency connections for duration seconds, rotating
+    over the Host headers.
+
+    :return: Tuple of number of requests, errors, elapsed seconds and a QuantileSketch of latencies in ms.
+    """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + duration
+    sketch = QuantileSketch()
+    counts = {'requests': 0, 'errors': 0}
+    requests = [('GET / HTTP/1.1\r\nHost: {}\r\n{}\r\n'.format(
+        host, '' if keep_alive else 'Connection: close\r\n')).encode('ascii') for host in hosts]
+
+    async def worker(idx):
+        reader = writer = None
+        while loop.time() < deadline:
+            request = requests[idx % len(requests)]
+            idx += concurrency
+            start = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(request)
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = 0
+                for line in head.split(b'\r\n'):
+                    if line[:15].lower() == b'content-length:':
+                        length = int(line[15:])
+                if length:
+                    await reader.readexactly(length)
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+                counts['errors'] += 1
+                if writer is not None:
+                    writer.close()
+                reader = writer = None
+                continue
+            sketch.add((time.perf_counter() - start) * 1000)
+            counts['requests'] += 1
+            if head[9:10] == b'5':
+                counts['errors'] += 1
+            if not keep_alive or b'connection: close' in head.lower():
+                writer.close()
+                reader = writer = None
+        if writer is not None:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(idx) for idx in range(concurrency)))
+    return counts['requests'], counts['errors'], time.perf_counter() - start, sketch
+
+
+def run_data_plane(vhosts=100, targets=2, backends=4, concurrency=32, duration=10.0, repeat=3, warmup=1.0,
+                   keep_alive=True, listen_port=18080, template_filename=None, haproxy='haproxy', direct=False):
+    """
+    Renders a synthetic configuration, runs it in a local haproxy in front of stub backends and
+    measures throughput and latency with an async load generator.
+
+    :param direct: If True haproxy is skipped and the load goes straight to a stub backend, shows the
+                   ceiling of the load generator on this machine.
+    :param template_filename: Template variant to render, defaults to the regular template.
+    :return: Result document, see write_results.
+    """
+    ports_queue = multiprocessing.Queue()
+    stubs = multiprocessing.Process(target=run_stub_backends, args=(backends, ports_queue), daemon=True)
+    stubs.start()
+    work_dir = tempfile.mkdtemp(prefix='nap-bench-')
+    haproxy_process = None
+    try:
+        backend_ports = ports_queue.get(timeout=10)
+        alb_config, hosts = synthetic_alb(vhosts, targets, backend_ports, listen_port)
+        port = backend_ports[0] if direct else listen_port
+        if not direct:
+            environ = dict(os.environ)
+            os.environ.update({
+                'HAPROXY_SOCKET': os.path.join(work_dir, 'haproxy.sock'),
+                'HAPROXY_PIDFILE': os.path.join(work_dir, 'haproxy.pid'),
+                'HAPROXY_SERVER_STATE': os.path.join(work_dir, 'haproxy.state'),
+                'HAPROXY_ERRORFILES': os.path.abspath(ERRORFILES_PATH),
+                'CERTS_PATH': os.path.join(work_dir, 'crt'),
+            })
+            try:
+                config_filename = os.path.join(work_dir, 'haproxy.cfg')
+                write_config(alb_config, template_filename=template_filename, filename=config_filename)
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+            haproxy_process = start_haproxy(config_filename, listen_port, haproxy=haproxy)
+
+        if warmup:
+            asyncio.run(drive_load(port, hosts, concurrency, warmup, keep_alive=keep_alive))
+        runs = []
+        for _ in range(repeat):
+            runs.append(asyncio.run(drive_load(port, hosts, concurrency, duration, keep_alive=keep_alive)))
+    finally:
+        if haproxy_process is not None:
+            haproxy_process.terminate()
+            haproxy_process.wait()
+        stubs.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {}
+    throughput = sorted(requests / elapsed for requests, _, elapsed, _ in runs)
+    results['throughput'] = {
+        'median_rps': round(throughput[len(throughput) // 2], 1),
+        'max_rps': round(throughput[-1], 1),
+        'runs': len(runs),
+        'requests': sum(run[0] for run in runs),
+        'errors': sum(run[1] for run in runs),
+    }
+    for q in LATENCY_QUANTILES:
+        values = sorted(sketch.quantile(q) or 0.0 for _, _, _, sketch in runs)
+        results['latency_p{}'.format(int(q * 100))] = {
+            'median_ms': round(values[len(values) // 2], 3),
+            'min_ms': round(values[0], 3),
+            'runs': len(runs),
+        }
+    return {
+        'format': BENCH_FORMAT,
+        'version': BENCH_VERSION,
+        'suite': 'data-plane',
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'config': {
+            'vhosts': vhosts,
+            'targets_per_vhost': min(targets, backends),
+            'backends': backends,
+            'concurrency': concurrency,
+            'duration': duration,
+            'keep_alive': keep_alive,
+            'template': template_filename or 'default',
+            'direct': direct,
+        },
+        'results': results,
+    }
+
+
+def import_time(output):
+    """
+    :param output: stderr of python -X importtime.
+    :return: Tuple of total import time in milliseconds and number of modules imported.
+    """
+    total = 0
+    modules = 0
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        modules += 1
+        # Only top level imports, their cumulative time includes what they import
+        if not fields[2].startswith('  '):
+            total += int(fields[1])
+    return total / 1000.0, modules
+
+
+def run_startup(commands=None, repeat=5, budget_ms=None):
+    """
+    Measures the startup cost of CLI commands in fresh interpreters with python -X importtime: the
+    time spent importing modules and the wall time of the whole process.
+
+    :param commands: List of (command, sub-command), defaults to all commands. The entry 'parser'
+                     only builds the argument parser, 'python' starts a bare interpreter.
+    :param budget_ms: Max import time per command, commands over budget are marked in the results.
+    :return: Result document, see write_results.
+    """
+    if commands is None:
+        commands = [('python',), ('parser',)] + sorted(COMMANDS)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environ = dict(os.environ)
+    environ['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, environ.get('PYTHONPATH')]))
+    results = {}
+    for command in commands:
+        name = ' '.join(command)
+        script = 'pass' if command == ('python',) else STARTUP_SCRIPT
+        argv = [] if command in (('python',), ('parser',)) else list(command)
+        imports = []
+        walls = []
+        modules = 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, '-X', 'importtime', '-c', script] + argv,
+                                     env=environ, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                     universal_newlines=True)
+            walls.append(time.perf_counter() - start)
+            if process.returncode != 0:
+                raise BenchError("Importing '{}' failed: {}".format(name, process.stderr.strip().splitlines()[-1:]))
+            milliseconds, modules = import_time(process.stderr)
+            imports.append(milliseconds)
+        imports.sort()
+        walls.sort()
+        results[name] = {
+            'median_ms': round(imports[len(imports) // 2], 3),
+            'min_ms': round(imports[0], 3),
+            'wall_ms': round(walls[len(walls) // 2] * 1000, 3),
+            'modules': modules,
+            'runs': repeat,
+            'over_budget': budget_ms is not None and imports[len(imports) // 2] > budget_ms,
+        }
+    return {
+        'format': BENCH_FORMAT,
+        'version': BENCH_VERSION,
+        'suite': 'startup',
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'config': {
+            'commands': len(commands),
+            'budget_ms': budget_ms,
+        },
+        'results': results,
+    }
+
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares median times with a baseline, stages slower than the baseline by more than tolerance
+    are regressions. For throughput the ratio is inverted so a higher ratio is always worse.
+    Stages that failed or are missing in either document are skipped.
+
+    :return: List of (stage, baseline value, current value, slowdown ratio, is regression) tuples.
+    """
+    comparison = []
+    for name, current in sorted(results['results'].items()):
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        if 'median_rps' in previous and 'median_rps' in current:
+            # Throughput, lower is worse
+            ratio = previous['median_rps'] / current['median_rps'] if current['median_rps'] else float('inf')
+            comparison.append((name, previous['median_rps'], current['median_rps'], ratio, ratio > 1 + tolerance))
+            continue
+        if 'median_ms' not in previous or 'median_ms' not in current:
+            continue
+        ratio = current['median_ms'] / previous['median_ms'] if previous['median_ms'] else 1.0
+        comparison.append((name, previous['median_ms'], current['median_ms'], ratio, ratio > 1 + tolerance))
+    return comparison
+
+
+def format_results(results, comparison=None):
+    lines = ["{suite}: {config}".format(suite=results['suite'], config=json.dumps(results['config'],
+                                                                                  sort_keys=True))]
+    compared = {name: (base_value, ratio, regression)
+                for name, base_value, _, ratio, regression in comparison or []}
+    for name, values in results['results'].items():
+        if 'error' in values:
+            lines.append("{:<24} error: {}".format(name, values['error']))
+            continue
+        if 'median_rps' in values:
+            line = "{:<24} {:>10.1f} req/s (max {:.1f}) {} requests {} errors".format(
+                name, values['median_rps'], values['max_rps'], values['requests'], values['errors'])
+        else:
+            line = "{:<24} {:>10.2f} ms (min {:.2f})".format(name, values['median_ms'], values['min_ms'])
+        if values.get('wall_ms') is not None:
+            line += " wall {:.1f} ms {} modules".format(values['wall_ms'], values['modules'])
+        if values.get('over_budget'):
+            line += " OVER BUDGET"
+        if values.get('peak_kb') is not None:
+            line += " peak {:.0f} KiB".format(values['peak_kb'])
+        if values.get('etcd_requests') is not None:
+            line += " {} etcd requests".format(values['etcd_requests'])
+        if name in compared:
+            base_value, ratio, regression = compared[name]
+            line += " | baseline {:.2f} slower {:+.0%}{}".format(base_value, ratio - 1,
+                                                                 " REGRESSION" if regression else "")
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def write_results(results, filename):
+    with open(filename, 'w') as results_file:
+        json.dump(results, results_file, indent=1, sort_keys=True)
+        results_file.write("\n")
+
+
+def read_results(filename):
+    with open(filename) as results_file:
+        results = json.load(results_file)
+    if results.get('format') != BENCH_FORMAT:
+        raise ValueError("{} is not a benchmark result".format(filename))
+    return results
+
+
+def cli_bench_control_plane(args):
+    if args.verbosity < 2:
+        # Debug lines written for each listener would be measured instead of the code
+        logger.setLevel(logging.WARNING)
+    results = run_control_plane(vhosts=args.vhosts, targets=args.targets, certificates=args.certificates,
+                                repeat=args.repeat, haproxy_check=args.haproxy_check, seed=args.seed,
+                                measure_memory=not args.no_memory)
+    report_results(args, results)
+
+
+def report_results(args, results):
+    """
+    Prints results, writes them to --output and compares with --baseline. Exits with 1 on regressions.
+    """
+    comparison = None
+    if args.baseline:
+        try:
+            comparison = compare_results(results, read_results(args.baseline), tolerance=args.tolerance)
+        except (OSError, ValueError) as e:
+            print("Cannot read baseline: {}".format(e), file=sys.stderr)
+            sys.exit(2)
+    if args.output:
+        write_results(results, args.output)
+    if args.verbosity >= 0:
+        print(format_results(results, comparison))
+    if comparison and any(regression for *_, regression in comparison):
+        sys.exit(1)
+
+
+def cli_bench_data_plane(args):
+    try:
+        results = run_data_plane(vhosts=args.vhosts, targets=args.targets, backends=args.backends,
+                                 concurrency=args.concurrency, duration=args.duration, repeat=args.repeat,
+                                 warmup=args.warmup, keep_alive=not args.no_keep_alive,
+                                 listen_port=args.listen_port, template_filename=args.template,
+                                 haproxy=args.haproxy, direct=args.direct)
+    except BenchError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    report_results(args, results)
+
+
+def cli_bench_startup(args):
+    commands = None
+    if args.commands:
+        commands = [tuple(command.split()) for command in args.commands]
+    try:
+        results = run_startup(commands, repeat=args.repeat, budget_ms=args.budget_ms)
+    except BenchError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    report_results(args, results)
+    if any(values['over_budget'] for values in results['results'].values()):
+        sys.exit(1)
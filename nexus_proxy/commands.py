@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import subprocess
+import sys
+import time
+from subprocess import call
+
+import etcd
+import jinja2
+
+from .generator import write_config, HAPROXY_TEMPLATE
+from .haproxy import RuntimeClient, RuntimeAPIError, server_updates, update_servers, started_servers, \
+    warm_up_servers, save_server_state, discard_server_state
+from .snapshot import write_snapshot, get_running_snapshot_path
+from . import metrics
+from .timing import span, CycleProfiler
+from .stats import StatsCollector, get_stats_interval
+from .control import ControllerState, start_control_server, get_api_port
+from .fleet import LeaderElection, FleetMember, FleetError, get_fleet_enabled, get_leader_ttl
+from .manager import get_alb, transfer_certificates, mark_certbots_ready
+from .services import NoListeners
+from .utils import POLL_TIMEOUT, NO_SERVICES_TIMEOUT, ConfigurationError, get_etcd_addr
+
+logger = logging.getLogger('docker-alb')
+
+
+def cli_run_alb(args):
+    verbosity = args.verbosity
+    alb_id = os.environ.get('ALB_ID', args.alb_id)
+    if verbosity >= 1:
+        logger.info("Initializing ALB with identifier: %s", alb_id)
+
+    current_listeners_map = {}
+    current_target_groups_map = None
+    runtime = RuntimeClient()
+    no_services_timeout = NO_SERVICES_TIMEOUT
+    config_mtime = None
+    metrics_port = args.metrics_port or metrics.get_metrics_port()
+    if metrics_port:
+        metrics.start_metrics_server(metrics_port)
+        if verbosity >= 1:
+            logger.info("Serving metrics on port %s", metrics_port)
+    stats_collector = None
+    stats_interval = args.stats_interval or get_stats_interval()
+    if stats_interval:
+        host, port = get_etcd_addr()
+        stats_collector = StatsCollector(runtime, interval=stats_interval, alb_id=alb_id,
+                                         client=metrics.CountingClient(host=host, port=int(port)))
+        stats_collector.start()
+    fleet = None
+    if args.fleet or get_fleet_enabled():
+        host, port = get_etcd_addr()
+        election = LeaderElection(metrics.CountingClient(host=host, port=int(port)), alb_id,
+                                  ttl=args.leader_ttl or get_leader_ttl())
+        election.start()
+        fleet = FleetMember(metrics.CountingClient(host=host, port=int(port)), alb_id, election)
+        if verbosity >= 1:
+            logger.info("Running in fleet mode as %s", election.node)
+    state = ControllerState(alb_id)
+    state.fleet = fleet
+    api_port = args.api_port or get_api_port()
+    if api_port:
+        start_control_server(state, api_port, address=args.api_address)
+        if verbosity >= 1:
+            logger.info("Serving control API on %s:%s", args.api_address, api_port)
+    profiler = CycleProfiler(args.profile, cycles=args.profile_cycles) if args.profile else None
+    cycle = 0
+    cycle_requests = None
+    if verbosity >= 0:
+        logger.info("Polling configuration from etcd")
+    while True:
+        if cycle:
+            if profiler:
+                profiler.stop()
+            time.sleep(POLL_TIMEOUT)
+        cycle += 1
+        state.cycle()
+        if profiler:
+            profiler.start()
+        # Requests of the previous cycle, including certificate reads and certbot updates
+        etcd_requests = metrics.ETCD_REQUESTS.value
+        if cycle_requests is not None:
+            metrics.ETCD_REQUESTS_CYCLE.set(etcd_requests - cycle_requests)
+        cycle_requests = etcd_requests
+        poll_start = time.monotonic()
+        # Set when following a fleet leader, the config is then applied as the leader rendered it
+        published = None
+        try:
+            if fleet is not None and not fleet.is_leader:
+                with span('fetch_generation', metric=metrics.LOAD_SECONDS, alb=alb_id, cycle=cycle):
+                    published = fleet.poll()
+                if published is None:
+                    metrics.POLL_SECONDS.observe(time.monotonic() - poll_start)
+                    continue
+                alb_config = published.alb_config
+            else:
+                with span('get_alb', metric=metrics.LOAD_SECONDS, alb=alb_id, cycle=cycle):
+                    alb_config = get_alb(alb_id, with_listener_group=True)
+
+            new_config_mtime = int(os.path.getmtime(HAPROXY_TEMPLATE))
+            if verbosity >= 3:
+                logger.debug("Config new mtime: %s, old mtime: %s", new_config_mtime, config_mtime)
+            # The template of a follower does not matter, the leader rendered the config
+            listeners_unchanged = (published is not None or new_config_mtime == config_mtime) and \
+                alb_config.listeners_map == current_listeners_map
+            metrics.POLL_SECONDS.observe(time.monotonic() - poll_start)
+            if listeners_unchanged and alb_config.target_groups_map == current_target_groups_map:
+                continue
+
+            if listeners_unchanged and current_target_groups_map is not None:
+                # Targets which expired, were unregistered or are draining are changed through the
+                # runtime API, anything else needs a reload
+                updates = server_updates(current_target_groups_map, alb_config.target_groups_map)
+                if updates is not None:
+                    try:
+                        with span('update_servers', servers=len(updates), cycle=cycle):
+                            update_servers(runtime, updates)
+                        # Keep the config file in line with the running haproxy for the next reload
+                        with span('write_config', metric=metrics.RENDER_SECONDS, cycle=cycle):
+                            config_text = published.write_config() if published else write_config(alb_config)
+                        current_target_groups_map = alb_config.target_groups_map.copy()
+                        save_running_snapshot(alb_config)
+                        sync_fleet(fleet, alb_config, config_text, published)
+                        state.record_applied(alb_config, config_text, 'runtime')
+                        metrics.RUNTIME_UPDATES.inc()
+                        metrics.record_applied(alb_config)
+                        if stats_collector:
+                            stats_collector.update_config(alb_config)
+                        if verbosity >= 1:
+                            logger.info("Updated %d servers without reload", len(updates))
+                        continue
+                    except RuntimeAPIError as e:
+                        metrics.RUNTIME_FAILURES.inc()
+                        logger.warning("Could not update servers, reloading instead: %s", e)
+
+            if verbosity >= 1:
+                logger.debug("Config changed. Transferring certificates")
+            with span('transfer_certificates', cycle=cycle):
+                if published:
+                    published.write_certificates()
+                else:
+                    transfer_certificates(alb_config)
+
+            if verbosity >= 1:
+                logger.debug("Config changed. reload haproxy")
+            # Write to a new config file and verify it
+            with span('write_config', metric=metrics.RENDER_SECONDS, cycle=cycle):
+                if published:
+                    config_text = published.write_config(filename="/etc/haproxy.new.cfg")
+                else:
+                    config_text = write_config(alb_config, filename="/etc/haproxy.new.cfg")
+            config_mtime = int(os.path.getmtime(HAPROXY_TEMPLATE))
+            with span('configtest', metric=metrics.CONFIGTEST_SECONDS, cycle=cycle):
+                ret = call("./configtest-haproxy.sh /etc/haproxy.new.cfg", shell=True, stdout=subprocess.DEVNULL)
+            if ret != 0:
+                state.record_reload(False, 'configtest', returncode=ret)
+                metrics.CONFIGTEST_FAILURES.inc()
+                logger.error(
+                    "haproxy configuration is not valid, keeping old config, see /etc/haproxy.new.cfg for details")
+                continue
+
+            if verbosity >= 2:
+                logger.info("Reloading haproxy")
+            try:
+                with span('save_server_state', cycle=cycle):
+                    servers = save_server_state(runtime, alb_config.target_groups_map)
+                if verbosity >= 2:
+                    logger.info("Saved state of %d servers for the reload", servers)
+            except (RuntimeAPIError, OSError) as e:
+                discard_server_state()
+                if current_target_groups_map is not None:
+                    logger.warning("Could not save server state, servers are checked from scratch: %s", e)
+            reload_start = time.monotonic()
+            try:
+                with span('reload', metric=metrics.RELOAD_SECONDS, cycle=cycle):
+                    ret = call("./reload-haproxy.sh", shell=True)
+            except BaseException:
+                # The saved state is only valid for this reload, a later start must not restore it
+                discard_server_state()
+                raise
+            state.record_reload(ret == 0, 'reload', returncode=ret, seconds=time.monotonic() - reload_start)
+            if ret != 0:
+                discard_server_state()
+                metrics.RELOAD_FAILURES.inc()
+                logger.error("Reloading haproxy returned non-zero value: %s", ret)
+                continue
+            if current_target_groups_map is not None:
+                servers = started_servers(current_target_groups_map, alb_config.target_groups_map)
+                try:
+                    with span('warm_up_servers', servers=len(servers), cycle=cycle):
+                        warm_up_servers(runtime, servers)
+                except RuntimeAPIError as e:
+                    logger.warning("Could not slow-start new servers: %s", e)
+            current_listeners_map = alb_config.listeners_map.copy()
+            current_target_groups_map = alb_config.target_groups_map.copy()
+            save_running_snapshot(alb_config)
+            sync_fleet(fleet, alb_config, config_text, published)
+            state.record_applied(alb_config, config_text, 'reload')
+            metrics.RELOADS.inc()
+            metrics.record_applied(alb_config)
+            if stats_collector:
+                stats_collector.update_config(alb_config)
+            if published is None:
+                with span('mark_certbots_ready', cycle=cycle):
+                    mark_certbots_ready(alb_config)
+
+        except NoListeners:
+            if verbosity >= 1:
+                logger.info("No services, waiting")
+            time.sleep(no_services_timeout)
+            pass
+        except ConfigurationError as e:
+            if verbosity >= 0:
+                logger.error("Etcd host is not defined: %s", e)
+            sys.exit(1)
+        except FleetError as e:
+            if verbosity >= 0:
+                logger.error("Cannot apply configuration published by the fleet leader: %s", e)
+        except jinja2.exceptions.TemplateError as e:
+            if verbosity >= 0:
+                logger.error("Error while rendering jinja2 template: %s", e)
+            time.sleep(no_services_timeout)
+            pass
+        except Exception as e:
+            if verbosity >= 0:
+                logger.exception("Unknown error")
+            raise
+
+
+def sync_fleet(fleet: FleetMember, alb_config, config_text, published=None):
+    """
+    Publishes an applied configuration to the fleet as leader, or records the generation as applied
+    when following.
+    """
+    if fleet is None:
+        return
+    if published is not None:
+        fleet.applied(published)
+        return
+    try:
+        with span('publish_generation'):
+            fleet.publish(alb_config, config_text)
+    except etcd.EtcdException as e:
+        logger.warning("Could not publish configuration to the fleet: %s", e)
+
+
+def save_running_snapshot(alb_config):
+    try:
+        write_snapshot(alb_config, get_running_snapshot_path())
+    except OSError as e:
+        logger.warning("Could not write snapshot of running configuration: %s", e)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+from .snapshot import config_to_dict
+
+logger = logging.getLogger('docker-alb')
+
+DEFAULT_API_ADDRESS = '127.0.0.1'
+# The controller is considered stuck if a poll cycle has not started for this many seconds
+LIVENESS_TIMEOUT = 120
+
+
+def get_api_port():
+    port = os.environ.get('API_PORT')
+    return int(port) if port else None
+
+
+class ControllerState(object):
+    def __init__(self, alb_id):
+        """
+        What the controller has applied, shared between the control loop and the API threads.
+        Values are replaced as a whole under the lock, readers never see half an update.
+        """
+        self.alb_id = alb_id
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.last_cycle = None
+        self.generation = 0
+        self.applied = None
+        self.config_text = None
+        self.config_json = None
+        self.last_reload = None
+        self.fleet = None
+
+    def cycle(self):
+        self.last_cycle = time.time()
+
+    def record_applied(self, alb_config, config_text, method):
+        """
+        Records a configuration haproxy is now running with.
+
+        :param method: reload, or runtime if it was applied through the runtime API.
+        """
+        fleet_generation = (self.fleet.generation or {}).get('generation') if self.fleet is not None else None
+        config_json = json.dumps(config_to_dict(alb_config), sort_keys=True).encode('utf8')
+        config_text = config_text.encode('utf8')
+        with self.lock:
+            self.generation += 1
+            self.config_text = config_text
+            self.config_json = config_json
+            self.applied = {
+                'generation': self.generation,
+                'fleet_generation': fleet_generation,
+                'config_hash': hashlib.sha256(config_text).hexdigest(),
+                'effective_hash': hashlib.sha256(config_json).hexdigest(),
+                'method': method,
+                'time': time.time(),
+                'listeners': len(alb_config.listeners_map),
+                'target_groups': len(alb_config.target_groups_map),
+            }
+
+    def record_reload(self, ok, stage, returncode=None, seconds=None):
+        """
+        :param stage: configtest or reload, the step which decided the result.
+        """
+        with self.lock:
+            self.last_reload = {
+                'ok': ok,
+                'stage': stage,
+                'returncode': returncode,
+                'seconds': round(seconds, 3) if seconds is not None else None,
+                'time': time.time(),
+            }
+
+    @property
+    def is_live(self):
+        last_cycle = self.last_cycle or self.started
+        return time.time() - last_cycle < LIVENESS_TIMEOUT
+
+    @property
+    def is_ready(self):
+        with self.lock:
+            return self.applied is not None and (self.last_reload is None or self.last_reload['ok'])
+
+    def status(self):
+        with self.lock:
+            status = {
+                'alb': self.alb_id,
+                'started': self.started,
+                'last_cycle': self.last_cycle,
+                'applied': self.applied,
+                'last_reload': self.last_reload,
+            }
+        fleet = self.fleet
+        if fleet is not None:
+            status['fleet'] = {
+                'node': fleet.election.node,
+                'leader': fleet.is_leader,
+                'generation': (fleet.generation or {}).get('generation'),
+            }
+        return status
+
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    return any(tag.strip() in (etag, '*', 'W/' + etag) for tag in header.split(','))
+
+
+class ControlHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Local status API of the controller:
+
+    /healthz      200 while the control loop is running
+    /readyz       200 once a configuration is applied and the last reload succeeded
+    /status       applied generation, hashes, last reload result and fleet role
+    /config       effective configuration as JSON
+    /haproxy.cfg  rendered haproxy configuration
+
+    Responses carry an ETag, /config and /haproxy.cfg use the hash of the applied configuration so
+    a request with a matching If-None-Match is answered with 304 without building a body.
+    """
+    def do_GET(self):
+        state = self.server.state  # type: ControllerState
+        path = self.path.split('?', 1)[0]
+        if path == '/healthz':
+            self.send_body(200 if state.is_live else 503, b'ok\n' if state.is_live else b'stuck\n')
+        elif path == '/readyz':
+            self.send_body(200 if state.is_ready else 503, b'ready\n' if state.is_ready else b'not ready\n')
+        elif path == '/status':
+            body = json.dumps(state.status(), sort_keys=True).encode('utf8')
+            self.send_cached(body, 'W/"{}"'.format(hashlib.sha256(body).hexdigest()[:32]), 'application/json')
+        elif path in ('/config', '/haproxy.cfg'):
+            with state.lock:
+                applied = state.applied
+                body = state.config_json if path == '/config' else state.config_text
+            if applied is None:
+                self.send_body(503, b'no configuration applied\n')
+                return
+            etag = '"{}"'.format(applied['effective_hash'] if path == '/config' else applied['config_hash'])
+            self.send_cached(body, etag, 'application/json' if path == '/config' else 'text/plain; charset=utf-8')
+        else:
+            self.send_error(404)
+
+    def send_cached(self, body, etag, content_type):
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_body(200, body, content_type=content_type, etag=etag)
+
+    def send_body(self, code, body, content_type='text/plain; charset=utf-8', etag=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("control api: " + format, *args)
+
+
+def start_control_server(state: ControllerState, port, address=DEFAULT_API_ADDRESS):
+    """
+    Serves the status API from a background thread, by default only on the loopback interface.
+    """
+    server = http.server.ThreadingHTTPServer((address, int(port)), ControlHandler)
+    server.state = state
+    thread = threading.Thread(target=server.serve_forever, name='control-api', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import logging
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+
+import etcd
+
+from .register import etcd_client, WriteBatch, StateMirror, register_vhost_config, unregister_vhost_config, \
+    parse_targets, unregister_targets, undrain_targets, normalize_seconds, DEFAULT_DRAIN_TIMEOUT
+from .shards import pool_albs
+from .utils import HostResolver
+
+logger = logging.getLogger('docker-alb')
+
+MAX_BATCH = 500
+BATCH_WINDOW = 0.01
+REFRESH_INTERVAL = 60.0
+
+
+class RegistrationRequest(object):
+    def __init__(self, data: dict, reply):
+        """
+        A queued registration request.
+
+        :param data: Decoded JSON request.
+        :param reply: Function called with the response dictionary once the request is done.
+        """
+        self.data = data
+        self.reply = reply
+
+
+class RegistrationDaemon(object):
+    def __init__(self, client: etcd.Client, alb='vhost', max_batch=MAX_BATCH, batch_window=BATCH_WINDOW,
+                 refresh_interval=REFRESH_INTERVAL, dockerhost_ip=None):
+        """
+        Processes registration requests in batches using a warm etcd connection and an in-memory
+        mirror of the registration state.
+
+        :param client: etcd client to write to.
+        :param alb: Default ALB identifier for requests.
+        :param max_batch: Max number of requests applied in one batch.
+        :param batch_window: Seconds to wait for more requests before applying a batch.
+        :param refresh_interval: Seconds between reloading the mirror from etcd, catches writes made by others.
+        :param dockerhost_ip: IP to use for the special target host dockerhost.
+        """
+        self.client = client
+        self.alb = alb
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.refresh_interval = refresh_interval
+        self.dockerhost_ip = dockerhost_ip
+        self.resolver = HostResolver()
+        self.requests = queue.Queue()
+        self.mirror = StateMirror(client, ['/alb/' + alb, '/target_group'])
+        self.handled = 0
+        self.batches = 0
+
+    def load_mirror(self):
+        """
+        Loads the mirror from etcd. A sharded pool places each virtual-host on one of its ALBs, so
+        all ALBs of the pool are mirrored, the shards are looked up again on every load.
+        """
+        self.mirror = StateMirror(self.client, ['/alb/' + pool_alb for pool_alb in pool_albs(self.client, self.alb)] +
+                                  ['/target_group'])
+        self.mirror.load()
+
+    def submit(self, data: dict, reply):
+        self.requests.put(RegistrationRequest(data, reply))
+
+    def queue_request(self, batch: WriteBatch, data: dict):
+        """
+        Adds the mutations for a single request to batch.
+
+        :raises ValueError: If the request is invalid.
+        """
+        op = data.get('op', 'register-vhost')
+        domains = data.get('domains')
+        if isinstance(domains, str):
+            domains = domains.split(',')
+        if not domains:
+            raise ValueError("Request is missing domains")
+        alb = data.get('alb') or self.alb
+        if alb != self.alb:
+            raise ValueError("Daemon only handles ALB '{}'".format(self.alb))
+        identifier = data.get('id') or ('vhost-' + domains[0])
+        port_mode = str(data.get('port') or 'https')
+
+        if op == 'register-vhost':
+            targets = data.get('targets') or []
+            if isinstance(targets, list):
+                targets = ','.join(targets)
+            targets, removed_targets = parse_targets(targets, dockerhost_ip=self.dockerhost_ip,
+                                                     resolve=self.resolver) if targets else ([], [])
+            certificate_name = data.get('certificate_name') or identifier
+            register_vhost_config(batch, alb=alb, identifier=identifier, domains=domains, port_mode=port_mode,
+                                  targets=targets, removed_targets=removed_targets,
+                                  certificate_name=certificate_name, use_certbot=bool(data.get('certbot')),
+                                  limits=data.get('limits'), capacity=data.get('capacity'),
+                                  slowstart=data.get('slowstart'),
+                                  drain_timeout=data.get('drain_timeout', DEFAULT_DRAIN_TIMEOUT))
+        elif op in ('drain', 'undrain'):
+            targets = data.get('targets') or []
+            if isinstance(targets, list):
+                targets = ','.join(targets)
+            if not targets:
+                raise ValueError("Request is missing targets")
+            targets, removed_targets = parse_targets(targets, dockerhost_ip=self.dockerhost_ip,
+                                                     resolve=self.resolver)
+            if op == 'drain':
+                unregister_targets(batch, identifier, targets + removed_targets,
+                                   drain_timeout=normalize_seconds(data.get('drain_timeout', DEFAULT_DRAIN_TIMEOUT),
+                                                                   'Drain timeout'))
+            else:
+                undrain_targets(batch, identifier, targets + removed_targets)
+        elif op == 'unregister-vhost':
+            unregister_vhost_config(batch, alb=alb, identifier=identifier, domains=domains, port_mode=port_mode)
+        else:
+            raise ValueError("Unknown operation '{}'".format(op))
+
+    def next_batch(self):
+        """
+        Waits for a request and collects any other requests queued within the batch window.
+        """
+        pending = [self.requests.get()]
+        deadline = time.time() + self.batch_window
+        while len(pending) < self.max_batch:
+            try:
+                pending.append(self.requests.get(timeout=max(0.0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return pending
+
+    def process(self, pending):
+        """
+        Applies a list of requests as a single batch and replies to each of them.
+        """
+        if self.mirror.loaded is None or time.time() - self.mirror.loaded > self.refresh_interval:
+            self.load_mirror()
+
+        batch = WriteBatch(self.client, mirror=self.mirror)
+        accepted = []
+        for request in pending:
+            try:
+                self.queue_request(batch, request.data)
+                accepted.append(request)
+            except (ValueError, OSError) as e:
+                request.reply({'ref': request.data.get('ref'), 'ok': False, 'error': str(e)})
+
+        try:
+            mutations = batch.apply()
+        except etcd.EtcdException as e:
+            logger.error("Failed to apply batch of %d requests: %s", len(accepted), e)
+            # State may be partially written, start over from etcd on the next batch
+            self.mirror.loaded = None
+            for request in accepted:
+                request.reply({'ref': request.data.get('ref'), 'ok': False, 'error': str(e)})
+            return
+
+        self.handled += len(pending)
+        self.batches += 1
+        for request in accepted:
+            request.reply({'ref': request.data.get('ref'), 'ok': True, 'batch_size': len(accepted),
+                           'mutations': mutations})
+
+    def run(self):
+        while True:
+            self.process(self.next_batch())
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='registration-daemon', daemon=True)
+        thread.start()
+        return thread
+
+
+def read_requests(daemon: RegistrationDaemon, reader, writer):
+    """
+    Reads NDJSON requests from reader and writes NDJSON responses to writer. Requests are
+    pipelined, responses are written as their batch completes and carry the 'ref' of the request.
+    Returns once reader is exhausted and all responses are written.
+    """
+    lock = threading.Lock()
+    outstanding = [0]
+    done = threading.Condition(lock)
+
+    def reply(response):
+        line = json.dumps(response) + "\n"
+        with lock:
+            writer.write(line if isinstance(writer, io.TextIOBase) else line.encode('utf8'))
+            writer.flush()
+            outstanding[0] -= 1
+            done.notify_all()
+
+    for line in reader:
+        if isinstance(line, bytes):
+            line = line.decode('utf8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+            if not isinstance(data, dict):
+                raise ValueError("Request must be a JSON object")
+        except ValueError as e:
+            with lock:
+                outstanding[0] += 1
+            reply({'ok': False, 'error': "Invalid request: {}".format(e)})
+            continue
+        with lock:
+            outstanding[0] += 1
+        daemon.submit(data, reply)
+
+    with lock:
+        done.wait_for(lambda: outstanding[0] == 0)
+
+
+class RegistrationHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        read_requests(self.server.registration_daemon, self.rfile, self.wfile)
+
+
+class RegistrationServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, daemon: RegistrationDaemon):
+        self.registration_daemon = daemon
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, RegistrationHandler)
+
+
+def run_daemon(args):
+    """
+    Runs the registration daemon, reads requests from a unix socket or from stdin.
+    """
+    client = etcd_client(args.etcd_host)
+    daemon = RegistrationDaemon(client, alb=args.alb_id, max_batch=args.max_batch,
+                                batch_window=args.batch_window / 1000.0,
+                                dockerhost_ip=os.environ.get("DOCKERHOST_IP"))
+    daemon.load_mirror()
+    daemon.start()
+    if args.socket:
+        server = RegistrationServer(args.socket, daemon)
+        if args.verbosity >= 1:
+            logger.info("Listening for registrations on %s", args.socket)
+        server.serve_forever()
+    else:
+        read_requests(daemon, sys.stdin, sys.stdout)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sys
+
+from .manager import get_alb
+from .services import LoadBalancerConfig, Listener, Rule, TargetGroup, Target, HealthCheck, Certificate, \
+    TrafficLimits, Capacity, NoListeners, NoTargetGroups
+from .snapshot import write_snapshot, read_snapshot, get_running_snapshot_path, SnapshotError
+from .utils import ConfigurationError
+
+# Kinds of configuration items a change can refer to
+KINDS = ('listener', 'rule', 'certificate', 'limits', 'target_group', 'health_check', 'capacity', 'target')
+
+
+class Change(object):
+    __slots__ = ('kind', 'action', 'identifier', 'old', 'new', 'runtime')
+
+    def __init__(self, kind: str, action: str, identifier: str, old=None, new=None, runtime=False):
+        """
+        A single difference between two ALB configurations.
+
+        :param kind: One of listener, rule, certificate, limits, target_group, health_check, capacity or target.
+        :param action: One of add, remove or change.
+        :param identifier: Path to the item, e.g. <target group>/<host:port> for a target.
+        :param old: Old value or None if added.
+        :param new: New value or None if removed.
+        :param runtime: True if the change can be applied through the haproxy runtime API,
+                        False if it needs a reload.
+        """
+        self.kind = kind
+        self.action = action
+        self.identifier = identifier
+        self.old = old
+        self.new = new
+        self.runtime = runtime
+
+    def __repr__(self):
+        return "Change({!r},{!r},{!r},runtime={!r})".format(self.kind, self.action, self.identifier, self.runtime)
+
+    def as_dict(self):
+        return {
+            'kind': self.kind,
+            'action': self.action,
+            'identifier': self.identifier,
+            'old': describe(self.old),
+            'new': describe(self.new),
+            'runtime': self.runtime,
+        }
+
+
+def describe(value):
+    """
+    Short JSON compatible description of a configuration value.
+    """
+    if isinstance(value, Listener):
+        return {'port': value.port, 'protocol': value.protocol, 'certificate_name': value.certificate_name,
+                'rules': len(value.rules)}
+    if isinstance(value, Rule):
+        return {'host': value.host, 'path': value.path, 'action': value.action, 'pri': value.pri}
+    if isinstance(value, TargetGroup):
+        return {'protocol': value.protocol, 'targets': len(value.targets)}
+    if isinstance(value, Target):
+        description = target_name(value)
+        if value.maxconn or value.maxqueue:
+            description += " maxconn={} maxqueue={}".format(value.maxconn, value.maxqueue)
+        if value.draining:
+            description += " draining"
+        return description
+    if isinstance(value, Capacity):
+        return {name: getattr(value, name) for name in Capacity._fields}
+    if isinstance(value, HealthCheck):
+        return {name: getattr(value, name) for name in HealthCheck._fields}
+    if isinstance(value, TrafficLimits):
+        return {name: getattr(value, name) for name in ('rate', 'conn', 'maxconn', 'action')}
+    if isinstance(value, Certificate):
+        return {'domains': value.domains, 'is_valid': value.is_valid,
+                'modified': value.modified.isoformat() if value.modified else None}
+    return value
+
+
+def diff_configs(old: LoadBalancerConfig, new: LoadBalancerConfig):
+    """
+    Compares two loads of an ALB.
+
+    Unchanged listeners and target groups are skipped when they compare equal, only the items that changed
+    are walked.
+
+    :return: List of Change, listeners first then target groups, each sorted on identifier.
+    """
+    return diff_listeners(old.listeners_map or {}, new.listeners_map or {}) + \
+        diff_target_groups(old.target_groups_map or {}, new.target_groups_map or {})
+
+
+def diff_listeners(old_listeners: dict, new_listeners: dict):
+    """
+    Compares listener maps, including their rules and certificates. All listener changes need a reload.
+    """
+    changes = []
+    for identifier in sorted(set(old_listeners) | set(new_listeners)):
+        old = old_listeners.get(identifier)
+        new = new_listeners.get(identifier)
+        if old is None:
+            changes.append(Change('listener', 'add', identifier, new=new))
+            continue
+        if new is None:
+            changes.append(Change('listener', 'remove', identifier, old=old))
+            continue
+        if old == new:
+            continue
+        if old.port != new.port or old.protocol != new.protocol or old.certificate_name != new.certificate_name:
+            changes.append(Change('listener', 'change', identifier, old=old, new=new))
+        if old.certificate != new.certificate:
+            action = 'add' if old.certificate is None else 'remove' if new.certificate is None else 'change'
+            changes.append(Change('certificate', action, identifier, old=old.certificate, new=new.certificate))
+        if old.limits != new.limits:
+            action = 'add' if old.limits is None else 'remove' if new.limits is None else 'change'
+            changes.append(Change('limits', action, identifier, old=old.limits, new=new.limits))
+        if old.rules != new.rules:
+            changes.extend(diff_rules(identifier, old.rules, new.rules))
+    return changes
+
+
+def rule_key(rule):
+    return rule.host or '', rule.path or ''
+
+
+def diff_rules(listener_id, old_rules, new_rules):
+    """
+    Compares the rules of a listener, rules are matched on host and path.
+    The same rules in a different order are reported as a single change.
+    """
+    changes = []
+    old_by_key = {}
+    for rule in old_rules:
+        old_by_key.setdefault(rule_key(rule), []).append(rule)
+    new_by_key = {}
+    for rule in new_rules:
+        new_by_key.setdefault(rule_key(rule), []).append(rule)
+
+    for key in sorted(set(old_by_key) | set(new_by_key)):
+        old = old_by_key.get(key, [])
+        new = new_by_key.get(key, [])
+        if old == new:
+            continue
+        host, path = key
+        identifier = "{}/{}{}".format(listener_id, host or '*', '/' + path.lstrip('/') if path else '')
+        unmatched = list(new)
+        removed = []
+        for rule in old:
+            if rule in unmatched:
+                unmatched.remove(rule)
+            else:
+                removed.append(rule)
+        for old_rule, new_rule in zip(removed, unmatched):
+            changes.append(Change('rule', 'change', identifier, old=old_rule, new=new_rule))
+        for old_rule in removed[len(unmatched):]:
+            changes.append(Change('rule', 'remove', identifier, old=old_rule))
+        for new_rule in unmatched[len(removed):]:
+            changes.append(Change('rule', 'add', identifier, new=new_rule))
+
+    if not changes and old_rules != new_rules:
+        # Same rules in a different order, first match wins so this changes routing
+        changes.append(Change('rule', 'change', listener_id + '/*order*'))
+    return changes
+
+
+def diff_target_groups(old_groups: dict, new_groups: dict):
+    """
+    Compares target group maps including targets, health checks and capacity.
+    Removed targets can be disabled and targets drained through the runtime API, everything else needs a reload.
+    """
+    changes = []
+    for identifier in sorted(set(old_groups) | set(new_groups)):
+        old = old_groups.get(identifier)
+        new = new_groups.get(identifier)
+        if old is None:
+            changes.append(Change('target_group', 'add', identifier, new=new))
+            continue
+        if new is None:
+            changes.append(Change('target_group', 'remove', identifier, old=old))
+            continue
+        if old == new:
+            continue
+        if old.protocol != new.protocol or old.slowstart != new.slowstart:
+            changes.append(Change('target_group', 'change', identifier, old=old, new=new))
+        if old.health_check != new.health_check:
+            changes.append(Change('health_check', 'change', identifier, old=old.health_check,
+                                  new=new.health_check))
+        if old.capacity != new.capacity:
+            action = 'add' if old.capacity is None else 'remove' if new.capacity is None else 'change'
+            changes.append(Change('capacity', action, identifier, old=old.capacity, new=new.capacity))
+        if old.targets != new.targets:
+            # Targets are matched on host and port, the server name in haproxy
+            old_targets = {target_name(target): target for target in old.targets}
+            new_targets = {target_name(target): target for target in new.targets}
+            for name in sorted(set(old_targets) - set(new_targets)):
+                changes.append(Change('target', 'remove', identifier + '/' + name, old=old_targets[name],
+                                      runtime=True))
+            for name in sorted(set(new_targets) - set(old_targets)):
+                changes.append(Change('target', 'add', identifier + '/' + name, new=new_targets[name]))
+            for name in sorted(set(old_targets) & set(new_targets)):
+                old_target = old_targets[name]
+                new_target = new_targets[name]
+                if old_target != new_target:
+                    # Only starting or ending a drain is a weight and state change in haproxy
+                    changes.append(Change('target', 'change', identifier + '/' + name, old=old_target,
+                                          new=new_target,
+                                          runtime=old_target.replace(draining=new_target.draining) == new_target))
+    return changes
+
+
+def target_name(target):
+    return "{}:{}".format(target.host, target.port)
+
+
+def needs_reload(changes):
+    return any(not change.runtime for change in changes)
+
+
+def format_changes(changes):
+    """
+    Formats changes for display, one line per change prefixed with +, - or ~.
+    """
+    lines = []
+    for change in changes:
+        sign = {'add': '+', 'remove': '-'}.get(change.action, '~')
+        lines.append("{} {} {} [{}]".format(sign, change.kind, change.identifier,
+                                            'runtime' if change.runtime else 'reload'))
+    return "\n".join(lines)
+
+
+def write_changes(changes, stream=sys.stdout, output_format='text'):
+    if output_format == 'json':
+        json.dump({
+            'changes': [change.as_dict() for change in changes],
+            'reload': needs_reload(changes),
+        }, stream, indent=1, sort_keys=True, default=str)
+        stream.write("\n")
+        return
+    if changes:
+        stream.write(format_changes(changes) + "\n")
+        runtime = sum(1 for change in changes if change.runtime)
+        stream.write("{} changes, {} runtime, {} need reload\n".format(len(changes), runtime,
+                                                                       len(changes) - runtime))
+    else:
+        stream.write("No changes\n")
+
+
+def cli_diff_alb(args):
+    verbosity = args.verbosity
+    alb_id = os.environ.get('ALB_ID', args.alb_id)
+
+    try:
+        alb_config = get_alb(alb_id, with_listener_group=True)
+    except (NoListeners, NoTargetGroups):
+        alb_config = LoadBalancerConfig(alb_id, listeners={}, target_groups={})
+    except ConfigurationError as e:
+        if verbosity >= 0:
+            print("Etcd host is not defined: ", e, file=sys.stderr)
+        sys.exit(1)
+
+    if args.save:
+        write_snapshot(alb_config, args.save)
+        return
+
+    snapshot = args.snapshot or get_running_snapshot_path()
+    try:
+        running_config = read_snapshot(snapshot)
+    except SnapshotError as e:
+        if verbosity >= 0:
+            print(e, file=sys.stderr)
+        sys.exit(2)
+
+    changes = diff_configs(running_config, alb_config)
+    write_changes(changes, sys.stdout, output_format=args.format)
+    if args.exit_code and changes:
+        sys.exit(1)
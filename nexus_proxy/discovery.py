@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import runpy
+import socket
+import sys
+
+import etcd
+
+from .register import etcd_client, WriteBatch, register_vhost_config, unregister_vhost_config, \
+    unregister_targets, register_target_group, has_other_targets, normalize_port_mode, normalize_limits, \
+    normalize_capacity, normalize_seconds, CAPACITY_NAMES, TARGET_CAPACITY_NAMES, DEFAULT_DRAIN_TIMEOUT
+from .timing import span
+
+logger = logging.getLogger('docker-alb')
+
+DEFAULT_MANIFEST = '/tmp/etcd_config.py'
+
+
+class ManifestChange(object):
+    def __init__(self, action: str, identifier: str, old: dict = None, new: dict = None):
+        """
+        A change to a single virtual-host between two docker-gen manifests.
+
+        :param action: One of add, remove, change or targets.
+        :param identifier: Identifier of virtual-host, used for target group and listener group.
+        :param old: Previous virtual-host spec or None if added.
+        :param new: New virtual-host spec or None if removed.
+        """
+        self.action = action
+        self.identifier = identifier
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return "ManifestChange({!r},{!r})".format(self.action, self.identifier)
+
+    @property
+    def added_targets(self):
+        """
+        Targets which are new or have new capacity overrides.
+        """
+        old_targets = (self.old or {}).get('targets', {})
+        return [target for key, target in sorted((self.new or {}).get('targets', {}).items())
+                if old_targets.get(key) != target]
+
+    @property
+    def removed_targets(self):
+        new_targets = set((self.new or {}).get('targets', {}))
+        return [target for key, target in sorted((self.old or {}).get('targets', {}).items())
+                if key not in new_targets]
+
+
+def load_manifest(filename=DEFAULT_MANIFEST):
+    """
+    Loads the services list written by docker-gen.
+    We use a Python file as the config to make it easier with trailing commas.
+    """
+    return runpy.run_path(filename).get('services', [])
+
+
+def normalize_manifest(services, host=None):
+    """
+    Turns docker-gen services in to virtual-host specs keyed on identifier. Containers sharing
+    a target group are merged and targets which are down are left out.
+
+    :param services: List of services from docker-gen.
+    :param host: Override host for each target.
+    :return: Dictionary of identifier to spec, the spec only contains JSON compatible values.
+    """
+    vhosts = {}
+    for service in services:
+        if service.get('mode', 'vhost') != 'vhost' or not service.get('domains'):
+            continue
+        identifier = service['id']
+        cert = service.get('cert') or 'letsencrypt'
+        health = dict(service.get('health') or {})
+        if 'success' in health:
+            health['success'] = [str(success) for success in health['success']]
+        spec = vhosts.setdefault(identifier, {
+            'name': 'VirtualHost: ' + service.get('name', identifier),
+            'domains': list(service['domains']),
+            'port_mode': normalize_port_mode(str(service.get('port_mode') or 'https')),
+            'certificate_name': None if cert == 'letsencrypt' else cert,
+            'use_certbot': cert == 'letsencrypt',
+            'health': health or None,
+            'targets': {},
+        })
+        limits = service_limits(service)
+        if limits:
+            spec['limits'] = limits
+        capacity = service_capacity(service, service.get('capacity'))
+        if capacity:
+            spec['capacity'] = capacity
+        slowstart = service_seconds(service, 'slowstart', 'Slowstart')
+        if slowstart:
+            spec['slowstart'] = slowstart
+        drain_timeout = service_seconds(service, 'drain_timeout', 'Drain timeout')
+        if drain_timeout is not None:
+            spec['drain_timeout'] = drain_timeout
+        for target in service.get('targets', []):
+            if target.get('down') or not target.get('port'):
+                continue
+            target_host = host or target['host']
+            target_port = str(target['port'])
+            target_spec = spec['targets']['{}:{}'.format(target_host, target_port)] = {
+                'host': target_host,
+                'port': target_port,
+            }
+            target_spec.update(service_capacity(service, target, names=TARGET_CAPACITY_NAMES) or {})
+    return vhosts
+
+
+def service_limits(service):
+    """
+    :return: Normalized traffic limits of a docker-gen service, None if unset or invalid.
+    """
+    try:
+        return normalize_limits(service.get('limits'))
+    except ValueError as e:
+        logger.warning("Ignoring traffic limits of %s: %s", service.get('id'), e)
+        return None
+
+
+def service_capacity(service, capacity, names=CAPACITY_NAMES):
+    """
+    :return: Normalized capacity of a docker-gen service or one of its targets, None if unset or invalid.
+    """
+    try:
+        return normalize_capacity(capacity, names=names)
+    except ValueError as e:
+        logger.warning("Ignoring capacity of %s: %s", service.get('id'), e)
+        return None
+
+
+def service_seconds(service, key, name):
+    """
+    :return: Number of seconds for a timing setting of a docker-gen service, None if unset or invalid.
+    """
+    try:
+        return normalize_seconds(service.get(key), name)
+    except ValueError as e:
+        logger.warning("Ignoring %s of %s: %s", key, service.get('id'), e)
+        return None
+
+
+def diff_manifests(old: dict, new: dict):
+    """
+    Compares two normalized manifests.
+
+    :return: List of ManifestChange, sorted on identifier.
+    """
+    changes = []
+    for identifier in sorted(set(old) | set(new)):
+        old_spec = old.get(identifier)
+        new_spec = new.get(identifier)
+        if old_spec == new_spec:
+            continue
+        if old_spec is None:
+            action = 'add'
+        elif new_spec is None:
+            action = 'remove'
+        elif _without_targets(old_spec) == _without_targets(new_spec):
+            action = 'targets'
+        else:
+            action = 'change'
+        changes.append(ManifestChange(action, identifier, old=old_spec, new=new_spec))
+    return changes
+
+
+def _without_targets(spec):
+    return {key: value for key, value in spec.items() if key != 'targets'}
+
+
+def plan_changes(batch: WriteBatch, alb, changes, lease=None):
+    """
+    Queues the mutations for a list of manifest changes in batch.
+
+    :param lease: Name of lease to register targets under, if any.
+    """
+    for change in changes:
+        old, new = change.old, change.new
+        if change.action == 'remove':
+            # Other hosts may still run containers for the virtual-host, only the last one removes it
+            targets = list(old['targets'].values())
+            if has_other_targets(batch.client, change.identifier, targets, lease=lease):
+                unregister_targets(batch, identifier=change.identifier, targets=targets, lease=lease,
+                                   drain_timeout=old.get('drain_timeout', DEFAULT_DRAIN_TIMEOUT))
+            else:
+                unregister_vhost_config(batch, alb=alb, identifier=change.identifier, domains=old['domains'],
+                                        port_mode=old['port_mode'], lease=lease)
+        elif change.action == 'targets':
+            unregister_targets(batch, identifier=change.identifier, targets=change.removed_targets, lease=lease,
+                               drain_timeout=new.get('drain_timeout', DEFAULT_DRAIN_TIMEOUT))
+            register_target_group(batch, identifier=change.identifier, name=new['name'],
+                                  targets=change.added_targets, health_check=new['health'], lease=lease,
+                                  capacity=new.get('capacity'), slowstart=new.get('slowstart'))
+        else:
+            if old and (old['domains'][0] != new['domains'][0] or old['port_mode'] != new['port_mode']):
+                # Listeners are named after the primary domain and port mode, remove the old ones but keep
+                # the target group which other hosts may register targets in
+                unregister_vhost_config(batch, alb=alb, identifier=change.identifier, domains=old['domains'],
+                                        port_mode=old['port_mode'], lease=lease, with_target_group=False)
+            register_vhost_config(batch, alb=alb, identifier=change.identifier, domains=new['domains'],
+                                  port_mode=new['port_mode'], targets=list(new['targets'].values()),
+                                  removed_targets=change.removed_targets, name=new['name'],
+                                  health_check=new['health'], certificate_name=new['certificate_name'],
+                                  use_certbot=new['use_certbot'], lease=lease, limits=new.get('limits'),
+                                  capacity=new.get('capacity'), slowstart=new.get('slowstart'),
+                                  drain_timeout=new.get('drain_timeout', DEFAULT_DRAIN_TIMEOUT))
+
+
+def manifest_key(discovery_id):
+    return '/discovery/{name}/manifest'.format(name=discovery_id)
+
+
+def load_previous_manifest(client: etcd.Client, discovery_id):
+    try:
+        return json.loads(client.get(manifest_key(discovery_id)).value or '{}')
+    except (etcd.EtcdKeyNotFound, ValueError):
+        return {}
+
+
+def reconcile_manifest(client: etcd.Client, alb, discovery_id, manifest, dry_run=False, previous=None,
+                       lease=None):
+    """
+    Reconciles a normalized manifest with the one applied previously by this discovery service.
+    Only added, removed and changed virtual-hosts are written.
+
+    :param previous: Previously applied manifest, if None it is read from etcd.
+    :param lease: Name of lease to register targets under, if any.
+    :return: Tuple of list of ManifestChange and list of planned mutations.
+    """
+    if previous is None:
+        previous = load_previous_manifest(client, discovery_id)
+    changes = diff_manifests(previous, manifest)
+    batch = WriteBatch(client)
+    plan_changes(batch, alb, changes, lease=lease)
+    if changes:
+        batch.write(manifest_key(discovery_id), json.dumps(manifest, sort_keys=True))
+    mutations = batch.plan()
+    if not dry_run:
+        batch.apply(mutations)
+    return changes, mutations
+
+
+def auto_register_docker(args):
+    """
+    Registers the containers found by docker-gen in the ALB configuration.
+    """
+    backend_host = os.environ.get("HOST_IP")
+    discovery_id = os.environ.get("DISCOVERY_ID") or socket.gethostname()
+    client = etcd_client(args.etcd_host)
+
+    with span('load_manifest', manifest=args.manifest):
+        manifest = normalize_manifest(load_manifest(args.manifest), host=backend_host)
+    with span('reconcile_manifest', vhosts=len(manifest), dry_run=args.dry_run):
+        changes, mutations = reconcile_manifest(client, args.alb_id, discovery_id, manifest, dry_run=args.dry_run)
+    if args.dry_run:
+        for change in changes:
+            print("{} {}".format(change.action, change.identifier))
+            for target in change.added_targets:
+                print("  + target {}:{}".format(target['host'], target['port']))
+            for target in change.removed_targets:
+                print("  - target {}:{}".format(target['host'], target['port']))
+        for operation, key, value in mutations:
+            if operation == 'write':
+                print("write {} = {}".format(key, value))
+            else:
+                print("delete {}".format(key))
+    elif args.verbosity >= 1:
+        print("Applied {} changes with {} mutations".format(len(changes), len(mutations)), file=sys.stderr)
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+import http.client
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from urllib.parse import quote
+
+from .discovery import normalize_manifest, reconcile_manifest, load_previous_manifest
+from .register import etcd_client, keep_lease_alive
+
+logger = logging.getLogger('docker-alb')
+
+DEFAULT_DOCKER_SOCKET = '/var/run/docker.sock'
+VIRTUAL_HOST_LABEL = 'com.proxy.virtual_host'
+# Labels which override the capacity of the target group for a single container
+TARGET_MAXCONN_LABEL = 'com.proxy.target.maxconn'
+TARGET_MAXQUEUE_LABEL = 'com.proxy.target.maxqueue'
+# Container events which may change the targets of a virtual-host
+CONTAINER_EVENTS = ('start', 'restart', 'unpause', 'pause', 'die', 'stop', 'kill', 'destroy', 'health_status')
+DEBOUNCE_TIMEOUT = 0.5
+# Longest time events are collected before reconciling, a steady stream (e.g. a crash-looping
+# container) would otherwise hold back all changes
+MAX_BURST_SECONDS = 5.0
+RECONNECT_TIMEOUT = 5.0
+
+
+class DockerError(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a unix domain socket.
+    """
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerClient(object):
+    def __init__(self, socket_path=None, timeout=30):
+        """
+        Minimal client for the Docker Engine API.
+
+        :param socket_path: Path to docker socket, defaults to DOCKER_HOST or /var/run/docker.sock.
+        :param timeout: Timeout in seconds for regular requests, event streams have no timeout.
+        """
+        if socket_path is None:
+            docker_host = os.environ.get('DOCKER_HOST', '')
+            socket_path = docker_host[len('unix://'):] if docker_host.startswith('unix://') \
+                else DEFAULT_DOCKER_SOCKET
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, path, timeout=None):
+        """
+        Sends a GET request and returns the open response.
+        """
+        conn = UnixHTTPConnection(self.socket_path, timeout=timeout)
+        conn.request('GET', path)
+        response = conn.getresponse()
+        if response.status >= 400:
+            body = response.read().decode('utf8', 'replace')
+            conn.close()
+            raise DockerError("Docker API {} returned {}: {}".format(path, response.status, body.strip()))
+        return response
+
+    def get_json(self, path):
+        response = self.request(path, timeout=self.timeout)
+        try:
+            return json.loads(response.read().decode('utf8'))
+        finally:
+            response.close()
+
+    def containers(self, label=VIRTUAL_HOST_LABEL):
+        """
+        Lists running containers with the given label.
+        """
+        filters = json.dumps({'label': [label]})
+        return self.get_json('/containers/json?filters=' + quote(filters))
+
+    def inspect(self, container_id):
+        """
+        Returns details for a container or None if it no longer exists.
+        """
+        try:
+            return self.get_json('/containers/{}/json'.format(quote(container_id)))
+        except DockerError as e:
+            if ' 404: ' in str(e):
+                return None
+            raise
+
+    def events(self, since=None):
+        """
+        Streams container events, yields one dictionary per event until the connection is closed.
+        """
+        filters = json.dumps({'type': ['container'], 'event': list(CONTAINER_EVENTS)})
+        path = '/events?filters=' + quote(filters)
+        if since is not None:
+            path += '&since={}'.format(int(since))
+        response = self.request(path)
+        try:
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line.decode('utf8'))
+                except ValueError:
+                    logger.warning("Invalid docker event: %r", line)
+        finally:
+            response.close()
+
+
+def get_int_env(env, name, default):
+    try:
+        return int(env.get(name) or default)
+    except ValueError:
+        logger.warning("Expected integer value for %s: %s", name, env.get(name))
+        return default
+
+
+def container_service(container, networks=None, host=None):
+    """
+    Creates a docker-gen style service entry from container details, uses the same environment
+    variables as config/docker_gen/etcd_config.tmpl.
+
+    :param container: Container details as returned by inspect.
+    :param networks: Names of networks reachable by the ALB or None to allow all networks.
+    :param host: Override host for the target, the published port is then used.
+    :return: Service dictionary or None if the container does not expose a virtual-host.
+    """
+    config = container.get('Config') or {}
+    labels = config.get('Labels') or {}
+    env = dict(item.split('=', 1) for item in (config.get('Env') or []) if '=' in item)
+    if VIRTUAL_HOST_LABEL not in labels or not env.get('VIRTUAL_HOST'):
+        return None
+
+    domains = [domain for domain in env['VIRTUAL_HOST'].split(',') if domain]
+    host_group = env.get('TARGET_GROUP') or domains[0]
+    service = {
+        'id': 'vhost-' + host_group,
+        'name': host_group,
+        'mode': 'vhost',
+        'domains': domains,
+        'port_mode': env.get('VIRTUAL_PORT') or 'https',
+        'cert': env.get('CERTIFICATE') or 'letsencrypt',
+        'health': {
+            'protocol': 'http',
+            'path': env.get('HEALTHCHECK_PATH') or '/',
+            'port': env.get('HEALTHCHECK_PORT') or 'traffic',
+            'healthy': get_int_env(env, 'HEALTHCHECK_HEALTHY', 2),
+            'unhealthy': get_int_env(env, 'HEALTHCHECK_UNHEALTHY', 10),
+            'timeout': get_int_env(env, 'HEALTHCHECK_TIMEOUT', 4),
+            'interval': get_int_env(env, 'HEALTHCHECK_INTERVAL', 5),
+            'success': (env.get('HEALTHCHECK_SUCCESS') or '200').split(','),
+        },
+        'limits': {
+            'rate': env.get('RATE_LIMIT'),
+            'conn': env.get('CONN_LIMIT'),
+            'maxconn': env.get('MAX_CONNECTIONS'),
+            'action': env.get('LIMIT_ACTION'),
+        },
+        'capacity': {
+            'maxconn': env.get('TARGET_MAXCONN'),
+            'maxqueue': env.get('TARGET_MAXQUEUE'),
+            'queue_timeout': env.get('QUEUE_TIMEOUT'),
+        },
+        'slowstart': env.get('SLOWSTART'),
+        'drain_timeout': env.get('DRAIN_TIMEOUT'),
+        'targets': [],
+    }
+
+    state = container.get('State') or {}
+    health_status = (state.get('Health') or {}).get('Status')
+    if not state.get('Running') or state.get('Paused') or health_status == 'unhealthy':
+        return service
+
+    # If only one port is exposed use it, otherwise the one matching VIRTUAL_PORT falling back to port 80
+    network_settings = container.get('NetworkSettings') or {}
+    ports = network_settings.get('Ports') or {}
+    tcp_ports = sorted(int(port.split('/')[0]) for port in ports if port.endswith('/tcp'))
+    if len(tcp_ports) == 1:
+        port = tcp_ports[0]
+    else:
+        port = get_int_env(env, 'VIRTUAL_PORT', 80)
+    bindings = ports.get('{}/tcp'.format(port)) or []
+
+    name = container.get('Name', '').lstrip('/')
+    overrides = {'maxconn': labels.get(TARGET_MAXCONN_LABEL), 'maxqueue': labels.get(TARGET_MAXQUEUE_LABEL)}
+    if host:
+        if bindings and bindings[0].get('HostPort'):
+            service['targets'].append(dict(overrides, name=name, host=host, port=int(bindings[0]['HostPort'])))
+        return service
+    for network_name, network in sorted((network_settings.get('Networks') or {}).items()):
+        if networks is not None and network_name not in networks:
+            continue
+        if network.get('IPAddress'):
+            service['targets'].append(dict(overrides, name=name, host=network['IPAddress'], port=port))
+            break
+    return service
+
+
+class DockerWatcher(object):
+    def __init__(self, docker: DockerClient, client, alb, discovery_id, host=None, dry_run=False, ttl=None):
+        """
+        Keeps the ALB configuration in sync with running containers by following docker events.
+
+        :param docker: Client for the docker engine.
+        :param client: etcd client to write configuration to.
+        :param alb: Identifier of the ALB to register in.
+        :param discovery_id: Name of this discovery service, previous state is stored under it.
+        :param host: Override host for targets, e.g. the public ip of the docker host.
+        :param dry_run: If True then changes are only logged.
+        :param ttl: If set then targets are registered under a lease named after discovery_id which
+                    expires after ttl seconds, the lease is refreshed while watching.
+        """
+        self.docker = docker
+        self.client = client
+        self.alb = alb
+        self.discovery_id = discovery_id
+        self.host = host
+        self.dry_run = dry_run
+        self.ttl = ttl
+        self.lease = discovery_id if ttl else None
+        # Monotonic time the lease was last refreshed
+        self.refreshed = None
+        self.services = {}  # type: Dict[str, dict]
+        self.networks = None
+        self.manifest = None
+
+    def find_networks(self):
+        """
+        Returns the networks of the container this process runs in, or None if not running in docker.
+        """
+        own = self.docker.inspect(socket.gethostname())
+        if own is None:
+            return None
+        return set(((own.get('NetworkSettings') or {}).get('Networks') or {}).keys())
+
+    def update_container(self, container_id):
+        container = self.docker.inspect(container_id)
+        service = container_service(container, networks=self.networks, host=self.host) if container else None
+        if service is None:
+            self.services.pop(container_id, None)
+        else:
+            self.services[container_id] = service
+
+    def sync(self):
+        """
+        Reads all containers and reconciles them with the stored configuration.
+        """
+        self.networks = self.find_networks()
+        self.services = {}
+        for container in self.docker.containers():
+            self.update_container(container['Id'])
+        self.manifest = load_previous_manifest(self.client, self.discovery_id)
+        if not self.keep_alive():
+            # Leased targets are gone, register everything again
+            self.manifest = {}
+        self.reconcile()
+
+    def keep_alive(self):
+        """
+        Refreshes the lease.
+
+        :return: False if the lease had expired and was created again.
+        """
+        if not self.lease or self.dry_run:
+            return True
+        alive = keep_lease_alive(self.client, self.lease, ttl=self.ttl)
+        self.refreshed = time.monotonic()
+        return alive
+
+    def lease_timeout(self):
+        """
+        :return: Seconds until the lease must be refreshed, None if there is no lease.
+        """
+        if not self.lease:
+            return None
+        return max(0.0, (self.refreshed or 0.0) + self.ttl / 3.0 - time.monotonic())
+
+    def refresh_lease(self):
+        """
+        Refreshes the lease once a third of its TTL has passed since the last refresh, no matter how
+        busy the event stream is. If it had expired all targets are registered again.
+        """
+        if self.lease_timeout():
+            return
+        if not self.keep_alive():
+            logger.warning("Lease %s expired, registering all targets again", self.lease)
+            self.manifest = {}
+            self.reconcile()
+
+    def reconcile(self):
+        manifest = normalize_manifest([self.services[key] for key in sorted(self.services)])
+        changes, mutations = reconcile_manifest(self.client, self.alb, self.discovery_id, manifest,
+                                                dry_run=self.dry_run, previous=self.manifest, lease=self.lease)
+        for change in changes:
+            logger.info("docker: %s %s, +%d/-%d targets", change.action, change.identifier,
+                        len(change.added_targets), len(change.removed_targets))
+        if not self.dry_run:
+            self.manifest = manifest
+        return changes
+
+    def handle_event(self, event):
+        """
+        Updates the known containers from a docker event.
+
+        :return: True if the event may have changed the configuration.
+        """
+        container_id = event.get('id') or (event.get('Actor') or {}).get('ID')
+        if not container_id:
+            return False
+        attributes = (event.get('Actor') or {}).get('Attributes') or {}
+        if container_id not in self.services and VIRTUAL_HOST_LABEL not in attributes:
+            return False
+        action = event.get('status') or event.get('Action') or ''
+        logger.debug("docker event: %s %s", action, container_id[:12])
+        if action == 'destroy':
+            self.services.pop(container_id, None)
+        else:
+            self.update_container(container_id)
+        return True
+
+    def read_events(self, events: queue.Queue, since):
+        try:
+            for event in self.docker.events(since=since):
+                events.put(event)
+        except (OSError, http.client.HTTPException, DockerError) as e:
+            logger.warning("Docker event stream failed: %s", e)
+        events.put(None)
+
+    def watch(self, max_events=None):
+        """
+        Follows the docker event stream and reconciles after each burst of events.
+        On disconnect it resyncs all containers and reconnects.
+
+        :param max_events: Stop after this many events, None to run forever.
+        """
+        handled = 0
+        while max_events is None or handled < max_events:
+            since = time.time()
+            self.sync()
+            events = queue.Queue()
+            reader = threading.Thread(target=self.read_events, args=(events, since), name='docker-events',
+                                      daemon=True)
+            reader.start()
+            connected = True
+            while connected and (max_events is None or handled < max_events):
+                try:
+                    event = events.get(timeout=self.lease_timeout())
+                except queue.Empty:
+                    self.refresh_lease()
+                    continue
+                changed = False
+                # Collect events that arrive close together and reconcile once, at most MAX_BURST_SECONDS apart
+                burst_end = time.monotonic() + MAX_BURST_SECONDS
+                while event is not None:
+                    handled += 1
+                    changed = self.handle_event(event) or changed
+                    if max_events is not None and handled >= max_events:
+                        break
+                    remaining = burst_end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        event = events.get(timeout=min(DEBOUNCE_TIMEOUT, remaining))
+                    except queue.Empty:
+                        break
+                if event is None:
+                    connected = False
+                if changed:
+                    self.reconcile()
+                self.refresh_lease()
+            if max_events is None and not connected:
+                time.sleep(RECONNECT_TIMEOUT)
+            elif not connected:
+                break
+
+
+def watch_docker(args):
+    """
+    Registers containers in the ALB configuration as they start and stop.
+    """
+    client = etcd_client(args.etcd_host)
+    discovery_id = os.environ.get("DISCOVERY_ID") or socket.gethostname()
+    watcher = DockerWatcher(DockerClient(args.docker_socket), client, alb=args.alb_id, discovery_id=discovery_id,
+                            host=os.environ.get("HOST_IP"), dry_run=args.dry_run, ttl=args.ttl)
+    watcher.watch()
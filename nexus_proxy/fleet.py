@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import zlib
+
+import etcd
+
+from .manager import get_certs_path, get_cert_path
+from .metrics import Gauge, Counter
+from .register import etcd_client
+from .services import LoadBalancerConfig
+from .snapshot import config_to_dict, config_from_dict
+
+logger = logging.getLogger('docker-alb')
+
+FLEET_PREFIX = '/fleet'
+DEFAULT_LEADER_TTL = 6
+# Fields of a generation which refer to artifacts, a generation with the same values is not published again
+CONTENT_FIELDS = ('config', 'snapshot', 'certificates')
+
+FLEET_LEADER = Gauge('nap_fleet_leader', "1 if this controller renders the configuration for the fleet")
+FLEET_GENERATION = Gauge('nap_fleet_generation', "Generation of the configuration published or applied last")
+FLEET_PUBLISHES = Counter('nap_fleet_publishes_total', "Generations published by this controller")
+FLEET_ARTIFACT_FETCHES = Counter('nap_fleet_artifact_fetches_total', "Artifacts read from etcd by this controller")
+
+
+class FleetError(Exception):
+    pass
+
+
+def get_fleet_enabled():
+    return os.environ.get('ALB_FLEET', '') in ('yes', 'true', '1')
+
+
+def get_leader_ttl():
+    ttl = os.environ.get('FLEET_LEADER_TTL')
+    return int(ttl) if ttl else DEFAULT_LEADER_TTL
+
+
+def fleet_key(alb_id, name):
+    return "{prefix}/{alb}/{name}".format(prefix=FLEET_PREFIX, alb=alb_id, name=name)
+
+
+def artifact_key(alb_id, digest):
+    return fleet_key(alb_id, 'artifacts/' + digest)
+
+
+def content_hash(text: str):
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+def encode_artifact(text: str):
+    # Rendered configs repeat the same lines for every virtual-host, compression keeps etcd values small
+    return base64.b64encode(zlib.compress(text.encode('utf8'))).decode('ascii')
+
+
+def decode_artifact(value: str):
+    return zlib.decompress(base64.b64decode(value)).decode('utf8')
+
+
+def generation_hashes(generation: dict):
+    """
+    :return: Set of artifact hashes a generation refers to.
+    """
+    if not generation:
+        return set()
+    return {generation['config'], generation['snapshot']} | set(generation['certificates'].values())
+
+
+def same_content(generation: dict, other: dict):
+    if not generation or not other:
+        return False
+    return all(generation.get(name) == other.get(name) for name in CONTENT_FIELDS)
+
+
+def read_generation(client: etcd.Client, alb_id, with_value=False):
+    """
+    :param with_value: If True the value as stored is returned as well, to compare-and-swap against.
+    :return: The current generation as a dictionary or None if nothing has been published,
+             with with_value a tuple of the generation and the stored value.
+    """
+    try:
+        value = client.read(fleet_key(alb_id, 'generation')).value
+    except (etcd.EtcdKeyNotFound, KeyError):
+        return (None, None) if with_value else None
+    try:
+        generation = json.loads(value)
+    except (TypeError, ValueError) as e:
+        raise FleetError("Generation for ALB {} is not valid JSON: {}".format(alb_id, e))
+    return (generation, value) if with_value else generation
+
+
+def read_leader(client: etcd.Client, alb_id):
+    try:
+        return client.read(fleet_key(alb_id, 'leader')).value
+    except (etcd.EtcdKeyNotFound, KeyError):
+        return None
+
+
+class LeaderElection(object):
+    def __init__(self, client: etcd.Client, alb_id, node=None, ttl=DEFAULT_LEADER_TTL):
+        """
+        Elects one controller per ALB through a leader key with a TTL. The leader refreshes the TTL,
+        if it stops doing so the key expires and another controller takes it within ttl seconds.
+
+        :param client: Client used only for the election, it runs in its own thread.
+        :param node: Name of this controller, defaults to the hostname.
+        :param ttl: Seconds until the leader key expires, it is refreshed every third of that.
+        """
+        self.client = client
+        self.alb_id = alb_id
+        self.node = node or socket.gethostname()
+        self.ttl = ttl
+        self.key = fleet_key(alb_id, 'leader')
+        self.leader = False
+        # Leadership is only assumed until the key could have expired, even if etcd cannot be reached
+        self.expires = 0.0
+
+    @property
+    def is_leader(self):
+        return self.leader and time.monotonic() < self.expires
+
+    def campaign(self):
+        """
+        Refreshes the leader key if this node holds it, otherwise tries to create it.
+
+        :return: True if this node is the leader.
+        """
+        start = time.monotonic()
+        if self.leader:
+            try:
+                self.client.write(self.key, None, ttl=self.ttl, refresh=True, prevExist=True, prevValue=self.node)
+                self.expires = start + self.ttl
+                return True
+            except (etcd.EtcdKeyNotFound, etcd.EtcdCompareFailed):
+                logger.warning("Lost leadership of ALB %s", self.alb_id)
+                self.leader = False
+        try:
+            self.client.write(self.key, self.node, ttl=self.ttl, prevExist=False)
+        except etcd.EtcdAlreadyExist:
+            return False
+        self.leader = True
+        self.expires = start + self.ttl
+        logger.info("Elected leader of ALB %s as %s", self.alb_id, self.node)
+        return True
+
+    def resign(self):
+        if not self.leader:
+            return
+        self.leader = False
+        try:
+            self.client.delete(self.key, prevValue=self.node)
+        except etcd.EtcdException:
+            pass
+
+    def run(self):
+        while True:
+            try:
+                self.campaign()
+            except etcd.EtcdException as e:
+                logger.warning("Could not reach etcd for leader election: %s", e)
+            FLEET_LEADER.set(1 if self.is_leader else 0)
+            time.sleep(self.ttl / 3.0)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='fleet-election', daemon=True)
+        thread.start()
+        return thread
+
+
+class Publication(object):
+    __slots__ = ('generation', 'config_text', 'alb_config', 'certificates')
+
+    def __init__(self, generation: dict, config_text: str, alb_config: LoadBalancerConfig, certificates: dict):
+        """
+        A generation fetched from etcd, ready to be applied by a follower.
+
+        :param certificates: Dictionary of certificate name to PEM data, None for certificates which
+                             are already on disk with the same content.
+        """
+        self.generation = generation
+        self.config_text = config_text
+        self.alb_config = alb_config
+        self.certificates = certificates
+
+    def __repr__(self):
+        return "Publication(generation={!r},leader={!r})".format(self.generation.get('generation'),
+                                                                 self.generation.get('leader'))
+
+    def write_config(self, filename=None):
+        with open(filename or "/etc/haproxy.cfg", "w") as f:
+            f.write(self.config_text)
+        return self.config_text
+
+    def write_certificates(self):
+        """
+        Writes changed certificates atomically and removes those no longer in use.
+        """
+        certs_path = get_certs_path()
+        os.makedirs(certs_path, exist_ok=True)
+        for name, pem_data in self.certificates.items():
+            if pem_data is None:
+                continue
+            cert_path = get_cert_path(name)
+            with open(cert_path + '.tmp', 'w') as pem_file:
+                pem_file.write(pem_data)
+            os.replace(cert_path + '.tmp', cert_path)
+        for filename in os.listdir(certs_path):
+            if filename.endswith('.pem') and filename[:-4] not in self.certificates:
+                os.unlink(os.path.join(certs_path, filename))
+
+
+class FleetMember(object):
+    def __init__(self, client: etcd.Client, alb_id, election: LeaderElection):
+        """
+        Shares one rendered configuration between all controllers of an ALB. The leader publishes the
+        haproxy config, a snapshot of the configuration and the certificates as content addressed
+        artifacts below /fleet/<alb>/artifacts and points /fleet/<alb>/generation at them. Followers
+        read the generation key each poll and only fetch artifacts whose hash changed.
+
+        :param client: Client used for publishing and fetching.
+        :param election: Election which decides if this controller is the leader.
+        """
+        self.client = client
+        self.alb_id = alb_id
+        self.election = election
+        # Last generation published or applied by this controller
+        self.generation = None
+        # Artifacts referenced by the previous generation, followers may still be fetching them
+        self.previous_hashes = None
+        # Certificate name to hash of the PEM on disk
+        self.certificate_hashes = {}
+
+    @property
+    def is_leader(self):
+        return self.election.is_leader
+
+    def fetch(self, digest):
+        try:
+            value = self.client.read(artifact_key(self.alb_id, digest)).value
+        except (etcd.EtcdKeyNotFound, KeyError):
+            raise FleetError("Artifact {} of ALB {} does not exist".format(digest, self.alb_id))
+        FLEET_ARTIFACT_FETCHES.inc()
+        try:
+            text = decode_artifact(value)
+        except (TypeError, ValueError, zlib.error) as e:
+            raise FleetError("Artifact {} cannot be decoded: {}".format(digest, e))
+        if content_hash(text) != digest:
+            raise FleetError("Artifact {} does not match its hash".format(digest))
+        return text
+
+    def poll(self):
+        """
+        Reads the current generation and fetches what changed since the last one applied.
+
+        :return: Publication or None if nothing new has been published.
+        """
+        generation = read_generation(self.client, self.alb_id)
+        if generation is None or same_content(generation, self.generation):
+            return None
+        config_text = self.fetch(generation['config'])
+        snapshot = json.loads(self.fetch(generation['snapshot']))
+        certificates = {}
+        for name, digest in generation['certificates'].items():
+            if self.certificate_hashes.get(name) == digest and os.path.exists(get_cert_path(name)):
+                certificates[name] = None
+            else:
+                certificates[name] = self.fetch(digest)
+        return Publication(generation, config_text, config_from_dict(snapshot), certificates)
+
+    def applied(self, publication: Publication):
+        """
+        Marks a publication as running in the local haproxy.
+        """
+        self.generation = publication.generation
+        self.certificate_hashes = dict(publication.generation['certificates'])
+        FLEET_GENERATION.set(publication.generation['generation'])
+
+    def write_artifact(self, text, digest=None):
+        digest = digest or content_hash(text)
+        try:
+            self.client.write(artifact_key(self.alb_id, digest), encode_artifact(text), prevExist=False)
+        except etcd.EtcdAlreadyExist:
+            pass
+        return digest
+
+    def publish(self, alb_config: LoadBalancerConfig, config_text: str):
+        """
+        Publishes the configuration this controller just applied. Certificates are read from the
+        certificate directory, transfer_certificates must have been run. haproxy loads every
+        certificate in the directory, so all of them are published, also those which are only
+        referred to by a listener group.
+
+        The generation is swapped in only if it is still the one read here and this controller is
+        still the leader, a leader which lost the election mid-cycle cannot roll followers back.
+
+        :return: The published generation, the current one if the content is unchanged, or None if
+                 this controller is no longer the leader or another generation was published meanwhile.
+        """
+        current, current_value = read_generation(self.client, self.alb_id, with_value=True)
+        if self.previous_hashes is None:
+            # Elected after another leader, its generation is what followers are running
+            self.previous_hashes = generation_hashes(current)
+
+        certificates = {}
+        certs_path = get_certs_path()
+        for filename in sorted(os.listdir(certs_path)) if os.path.isdir(certs_path) else []:
+            if filename.endswith('.pem'):
+                with open(os.path.join(certs_path, filename)) as pem_file:
+                    certificates[filename[:-4]] = self.write_artifact(pem_file.read())
+        generation = {
+            'generation': (current or {}).get('generation', 0) + 1,
+            'leader': self.election.node,
+            'time': int(time.time()),
+            'config': self.write_artifact(config_text),
+            'snapshot': self.write_artifact(json.dumps(config_to_dict(alb_config), sort_keys=True)),
+            'certificates': certificates,
+        }
+        if same_content(generation, current):
+            self.generation = current
+            return current
+
+        if not self.election.is_leader:
+            logger.warning("No longer leader of ALB %s, not publishing generation %d", self.alb_id,
+                           generation['generation'])
+            return None
+        try:
+            if current_value is None:
+                self.client.write(fleet_key(self.alb_id, 'generation'), json.dumps(generation, sort_keys=True),
+                                  prevExist=False)
+            else:
+                self.client.write(fleet_key(self.alb_id, 'generation'), json.dumps(generation, sort_keys=True),
+                                  prevValue=current_value)
+        except (etcd.EtcdCompareFailed, etcd.EtcdAlreadyExist, etcd.EtcdKeyNotFound):
+            logger.warning("Generation of ALB %s changed while publishing, not publishing generation %d",
+                           self.alb_id, generation['generation'])
+            return None
+        FLEET_PUBLISHES.inc()
+        FLEET_GENERATION.set(generation['generation'])
+        logger.info("Published generation %d of ALB %s", generation['generation'], self.alb_id)
+
+        # Artifacts of the generation before the current are no longer read by anyone
+        hashes = generation_hashes(generation)
+        current_hashes = generation_hashes(current)
+        for digest in self.previous_hashes - hashes - current_hashes:
+            try:
+                self.client.delete(artifact_key(self.alb_id, digest))
+            except etcd.EtcdKeyNotFound:
+                pass
+        self.previous_hashes = current_hashes
+        self.generation = generation
+        self.certificate_hashes = dict(certificates)
+        return generation
+
+
+def cli_show_fleet(args):
+    client = etcd_client(args.etcd_host)
+    alb_id = os.environ.get('ALB_ID', args.alb_id)
+    leader = read_leader(client, alb_id)
+    try:
+        generation = read_generation(client, alb_id)
+    except FleetError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    if args.format == 'json':
+        json.dump({'leader': leader, 'generation': generation}, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write("\n")
+        return
+    print("leader: {}".format(leader or '-'))
+    if generation is None:
+        print("generation: -")
+        return
+    print("generation: {} by {} at {}".format(generation['generation'], generation['leader'],
+                                              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(generation['time']))))
+    print("config: {}".format(generation['config']))
+    print("snapshot: {}".format(generation['snapshot']))
+    for name, digest in sorted(generation['certificates'].items()):
+        print("certificate {}: {}".format(name, digest))
@@ -2,10 +2,14 @@
 import os
 from jinja2 import Environment, PackageLoader
 
-from .services import LoadBalancerConfig
+from .haproxy import get_runtime_socket, get_server_state_file
+from .manager import get_certs_path
+from .services import LoadBalancerConfig, RATE_PERIOD, LIMIT_GROUPS_TABLE
 
 HAPROXY_TEMPLATE = "templates/haproxy/haproxy.cfg"
 DEFAULT_LOG_SIDECAR_PATH = '/sidecar/log'
+DEFAULT_PIDFILE = '/var/run/haproxy.pid'
+DEFAULT_ERRORFILES_PATH = '/etc/haproxy/errorfiles'
 env = Environment()
 
 
@@ -26,25 +30,27 @@ def create_context():
         'log_sidecar': log_sidecar,
         'log_path': log_path,
         'stats': stats,
+        'runtime_socket': get_runtime_socket(),
+        'server_state_file': get_server_state_file(),
+        'certs_path': get_certs_path(),
+        'pidfile': os.environ.get('HAPROXY_PIDFILE', DEFAULT_PIDFILE),
+        'errorfiles_path': os.environ.get('HAPROXY_ERRORFILES', DEFAULT_ERRORFILES_PATH),
     }
 
 
-def write_config(alb_config: LoadBalancerConfig, template_filename=None, filename=None):
+def write_config(alb_config: LoadBalancerConfig, template_filename=None, filename=None) -> str:
     """
     Writes load balancer configuration to a haproxy config file.
 
     :param alb_config: Load balancer configuration object
     :param template_filename: Filename to load template from or None to use default.
     :param filename: Filename to write to or None to use default haproxy config
+    :return: The haproxy config as a string
     """
-    template = env.from_string(open(template_filename or HAPROXY_TEMPLATE).read())
+    config_text = generate_config(alb_config, template_filename=template_filename)
     with open(filename or "/etc/haproxy.cfg", "w") as f:
-        context = create_context()
-        context.update({
-            'port_groups': alb_config.port_groups,
-            'target_groups': alb_config.target_groups,
-        })
-        f.write(template.render(context))
+        f.write(config_text)
+    return config_text
 
 
 def generate_config(alb_config: LoadBalancerConfig, template_filename=None) -> str:
@@ -60,5 +66,8 @@ def generate_config(alb_config: LoadBalancerConfig, template_filename=None) -> s
     context.update({
         'port_groups': alb_config.port_groups,
         'target_groups': alb_config.target_groups,
+        'traffic_limits': alb_config.traffic_limits,
+        'rate_period': RATE_PERIOD,
+        'limit_groups_table': LIMIT_GROUPS_TABLE,
     })
     return template.render(context)
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import logging
+import os
+import socket
+
+from .diff import diff_target_groups, needs_reload
+from .services import TargetGroup
+
+logger = logging.getLogger('docker-alb')
+
+DEFAULT_RUNTIME_SOCKET = '/var/run/haproxy.sock'
+DEFAULT_SERVER_STATE_FILE = '/var/run/haproxy.state'
+# Version of the 'show servers state' format haproxy 1.7 writes and loads
+SERVER_STATE_VERSION = '1'
+# srv_admin_state values, SRV_ADMF_FDRAIN is the drain state set through the runtime API
+ADMIN_STATE_READY = '0'
+ADMIN_STATE_DRAIN = '8'
+
+
+class RuntimeAPIError(Exception):
+    pass
+
+
+def get_runtime_socket():
+    return os.environ.get('HAPROXY_SOCKET', DEFAULT_RUNTIME_SOCKET)
+
+
+def get_server_state_file():
+    return os.environ.get('HAPROXY_SERVER_STATE', DEFAULT_SERVER_STATE_FILE)
+
+
+class RuntimeClient(object):
+    def __init__(self, socket_path=None, timeout=5.0):
+        """
+        Client for the haproxy runtime API (stats socket), used to change servers without a reload.
+
+        :param socket_path: Path to the stats socket, defaults to HAPROXY_SOCKET env or /var/run/haproxy.sock.
+        :param timeout: Socket timeout in seconds.
+        """
+        self.socket_path = socket_path or get_runtime_socket()
+        self.timeout = timeout
+
+    def execute(self, commands):
+        """
+        Sends one or more commands over a single connection.
+
+        :param commands: Command string or list of commands.
+        :return: The output from haproxy.
+        """
+        if not isinstance(commands, str):
+            commands = ";".join(commands)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall((commands + "\n").encode('utf8'))
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except OSError as e:
+            raise RuntimeAPIError("haproxy runtime API {} failed: {}".format(self.socket_path, e))
+        finally:
+            sock.close()
+        return b"".join(chunks).decode('utf8', 'replace')
+
+
+def backend_name(target_group: TargetGroup):
+    return target_group.slug + '_backend'
+
+
+def server_name(target):
+    return 'target_' + target.hash
+
+
+def server_updates(old_groups: dict, new_groups: dict):
+    """
+    Finds server changes which can be applied through the runtime API instead of a reload.
+
+    :param old_groups: Target groups map of the running configuration.
+    :param new_groups: Target groups map of the new configuration.
+    :return: List of (backend, server, state) tuples, state is maint for removed targets, drain for targets
+             which started draining and ready for targets back in service. None if the change needs a reload.
+    """
+    changes = diff_target_groups(old_groups, new_groups)
+    if needs_reload(changes):
+        return None
+    updates = []
+    for change in changes:
+        if change.action == 'remove':
+            state = 'maint'
+        else:
+            state = 'drain' if change.new.draining else 'ready'
+        updates.append((backend_name(old_groups[change.identifier.split('/', 1)[0]]), server_name(change.old),
+                        state))
+    return updates
+
+
+def update_servers(runtime: RuntimeClient, updates):
+    """
+    Changes the admin state of servers. In maint a server receives no traffic and is no longer health
+    checked, in drain it keeps its connections but gets no new requests.
+
+    :param updates: List of (backend, server, state) tuples.
+    :raises RuntimeAPIError: If haproxy did not accept the commands.
+    """
+    if not updates:
+        return
+    commands = []
+    for backend, server, state in updates:
+        commands.append("set server {}/{} state {}".format(backend, server, state))
+        if state == 'ready':
+            # A server which was draining when the config was written has weight 0
+            commands.append("set weight {}/{} 1".format(backend, server))
+    output = runtime.execute(commands)
+    if output.strip():
+        raise RuntimeAPIError("haproxy did not update servers: {}".format(output.strip()))
+
+
+def started_servers(old_groups: dict, new_groups: dict):
+    """
+    Finds servers added to existing target groups with slowstart. haproxy does not ramp up servers which
+    are present when it starts, only those which come back from maintenance.
+
+    :return: List of (backend, server) tuples.
+    """
+    servers = []
+    for identifier, group in sorted(new_groups.items()):
+        old = old_groups.get(identifier)
+        if not group.slowstart or old is None:
+            continue
+        old_names = {server_name(target) for target in old.targets}
+        servers.extend((backend_name(group), server_name(target)) for target in group.targets
+                       if not target.draining and server_name(target) not in old_names)
+    return servers
+
+
+def warm_up_servers(runtime: RuntimeClient, servers):
+    """
+    Cycles servers through maintenance so haproxy applies the slowstart ramp-up to them.
+
+    :param servers: List of (backend, server) tuples.
+    :raises RuntimeAPIError: If haproxy did not accept the commands.
+    """
+    if not servers:
+        return
+    commands = []
+    for backend, server in servers:
+        commands.append("set server {}/{} state maint".format(backend, server))
+        commands.append("set server {}/{} state ready".format(backend, server))
+    output = runtime.execute(commands)
+    if output.strip():
+        raise RuntimeAPIError("haproxy did not warm up servers: {}".format(output.strip()))
+
+
+def save_server_state(runtime: RuntimeClient, target_groups_map: dict, path=None):
+    """
+    Dumps the state of the running servers to the file the next haproxy process loads, so after a
+    reload servers keep their health and are not checked up from scratch. haproxy matches the lines
+    on backend and server name, both are derived from the target group and host:port and stay the
+    same across reloads.
+
+    Only servers in the new configuration are written. Their admin state and weight are taken from
+    the new configuration, which decides if a target is draining, only the health is carried over.
+
+    :param target_groups_map: Target groups of the configuration haproxy is reloaded with.
+    :param path: File to write, defaults to HAPROXY_SERVER_STATE env or /var/run/haproxy.state.
+    :return: Number of servers written.
+    :raises RuntimeAPIError: If haproxy did not answer with a server state dump.
+    :raises OSError: If the file cannot be written.
+    """
+    output = runtime.execute("show servers state")
+    lines = [line for line in output.splitlines() if line.strip()]
+    if len(lines) < 2 or lines[0].strip() != SERVER_STATE_VERSION or not lines[1].startswith('# '):
+        raise RuntimeAPIError("Unexpected 'show servers state' output: {}".format(output[:200].strip()))
+    columns = lines[1][2:].split()
+    try:
+        be_name, srv_name, admin_state, uweight, iweight = (
+            columns.index(name) for name in ('be_name', 'srv_name', 'srv_admin_state', 'srv_uweight', 'srv_iweight'))
+    except ValueError:
+        raise RuntimeAPIError("Unexpected 'show servers state' columns: {}".format(lines[1]))
+
+    targets = {}
+    for target_group in target_groups_map.values():
+        backend = backend_name(target_group)
+        for target in target_group.targets:
+            targets[(backend, server_name(target))] = target
+    servers = []
+    for line in lines[2:]:
+        fields = line.split()
+        if len(fields) != len(columns):
+            continue
+        target = targets.get((fields[be_name], fields[srv_name]))
+        if target is None:
+            continue
+        fields[admin_state] = ADMIN_STATE_DRAIN if target.draining else ADMIN_STATE_READY
+        # Matches the weight in the config, otherwise haproxy ignores the weight from the file
+        fields[uweight] = fields[iweight] = '0' if target.draining else '1'
+        servers.append(" ".join(fields))
+
+    path = path or get_server_state_file()
+    with open(path + '.tmp', 'w') as state_file:
+        state_file.write("\n".join([SERVER_STATE_VERSION, lines[1]] + servers) + "\n")
+    os.replace(path + '.tmp', path)
+    return len(servers)
+
+
+def discard_server_state(path=None):
+    """
+    Removes the server state file, a file from an earlier haproxy process would restore outdated states.
+    """
+    try:
+        os.remove(path or get_server_state_file())
+    except FileNotFoundError:
+        pass
+
+
+def show_stat(runtime: RuntimeClient):
+    """
+    Reads the 'show stat' CSV from haproxy.
+
+    :return: List of dictionaries, one per frontend, backend and server row.
+    """
+    output = runtime.execute("show stat")
+    lines = [line for line in output.splitlines() if line.strip()]
+    if not lines or not lines[0].startswith('# '):
+        raise RuntimeAPIError("Unexpected 'show stat' output: {}".format(output[:200].strip()))
+    return list(csv.DictReader(io.StringIO("\n".join([lines[0][2:]] + lines[1:]))))
+
+
+def show_info(runtime: RuntimeClient):
+    """
+    Reads process information from haproxy.
+
+    :return: Dictionary of field name to string value.
+    """
+    info = {}
+    for line in runtime.execute("show info").splitlines():
+        name, sep, value = line.partition(':')
+        if sep:
+            info[name.strip()] = value.strip()
+    return info
+
+
+def show_table(runtime: RuntimeClient, table):
+    """
+    Reads the entries of a stick table.
+
+    :return: Dictionary of key to dictionary of the stored counters, e.g. conn_cur, as strings.
+    """
+    entries = {}
+    for line in runtime.execute("show table {}".format(table)).splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = dict(item.split('=', 1) for item in line.split()[1:] if '=' in item)
+        key = fields.pop('key', None)
+        if key is not None:
+            entries[key] = fields
+    return entries
@@ -4,6 +4,7 @@ import sys
 import json
 import logging
 import shutil
+from collections import OrderedDict
 from datetime import datetime
 
 import etcd
@@ -11,10 +12,11 @@ import etcd
 from subprocess import call
 
 from .services import NoListeners, Listener, Rule, Target, NoTargetGroups, HealthCheck, ListenerGroup, CertBot, \
-    Certificate
+    Certificate, TrafficLimits, Capacity
 from .utils import get_etcd_addr
 from .services import TargetGroup, LoadBalancerConfig
-from .register import mark_certbot_ready
+from .register import mark_certbot_ready, LEASE_PREFIX
+from .metrics import CountingClient, CERTIFICATE_SYNCS
 
 logger = logging.getLogger('docker-alb')
 
@@ -24,53 +26,65 @@ bool_lookup = {
 }
 
 
-def get_listeners(alb_id, max_tries=3):
+def get_listeners(alb_id, max_tries=3, client: etcd.Client = None):
     tries = 0
     while tries < max_tries:
         try:
-            return _get_listeners(alb_id)
+            return _get_listeners(alb_id, client=client)
         except etcd.EtcdConnectionFailed:
             tries += 1
     raise NoListeners()
 
 
-def get_target_groups(identifiers, max_tries=3):
+def get_target_groups(identifiers, max_tries=3, client: etcd.Client = None):
     tries = 0
     while tries < max_tries:
         try:
-            return _get_target_groups(identifiers)
+            return _get_target_groups(identifiers, client=client)
         except etcd.EtcdConnectionFailed:
             tries += 1
     raise NoTargetGroups()
 
 
-def get_listener_groups(alb_id, max_tries=3):
+def get_listener_groups(alb_id, max_tries=3, client: etcd.Client = None):
     tries = 0
     while tries < max_tries:
         try:
-            return _get_listener_groups(alb_id)
+            return _get_listener_groups(alb_id, client=client)
         except etcd.EtcdConnectionFailed:
             tries += 1
     raise NoTargetGroups()
 
 
-def get_alb(alb_id, with_listener_group=False, max_tries=3, raw=False) -> LoadBalancerConfig:
+def get_certificate(certificate_name, with_pem=False, client: etcd.Client = None):
+    """
+    Loads a single certificate entry, returns None if it does not exist.
+    """
+    return _get_certificate(certificate_name, with_pem=with_pem, client=client)
+
+
+def get_alb(alb_id, with_listener_group=False, max_tries=3, raw=False,
+            client: etcd.Client = None) -> LoadBalancerConfig:
     """
     :param alb_id: Identifier for ALB.
     :param with_listener_group: If True then it will also load listener groups.
     :param max_tries: Max number of times to try and fetching data if it fails.
     :param raw: If True then it will only include data found in config, not auto-generated ones
+    :param client: etcd client to use, if None one is created from ETCD_HOST.
     """
-    listeners = get_listeners(alb_id, max_tries=max_tries)
+    if client is None:
+        host, port = get_etcd_addr()
+        client = CountingClient(host=host, port=int(port))
+    listeners = get_listeners(alb_id, max_tries=max_tries, client=client)
     target_ids = set()
     for listener in listeners.values():
         target_ids |= set(listener.iter_target_group_ids())
-    target_groups = get_target_groups(target_ids, max_tries=max_tries)
+    target_groups = get_target_groups(target_ids, max_tries=max_tries, client=client)
 
     listener_groups = None
     # logger.debug("with_listener_group: %s", with_listener_group)
     if with_listener_group:
-        listener_groups = get_listener_groups(alb_id, max_tries=max_tries)
+        listener_groups = get_listener_groups(alb_id, max_tries=max_tries, client=client)
         if listener_groups is not None:
             listener_groups = list(listener_groups.values())
 
@@ -101,31 +115,36 @@ def get_alb(alb_id, with_listener_group=False, max_tries=3, raw=False) -> LoadBa
                     Target(host=certbot.target_ip, port=certbot.target_port),
                 ])
                 if certbot_listener:
-                    certbot_listener.rules.extend(certbot_rules)
+                    certbot_listener = certbot_listener.replace(rules=certbot_listener.rules + tuple(certbot_rules))
                 else:
                     certbot_listener = Listener('certbot-' + listener_group.identifier, port=80, rules=certbot_rules)
-                    listeners[certbot_listener.identifier] = certbot_listener
+                listeners[certbot_listener.identifier] = certbot_listener
                 target_groups[certbot_tg.identifier] = certbot_tg
 
-    # Assign TargetGroup objects to rules
-    for listener in listeners.values():
-        for rule in listener.rules:
-            if rule.target_group_id and rule.target_group_id in target_groups:
-                rule.target_group = target_groups[rule.target_group_id]
-
-    # Load certificates
-    for listener in listeners.values():
+    # Traffic limits are set on listener groups but rendered per listener
+    listener_limits = {}
+    for listener_group in listener_groups or ():
+        if listener_group.limits is not None:
+            for listener_id in listener_group.listeners or ():
+                listener_limits[listener_id] = listener_group.limits
+
+    # Listeners are immutable, each one is rebuilt once with everything resolved
+    for listener_id, listener in list(listeners.items()):
+        # Assign TargetGroup objects to rules
+        rules = [rule.replace(target_group=target_groups[rule.target_group_id])
+                 if rule.target_group_id and rule.target_group_id in target_groups else rule
+                 for rule in listener.rules]
+        if not raw:
+            # Sort rules so that high priority comes first
+            rules.sort(key=lambda r: r.pri, reverse=True)
+
+        # Load certificate details, except PEM data
+        certificate = listener.certificate
         if listener.certificate_name:
-            # Load certificate details, except PEM data
-            certificate = _get_certificate(listener.certificate_name)
+            certificate = _get_certificate(listener.certificate_name, client=client) or certificate
             logger.debug("listener: %s, cert: %s", listener, certificate)
-            if certificate:
-                listener.certificate = certificate
-
-    if not raw:
-        # Sort rules in all listeners so that high priority comes first
-        for listener in listeners.values():  # type: Listener
-            listener.rules.sort(key=lambda r: r.pri, reverse=True)
+        listeners[listener_id] = listener.replace(rules=rules, certificate=certificate,
+                                                  limits=listener_limits.get(listener_id))
 
     return LoadBalancerConfig(alb_id, listeners=listeners, listener_groups=listener_groups,
                               target_groups=target_groups)
@@ -161,64 +180,109 @@ def get_int_item(data, key, name):
         return None
 
 
-def _get_listeners(alb_id):
+def get_positive_int(data, key, name):
     """
+    :return: Value of an optional setting as a number above zero, or None if unset or invalid.
     """
-    host, port = get_etcd_addr()
-    client = etcd.Client(host=host, port=int(port))
-    listeners = {}
+    value = data.get(key)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        logger.warning("Expected integer value for %s: %s", name, value)
+        return None
+    return value if value > 0 else None
+
 
+def read_tree(client: etcd.Client, prefix):
+    """
+    Reads everything below prefix with a single recursive read.
+
+    :return: Nested dictionaries of key name to value or sub-directory, sorted on key.
+    """
+    tree = OrderedDict()
     try:
-        listeners_prefix = '/alb/{name}/listeners'.format(name=alb_id)
-        for i in client.read(listeners_prefix).children:
-            listener_id = i.key[1:].split("/")[-1]
+        result = client.read(prefix, recursive=True, sorted=True)
+    except (etcd.EtcdKeyNotFound, KeyError):
+        return tree
+    offset = len(prefix.rstrip('/')) + 1
+    for node in result.leaves:
+        if len(node.key) < offset:
+            # Empty directory at prefix
+            continue
+        parts = node.key[offset:].split('/')
+        branch = tree
+        for part in parts[:-1]:
+            branch = branch.setdefault(part, OrderedDict())
+        if node.dir:
+            branch.setdefault(parts[-1], OrderedDict())
+        else:
+            branch[parts[-1]] = node.value
+    return tree
+
+
+def load_json(value, name):
+    if value is None:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        logger.warning("Invalid JSON in %s: %s", name, value)
+        return None
+
+
+def _get_listeners(alb_id, client: etcd.Client = None):
+    """
+    Loads all listeners of an ALB with a single recursive read.
+    """
+    if client is None:
+        host, port = get_etcd_addr()
+        client = CountingClient(host=host, port=int(port))
+    listeners = {}
 
-            listener_path = listeners_prefix + '/' + listener_id
-            listener_port = get_value(client, listener_path + '/port')
-            if listener_port is None:
+    listeners_prefix = '/alb/{name}/listeners'.format(name=alb_id)
+    for listener_id, listener_tree in read_tree(client, listeners_prefix).items():
+        if not isinstance(listener_tree, dict):
+            continue
+        listener_port = listener_tree.get('port')
+        if listener_port is None:
+            continue
+        try:
+            listener_port = int(listener_port)
+        except ValueError:
+            # Port is not an integer, skip listener
+            continue
+        listener_protocol = listener_tree.get('protocol', 'http')
+        certificate_name = listener_tree.get('certificate_name')
+
+        rules = []
+        for rule_id, rule_tree in (listener_tree.get('rules') or {}).items():
+            if not isinstance(rule_tree, dict):
                 continue
-            try:
-                listener_port = int(listener_port)
-            except ValueError:
-                # Port is not an integer, skip listener
+            config = load_json(rule_tree.get('config'), '{}/{}/rules/{}'.format(listeners_prefix, listener_id,
+                                                                                rule_id))
+            if not isinstance(config, dict):
                 continue
-            listener_protocol = get_value(client, listener_path + '/protocol', default='http')
-            certificate_name = get_value(client, listener_path + '/certificate_name')
 
-            listener = Listener(listener_id, port=listener_port, protocol=listener_protocol,
-                                certificate_name=certificate_name)
+            path = config.get('path')
+            host = config.get('host')
+            action = config.get('action')
+            if not action:
+                continue
 
-            rules = []
-            try:
-                for rule_it in client.read(listener_path + '/rules').children:
-                    rule_id = rule_it.key[1:].split("/")[-1]
-                    rule_path = listener_path + '/rules/' + rule_id
-                    config = get_json(client, rule_path + '/config')
-                    if config is None:
-                        continue
-
-                    path = config.get('path')
-                    host = config.get('host')
-                    action = config.get('action')
-                    if not action:
-                        continue
-
-                    rules.append(Rule(
-                        host=host,
-                        path=path,
-                        action=action
-                    ))
-            except (etcd.EtcdKeyNotFound, KeyError):
-                pass
+            rules.append(Rule(
+                host=host,
+                path=path,
+                action=action
+            ))
 
-            # If there are no rules skip the entire listener
-            if not rules:
-                continue
+        # If there are no rules skip the entire listener
+        if not rules:
+            continue
 
-            listener.rules.extend(rules)
-            listeners[listener_id] = listener
-    except (etcd.EtcdKeyNotFound, KeyError, ValueError):
-        pass
+        listeners[listener_id] = Listener(listener_id, port=listener_port, protocol=listener_protocol,
+                                          certificate_name=certificate_name, rules=rules)
 
     return listeners
 
@@ -230,7 +294,7 @@ def _get_certificate(certificate_name, with_pem=False, client: etcd.Client = Non
     """
     if client is None:
         host, port = get_etcd_addr()
-        client = etcd.Client(host=host, port=int(port))
+        client = CountingClient(host=host, port=int(port))
 
     cert_path = '/certs/{name}'.format(name=certificate_name)
     try:
@@ -255,11 +319,13 @@ def _get_certificate(certificate_name, with_pem=False, client: etcd.Client = Non
                     cert_modified = None
     cert_is_valid = get_value(client, cert_path + '/is_valid')
     cert_is_valid = bool_lookup.get(cert_is_valid)
+    if cert_is_valid is None:
+        cert_is_valid = bool(cert_pem)
 
     certificate = Certificate(certificate_name, pem_data=cert_pem, domains=cert_domains, email=cert_email,
                               modified=cert_modified, is_valid=cert_is_valid)
     if with_pem:
-        certificate.pem_data = _load_certificate_data(certificate, client=client)
+        certificate = certificate.replace(pem_data=_load_certificate_data(certificate, client=client))
 
     return certificate
 
@@ -267,7 +333,7 @@ def _get_certificate(certificate_name, with_pem=False, client: etcd.Client = Non
 def _load_certificate_data(certificate: Certificate, client: etcd.Client = None):
     if client is None:
         host, port = get_etcd_addr()
-        client = etcd.Client(host=host, port=int(port))
+        client = CountingClient(host=host, port=int(port))
 
     cert_path = '/certs/{name}'.format(name=certificate.identifier)
     cert_pem = get_value(client, cert_path + '/data') or None
@@ -277,7 +343,7 @@ def _load_certificate_data(certificate: Certificate, client: etcd.Client = None)
 def transfer_certificates(alb: LoadBalancerConfig, client: etcd.Client = None):
     if client is None:
         host, port = get_etcd_addr()
-        client = etcd.Client(host=host, port=int(port))
+        client = CountingClient(host=host, port=int(port))
 
     certs_path = get_certs_path()
     certs_temp_path = get_temp_certs_path()
@@ -290,8 +356,10 @@ def transfer_certificates(alb: LoadBalancerConfig, client: etcd.Client = None):
         logger.debug("Transfer for listener: %s", listener)
         if listener.certificate:
             # If the certificate was transferred, mark it as valid
+            CERTIFICATE_SYNCS.inc()
             if transfer_certificate(listener.certificate, client=client):
-                listener.certificate.is_valid = True
+                alb.listeners_map[listener.identifier] = listener.replace(
+                    certificate=listener.certificate.replace(is_valid=True))
 
     # Sync over changes and delete those that no longer exist
     call(["rsync", "-a", "--delete", certs_temp_path + '/', certs_path + '/'])
@@ -300,7 +368,7 @@ def transfer_certificates(alb: LoadBalancerConfig, client: etcd.Client = None):
 def transfer_certificate(certificate: Certificate, client: etcd.Client = None):
     if client is None:
         host, port = get_etcd_addr()
-        client = etcd.Client(host=host, port=int(port))
+        client = CountingClient(host=host, port=int(port))
 
     modified = certificate.modified
 
@@ -328,7 +396,7 @@ def transfer_certificate(certificate: Certificate, client: etcd.Client = None):
 def mark_certbots_ready(alb: LoadBalancerConfig, client: etcd.Client = None):
     if client is None:
         host, port = get_etcd_addr()
-        client = etcd.Client(host=host, port=int(port))
+        client = CountingClient(host=host, port=int(port))
 
     for listener_group in alb.listener_groups:
         certbot = listener_group.certbot
@@ -337,33 +405,84 @@ def mark_certbots_ready(alb: LoadBalancerConfig, client: etcd.Client = None):
 
 
 def get_certs_path():
-    return '/etc/ssl/crt'
+    return os.environ.get('CERTS_PATH', '/etc/ssl/crt')
 
 
 def get_temp_certs_path():
-    return '/tmp/crt'
+    return os.environ.get('CERTS_TEMP_PATH', '/tmp/crt')
 
 
 def get_cert_path(name):
-    return '/etc/ssl/crt/{name}.pem'.format(name=name)
+    return '{path}/{name}.pem'.format(path=get_certs_path(), name=name)
 
 
 def get_temp_cert_path(name):
-    return '/tmp/crt/{name}.pem'.format(name=name)
+    return '{path}/{name}.pem'.format(path=get_temp_certs_path(), name=name)
+
+
+def _get_leased_targets(client: etcd.Client) -> dict:
+    """
+    Loads targets registered under leases with a single recursive read.
+
+    :return: Dictionary of target group id to list of target config dicts.
+    """
+    leased = {}
+    try:
+        for node in client.read(LEASE_PREFIX, recursive=True).leaves:
+            parts = node.key[1:].split("/")
+            # leases/<lease>/targets/<target group>/<host:port>
+            if node.dir or len(parts) != 5 or parts[2] != 'targets':
+                continue
+            try:
+                config = json.loads(node.value)
+            except (TypeError, ValueError):
+                continue
+            leased.setdefault(parts[3], []).append(config)
+    except (etcd.EtcdKeyNotFound, KeyError):
+        pass
+    return leased
+
+
+def _read_target_group_trees(client: etcd.Client, identifiers) -> dict:
+    """
+    Reads the target groups in identifiers. An ALB which refers to most target groups reads them all
+    with a single recursive read, a shard of a pool only refers to its share and reads those one by one.
+
+    :return: Dictionary of target group id to its tree as returned by read_tree.
+    """
+    try:
+        existing = {node.key.rsplit('/', 1)[-1] for node in client.read('/target_group').leaves
+                    if node.dir and node.key.rstrip('/') != '/target_group'}
+    except (etcd.EtcdKeyNotFound, KeyError):
+        return {}
+    wanted = sorted(existing.intersection(identifiers))
+    if len(wanted) * 2 >= len(existing):
+        return read_tree(client, '/target_group')
+    return {group_id: read_tree(client, '/target_group/' + group_id) for group_id in wanted}
 
 
-def _get_target_groups(identifiers: list) -> dict:
-    host, port = get_etcd_addr()
-    client = etcd.Client(host=host, port=int(port))
+def _get_target_groups(identifiers: list, client: etcd.Client = None) -> dict:
+    """
+    Loads target groups, leased targets are merged in.
+    """
+    if client is None:
+        host, port = get_etcd_addr()
+        client = CountingClient(host=host, port=int(port))
     groups = {}
+    leased_targets = _get_leased_targets(client)
+    tree = _read_target_group_trees(client, identifiers)
 
     for group_id in identifiers:
-        name = get_value(client, '/target_group/{name}/name'.format(name=group_id))
+        group_tree = tree.get(group_id)
+        if not isinstance(group_tree, dict):
+            continue
+        name = group_tree.get('name')
         if name is None:
             continue
 
-        protocol = get_value(client, '/target_group/{name}/protocol'.format(name=group_id))
-        health_check_data = get_json(client, '/target_group/{name}/healthcheck'.format(name=group_id))
+        protocol = group_tree.get('protocol')
+        health_check_data = load_json(group_tree.get('healthcheck'),
+                                      '/target_group/{}/healthcheck'.format(group_id))
         if health_check_data:
             hc_protocol = health_check_data.get('protocol')
             if hc_protocol not in ('http', ):
@@ -399,14 +518,21 @@ def _get_target_groups(identifiers: list) -> dict:
         else:
             health_check = HealthCheck()
 
-        targets_prefix = '/target_group/{name}/targets'.format(name=group_id)
-        targets = []
-        for i in client.read(targets_prefix).children:
-            target_id = i.key[1:].split("/")[-1]
+        capacity = None
+        capacity_data = load_json(group_tree.get('capacity'), '/target_group/{}/capacity'.format(group_id))
+        if isinstance(capacity_data, dict):
+            capacity = Capacity(maxconn=get_positive_int(capacity_data, 'maxconn', "capacity.maxconn"),
+                                maxqueue=get_positive_int(capacity_data, 'maxqueue', "capacity.maxqueue"),
+                                queue_timeout=get_positive_int(capacity_data, 'queue_timeout',
+                                                               "capacity.queue_timeout"))
+            if not (capacity.maxconn or capacity.maxqueue or capacity.queue_timeout):
+                capacity = None
 
-            target_path = targets_prefix + '/' + target_id
-            config = get_json(client, target_path)
-            if config is None:
+        targets = []
+        for target_id, target_value in (group_tree.get('targets') or {}).items():
+            config = load_json(target_value, '/target_group/{}/targets/{}'.format(group_id, target_id)) \
+                if isinstance(target_value, str) else None
+            if not isinstance(config, dict):
                 continue
 
             host = config.get('host')
@@ -417,49 +543,81 @@ def _get_target_groups(identifiers: list) -> dict:
             targets.append(Target(
                 host=host,
                 port=port,
+                maxconn=get_positive_int(config, 'maxconn', "target.maxconn"),
+                maxqueue=get_positive_int(config, 'maxqueue', "target.maxqueue"),
+                draining=config.get('draining') is True,
             ))
 
-        target_group = TargetGroup(group_id, targets=targets, health_check=health_check, protocol=protocol)
+        # Targets are the same server in haproxy if host and port match, the first one wins unless it
+        # is draining and the target was registered again under a lease
+        known_targets = {(target.host, target.port): index for index, target in enumerate(targets)}
+        for config in leased_targets.get(group_id, []):
+            target = Target(host=config.get('host'), port=config.get('port'),
+                            maxconn=get_positive_int(config, 'maxconn', "target.maxconn"),
+                            maxqueue=get_positive_int(config, 'maxqueue', "target.maxqueue"))
+            if not target.host or not target.port:
+                continue
+            index = known_targets.get((target.host, target.port))
+            if index is None:
+                known_targets[(target.host, target.port)] = len(targets)
+                targets.append(target)
+            elif targets[index].draining:
+                targets[index] = target
+
+        target_group = TargetGroup(group_id, targets=targets, health_check=health_check, protocol=protocol,
+                                   capacity=capacity, slowstart=get_positive_int(group_tree, 'slowstart',
+                                                                                 "target_group.slowstart"))
         groups[group_id] = target_group
 
     return groups
 
 
-def _get_listener_groups(alb_id):
-    host, port = get_etcd_addr()
-    client = etcd.Client(host=host, port=int(port))
+def _get_listener_groups(alb_id, client: etcd.Client = None):
+    """
+    Loads listener groups and their certbots, one recursive read for each.
+    """
+    if client is None:
+        host, port = get_etcd_addr()
+        client = CountingClient(host=host, port=int(port))
     listener_groups = {}
 
-    try:
-        lg_prefix = '/alb/{name}/listener_groups'.format(name=alb_id)
-        for i in client.read(lg_prefix).children:
-            lg_id = i.key[1:].split("/")[-1]
-
-            lg_path = lg_prefix + '/' + lg_id
-            domains = get_json(client, lg_path + '/domains')
-            listener_ids = get_json(client, lg_path + '/listeners')
-            certificate_name = get_value(client, lg_path + '/certificate_name')
-            use_certbot = get_value(client, lg_path + '/certbot_managed') == 'true'
-
-            certbot_path = '/alb/{name}/certbot/{listener_id}'.format(name=alb_id, listener_id=lg_id)
-            certbot_enabled = get_value(client, certbot_path + '/enabled', default='false') == 'true'
-            certbot_target = get_json(client, certbot_path + '/target')
-            certbot_domains = get_json(client, certbot_path + '/domains')
-            certbot_certificate_name = get_value(client, certbot_path + '/certificate_name')
-            certbot = None
-            logger.debug("use_certbot=%r,cerbot_enabled=%r,domains=%r,target=%r", use_certbot, certbot_enabled,
-                         domains, certbot_target)
-            if use_certbot and certbot_enabled and domains and isinstance(certbot_target, list) and len(
-                    certbot_target) >= 2:
-                certbot = CertBot(lg_id, target_ip=certbot_target[0], target_port=certbot_target[1],
-                                  domains=certbot_domains, certificate_name=certbot_certificate_name)
-
-            lg = ListenerGroup(lg_id, listeners=listener_ids, domains=domains, certificate_name=certificate_name,
-                               use_certbot=use_certbot, certbot=certbot)
-            listener_groups[lg_id] = lg
-    except (etcd.EtcdKeyNotFound, KeyError, ValueError) as e:
-        logger.exception("error reading listener groups: %s: %s", type(e).__name__, e)
-        pass
+    lg_prefix = '/alb/{name}/listener_groups'.format(name=alb_id)
+    certbots = read_tree(client, '/alb/{name}/certbot'.format(name=alb_id))
+    for lg_id, lg_tree in read_tree(client, lg_prefix).items():
+        if not isinstance(lg_tree, dict):
+            continue
+        lg_path = lg_prefix + '/' + lg_id
+        domains = load_json(lg_tree.get('domains'), lg_path + '/domains')
+        listener_ids = load_json(lg_tree.get('listeners'), lg_path + '/listeners')
+        certificate_name = lg_tree.get('certificate_name')
+        use_certbot = lg_tree.get('certbot_managed') == 'true'
+
+        certbot_tree = certbots.get(lg_id)
+        if not isinstance(certbot_tree, dict):
+            certbot_tree = {}
+        certbot_path = '/alb/{name}/certbot/{listener_id}'.format(name=alb_id, listener_id=lg_id)
+        certbot_enabled = certbot_tree.get('enabled', 'false') == 'true'
+        certbot_target = load_json(certbot_tree.get('target'), certbot_path + '/target')
+        certbot_domains = load_json(certbot_tree.get('domains'), certbot_path + '/domains')
+        certbot_certificate_name = certbot_tree.get('certificate_name')
+        certbot = None
+        logger.debug("use_certbot=%r,cerbot_enabled=%r,domains=%r,target=%r", use_certbot, certbot_enabled,
+                     domains, certbot_target)
+        if use_certbot and certbot_enabled and domains and isinstance(certbot_target, list) and len(
+                certbot_target) >= 2:
+            certbot = CertBot(lg_id, target_ip=certbot_target[0], target_port=certbot_target[1],
+                              domains=certbot_domains, certificate_name=certbot_certificate_name)
+
+        limits = None
+        limits_data = load_json(lg_tree.get('limits'), lg_path + '/limits')
+        if isinstance(limits_data, dict):
+            limits = TrafficLimits(lg_id, **{name: limits_data.get(name)
+                                             for name in ('rate', 'conn', 'maxconn', 'action')})
+            if not (limits.rate or limits.conn or limits.maxconn):
+                limits = None
+
+        lg = ListenerGroup(lg_id, listeners=listener_ids, domains=domains, certificate_name=certificate_name,
+                           use_certbot=use_certbot, certbot=certbot, limits=limits)
+        listener_groups[lg_id] = lg
 
     return listener_groups
-
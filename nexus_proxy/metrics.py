@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import http.server
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import etcd
+
+logger = logging.getLogger('docker-alb')
+
+# Bucket limits in seconds, covers everything from a single etcd read up to a slow reload
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name: str, help_text: str, registry=None):
+        """
+        Base for metrics exposed in the Prometheus text format.
+
+        :param name: Metric name, should be prefixed with nap_.
+        :param help_text: Description shown in the HELP line.
+        :param registry: Registry to add metric to, defaults to the global one.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).add(self)
+
+    def samples(self):
+        """
+        :return: List of (suffix, labels, value) tuples.
+        """
+        raise NotImplementedError()
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} {}".format(self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            label_text = "{" + ",".join('{}="{}"'.format(key, val) for key, val in labels) + "}" if labels else ""
+            lines.append("{}{}{} {}".format(self.name, suffix, label_text, format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, registry=None):
+        super().__init__(name, help_text, registry=registry)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', (), self.value)]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, registry=None, function=None):
+        """
+        :param function: If set it is called on every scrape to get the value.
+        """
+        super().__init__(name, help_text, registry=registry)
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [('', (), self.function() if self.function else self.value)]
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class LabeledGauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, label_names, registry=None):
+        """
+        Gauge with one value per label combination, all values are replaced at once by a collector.
+
+        :param label_names: Names of labels, values are keyed on tuples in the same order.
+        """
+        super().__init__(name, help_text, registry=registry)
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def replace(self, values: dict):
+        """
+        :param values: Dictionary of label value tuple to value, label combinations not included are dropped.
+        """
+        self.values = dict(values)
+
+    def samples(self):
+        return [('', tuple(zip(self.label_names, (escape_label(label) for label in labels))), value)
+                for labels, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, registry=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, registry=registry)
+        self.buckets = tuple(buckets) + (float('inf'), )
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        with self.lock:
+            self.sum += value
+            self.count += 1
+            for idx, limit in enumerate(self.buckets):
+                if value <= limit:
+                    self.counts[idx] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        """
+        Observes the time spent in the with block, also when it raises.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        samples = []
+        cumulative = 0
+        for limit, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append(('_bucket', (('le', format_value(float(limit))), ), cumulative))
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def expose(self):
+        """
+        :return: All metrics in the Prometheus text exposition format.
+        """
+        return "\n".join(metric.expose() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+ETCD_REQUESTS = Counter('nap_etcd_requests_total', "Requests sent to etcd")
+ETCD_REQUESTS_CYCLE = Gauge('nap_etcd_requests_last_cycle', "Requests sent to etcd during the last poll cycle")
+POLL_SECONDS = Histogram('nap_poll_seconds', "Time spent loading and comparing the configuration in a poll cycle")
+LOAD_SECONDS = Histogram('nap_config_load_seconds', "Time spent loading the ALB configuration from etcd")
+RENDER_SECONDS = Histogram('nap_render_seconds', "Time spent rendering the haproxy configuration")
+CONFIGTEST_SECONDS = Histogram('nap_configtest_seconds', "Time spent validating the haproxy configuration")
+CONFIGTEST_FAILURES = Counter('nap_configtest_failures_total', "Rendered configurations haproxy did not accept")
+RELOAD_SECONDS = Histogram('nap_reload_seconds', "Time spent reloading haproxy")
+RELOADS = Counter('nap_reloads_total', "Successful haproxy reloads")
+RELOAD_FAILURES = Counter('nap_reload_failures_total', "Failed haproxy reloads")
+RUNTIME_UPDATES = Counter('nap_runtime_updates_total', "Changes applied through the runtime API without reload")
+RUNTIME_FAILURES = Counter('nap_runtime_failures_total', "Runtime API changes which fell back to a reload")
+CERTIFICATE_SYNCS = Counter('nap_certificate_syncs_total', "Certificate transfers from etcd to haproxy")
+CERTIFICATES = Gauge('nap_certificates', "Certificates used by the applied configuration")
+FRONTENDS = Gauge('nap_config_frontends', "Frontends in the applied configuration")
+BACKENDS = Gauge('nap_config_backends', "Backends in the applied configuration")
+SERVERS = Gauge('nap_config_servers', "Servers in the applied configuration")
+ACLS = Gauge('nap_config_acls', "Routing rules (ACLs) in the applied configuration")
+LAST_APPLY = Gauge('nap_last_apply_timestamp_seconds', "Unix time of the last successful apply")
+SINCE_LAST_APPLY = Gauge('nap_seconds_since_last_apply', "Seconds since the last successful apply, -1 if never",
+                         function=lambda: time.time() - LAST_APPLY.value if LAST_APPLY.value else -1)
+
+
+class CountingClient(etcd.Client):
+    """
+    etcd client which counts all requests it sends in nap_etcd_requests_total.
+    """
+    def api_execute(self, *args, **kwargs):
+        ETCD_REQUESTS.inc()
+        return super().api_execute(*args, **kwargs)
+
+    def api_execute_json(self, *args, **kwargs):
+        ETCD_REQUESTS.inc()
+        return super().api_execute_json(*args, **kwargs)
+
+
+def record_applied(alb_config):
+    """
+    Updates the configuration size metrics after haproxy has been updated.
+    """
+    port_groups = alb_config.port_groups
+    target_groups = alb_config.target_groups
+    FRONTENDS.set(len(port_groups))
+    BACKENDS.set(len(target_groups))
+    SERVERS.set(sum(len(target_group.targets) for target_group in target_groups))
+    ACLS.set(sum(len(listener.rules) for listener in alb_config.listeners))
+    CERTIFICATES.set(len({listener.certificate_name for listener in alb_config.listeners
+                          if listener.certificate_name}))
+    LAST_APPLY.set(time.time())
+
+
+def get_metrics_port():
+    port = os.environ.get('METRICS_PORT')
+    return int(port) if port else None
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics server: " + format, *args)
+
+
+def start_metrics_server(port, address=''):
+    """
+    Serves /metrics from a background thread, scrapes never block the control loop.
+    """
+    server = http.server.ThreadingHTTPServer((address, int(port)), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import sys
+
+import etcd
+
+from .register import WriteBatch, etcd_client
+from .shards import ShardMap, read_shard_map, write_shard_albs, write_placement, get_shard_map
+
+logger = logging.getLogger('docker-alb')
+
+
+class PlacedGroup(object):
+    __slots__ = ('identifier', 'alb', 'listeners', 'rules', 'certificate_name', 'keys')
+
+    def __init__(self, identifier, alb, listeners, rules=0, certificate_name=None, keys=None):
+        """
+        A listener group as it is currently stored on an ALB.
+
+        :param listeners: Identifiers of the listeners which belong to the group.
+        :param rules: Number of rules in those listeners.
+        :param keys: Dictionary of etcd key to value for the group, its listeners and certbot.
+        """
+        self.identifier = identifier
+        self.alb = alb
+        self.listeners = listeners
+        self.rules = rules
+        self.certificate_name = certificate_name
+        self.keys = keys or {}
+
+    def __repr__(self):
+        return "PlacedGroup({!r},alb={!r},listeners={!r})".format(self.identifier, self.alb, self.listeners)
+
+
+def read_alb_groups(client: etcd.Client, alb):
+    """
+    Reads all listener groups of an ALB with a single recursive read.
+
+    :return: Dictionary of listener group id to PlacedGroup.
+    """
+    prefix = '/alb/{alb}/'.format(alb=alb)
+    entities = {}
+    try:
+        for node in client.read(prefix.rstrip('/'), recursive=True).leaves:
+            if node.dir or not node.key.startswith(prefix):
+                continue
+            parts = node.key[len(prefix):].split('/', 2)
+            if len(parts) < 3:
+                continue
+            entities.setdefault((parts[0], parts[1]), {})[node.key] = node.value
+    except (etcd.EtcdKeyNotFound, KeyError):
+        return {}
+
+    groups = {}
+    for (kind, identifier), keys in entities.items():
+        if kind != 'listener_groups':
+            continue
+        lg_path = '{prefix}listener_groups/{identifier}'.format(prefix=prefix, identifier=identifier)
+        try:
+            listener_ids = json.loads(keys.get(lg_path + '/listeners') or '[]') or []
+        except ValueError:
+            listener_ids = []
+        group_keys = dict(keys)
+        group_keys.update(entities.get(('certbot', identifier), {}))
+        rules = 0
+        for listener_id in listener_ids:
+            listener_keys = entities.get(('listeners', listener_id), {})
+            rules += sum(1 for key in listener_keys if key.endswith('/config'))
+            group_keys.update(listener_keys)
+        groups[identifier] = PlacedGroup(identifier, alb, listener_ids, rules=rules,
+                                         certificate_name=keys.get(lg_path + '/certificate_name') or None,
+                                         keys=group_keys)
+    return groups
+
+
+def read_placement(client: etcd.Client, shard_map: ShardMap):
+    """
+    :return: Dictionary of ALB identifier to dictionary of listener group id to PlacedGroup.
+    """
+    return {alb: read_alb_groups(client, alb) for alb in shard_map.all_albs}
+
+
+def plan_rebalance(shard_map: ShardMap, placement: dict):
+    """
+    :return: List of (PlacedGroup, target ALB) for listener groups which are not on their ALB. The
+             target is None if the group is already on its ALB as well, e.g. registered again before
+             the rebalance, the stale copy is then only removed.
+    """
+    moves = []
+    for alb, groups in sorted(placement.items()):
+        for identifier, group in sorted(groups.items()):
+            target = shard_map.place(identifier)
+            if target == alb:
+                continue
+            moves.append((group, None if identifier in placement.get(target, {}) else target))
+    return moves
+
+
+def move_group(client: etcd.Client, group: PlacedGroup, target):
+    """
+    Copies a listener group with its listeners and certbot to another ALB, then removes it from the
+    old one. Both ALBs serve it for a moment, but it is never missing from both.
+
+    :param target: ALB to move to, None to only remove it.
+    """
+    source_prefix = '/alb/{alb}/'.format(alb=group.alb)
+    batch = WriteBatch(client)
+    if target is not None:
+        target_prefix = '/alb/{alb}/'.format(alb=target)
+        for key, value in group.keys.items():
+            batch.write(target_prefix + key[len(source_prefix):], value)
+        batch.apply()
+    batch.delete('{prefix}listener_groups/{identifier}'.format(prefix=source_prefix, identifier=group.identifier),
+                 recursive=True)
+    batch.delete('{prefix}certbot/{identifier}'.format(prefix=source_prefix, identifier=group.identifier),
+                 recursive=True)
+    for listener_id in group.listeners:
+        batch.delete('{prefix}listeners/{identifier}'.format(prefix=source_prefix, identifier=listener_id),
+                     recursive=True)
+    batch.apply()
+
+
+def placement_report(shard_map: ShardMap, placement: dict):
+    """
+    :return: Dictionary of ALB identifier to counts of what it carries now and how many of its
+             listener groups belong on another ALB.
+    """
+    report = {}
+    for alb in shard_map.all_albs:
+        groups = placement.get(alb, {})
+        report[alb] = {
+            'shard': alb in shard_map.albs,
+            'listener_groups': len(groups),
+            'listeners': sum(len(group.listeners) for group in groups.values()),
+            'rules': sum(group.rules for group in groups.values()),
+            'certificates': len({group.certificate_name for group in groups.values() if group.certificate_name}),
+            'misplaced': sum(1 for identifier in groups if shard_map.place(identifier) != alb),
+        }
+    return report
+
+
+def format_report(shard_map: ShardMap, report: dict):
+    lines = ["pool {}: {} shards, {} pinned listener groups".format(shard_map.pool, len(shard_map.albs),
+                                                                    len(shard_map.placement)),
+             "{:<30} {:>6} {:>10} {:>8} {:>6} {:>10}".format('alb', 'groups', 'listeners', 'rules', 'certs',
+                                                             'misplaced')]
+    for alb, counts in sorted(report.items()):
+        lines.append("{:<30} {:>6} {:>10} {:>8} {:>6} {:>10}".format(
+            alb + ('' if counts['shard'] else ' *'), counts['listener_groups'], counts['listeners'],
+            counts['rules'], counts['certificates'], counts['misplaced']))
+    return "\n".join(lines)
+
+
+def cli_shards(args):
+    client = etcd_client(args.etcd_host)
+    pool = os.environ.get('ALB_ID', args.alb_id)
+    shards_cmd = args.shards_cmd
+    if shards_cmd == 'set':
+        write_shard_albs(client, pool, args.albs)
+        return
+    if shards_cmd == 'place':
+        write_placement(client, pool, args.listener_group, args.alb)
+        return
+
+    shard_map = read_shard_map(client, pool) or ShardMap(pool, [])
+    placement = read_placement(client, shard_map)
+    if shards_cmd == 'rebalance':
+        moves = plan_rebalance(shard_map, placement)
+        for group, target in moves:
+            if args.verbosity >= 1 or args.dry_run:
+                print("{} {} -> {}".format(group.identifier, group.alb, target or '(removed, already placed)'))
+            if not args.dry_run:
+                move_group(client, group, target)
+        if args.verbosity >= 0:
+            total = sum(len(groups) for groups in placement.values())
+            print("{} {} of {} listener groups".format('Would move' if args.dry_run else 'Moved', len(moves), total),
+                  file=sys.stderr)
+        get_shard_map.clear()
+        return
+
+    report = placement_report(shard_map, placement)
+    if args.format == 'json':
+        json.dump({'pool': pool, 'albs': list(shard_map.albs), 'placement': shard_map.placement,
+                   'report': report}, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write("\n")
+        return
+    print(format_report(shard_map, report))
@@ -4,205 +4,625 @@ import logging
 import socket
 import sys
 import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 
 import etcd
 import json
 
+from .shards import resolve_alb, pool_albs
+from .timing import span
 
 logger = logging.getLogger('docker-alb')
 
-
-def load_config():
-    # We use a Python file as the config to make it easier with trailing commas
-    import etcd_config
-    return etcd_config
-
-
-def send_config(client, config, host=None):
+# Keys the ALB uses to decide if a listener or target group exists
+GATE_KEYS = ('port', 'name')
+LEASE_PREFIX = '/leases'
+DEFAULT_LEASE_TTL = 30
+# Seconds a removed target keeps its connections before etcd deletes it, 0 removes it at once
+DEFAULT_DRAIN_TIMEOUT = 30
+# Traffic limits of a listener group and what is done with requests over the per source limits
+LIMIT_NAMES = ('rate', 'conn', 'maxconn')
+LIMIT_ACTIONS = ('deny', 'tarpit')
+# Capacity of a target group, targets may override the per target values
+CAPACITY_NAMES = ('maxconn', 'maxqueue', 'queue_timeout')
+TARGET_CAPACITY_NAMES = ('maxconn', 'maxqueue')
+
+
+class WriteBatch(object):
     """
-
-    :param client:
-    :param config:
-    :param host: Override host for each container.
-    :return:
+    Collects all etcd mutations for a single operation and applies them in one pass.
+
+    Existing values are fetched with one recursive read per entity (listener, listener group,
+    certbot, target group or certificate) and writes with an unchanged value are skipped, so
+    re-registering the same configuration does not bump any indexes or trigger reloads.
+    Parent directories are created implicitly by etcd.
+
+    The etcd v2 API has no multi-key transactions, instead mutations are ordered so readers never see
+    a partial entity: deeper keys (rules, targets) are written before the keys the ALB uses to
+    detect an entity (port, name), and stale keys are only deleted once all new and changed keys are
+    written. Old and new keys of an entity may briefly coexist, but an entity is never seen without
+    them. Recursive deletes remove a whole entity at once.
     """
-    try:
-        client.read("/services")
-    except (etcd.EtcdKeyNotFound, KeyError):
-        client.write("/services", None, dir=True)
-
-    services = {}
-    for service in config:
-        name = service['name']
-        hosts = service.get('hosts')
-        ports = service.get('ports', [80])
-        if name not in services:
-            services[name] = {
-                'name': name,
-                'backends': [],
-            }
-            if hosts:
-                services[name]['hosts'] = hosts
-            if ports:
-                services[name]['ports'] = ports
-        for backend in service.get('backends', []):
-            services[name]['backends'].append(backend)
-
-    for name, service in services.items():
-        backends = service.get('backends', [])
-        if not backends:
-            continue
-        hosts = service.get('hosts')
-        ports = service.get('ports', [80])
+    def __init__(self, client: etcd.Client, mirror: "StateMirror" = None):
+        """
+        :param client: etcd client to apply mutations with.
+        :param mirror: Optional in-memory copy of the state, used instead of reading from etcd.
+        """
+        self.client = client
+        self.mirror = mirror
+        self.writes = OrderedDict()  # type: Dict[str, str]
+        self.deletes = OrderedDict()  # type: Dict[str, bool]
+        self.ttls = {}  # type: Dict[str, int]
+        # Key to keys of which one must exist for the write to happen
+        self.conditions = {}  # type: Dict[str, Tuple[str, ...]]
+        self.written = 0
+        self.deleted = 0
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.writes) + len(self.deletes)
+
+    def write(self, key, value, ttl=None, if_exists=None):
+        """
+        Queue a write of value to key, None is stored as an empty string.
+
+        :param ttl: Seconds until etcd removes the key, None keeps it until it is deleted.
+        :param if_exists: Keys of which at least one must exist for the write to happen.
+        """
+        self.writes[key] = '' if value is None else str(value)
+        for options, option in ((self.ttls, ttl), (self.conditions, tuple(if_exists or ()))):
+            if option:
+                options[key] = option
+            else:
+                options.pop(key, None)
+
+    def delete(self, key, recursive=False):
+        """
+        Queue a delete of key, if recursive is True then all keys below it are removed as well.
+        Writes to the same key or below it that were queued before are dropped, writes queued after
+        the delete take precedence over it. A batch thus ends in the state of its last request.
+        """
+        if recursive:
+            prefix = key + '/'
+            dropped = [written for written in self.writes if written == key or written.startswith(prefix)]
+        else:
+            # Only the key itself, a large batch is not scanned for each delete of a single key
+            dropped = [key] if key in self.writes else []
+        for written in dropped:
+            del self.writes[written]
+            self.ttls.pop(written, None)
+            self.conditions.pop(written, None)
+        self.deletes[key] = self.deletes.get(key, False) or recursive
+
+    def read_existing(self, keys):
+        """
+        Reads current values for all entities touched by keys.
+
+        :return: Dictionary of key to value for all existing leaf keys.
+        """
+        existing = {}
+        for root in sorted(set(entity_root(key) for key in keys)):
+            if self.mirror is not None and self.mirror.covers(root):
+                existing.update(self.mirror.entity(root))
+                continue
+            try:
+                for node in self.client.read(root, recursive=True).leaves:
+                    if not node.dir:
+                        existing[node.key] = node.value
+            except (etcd.EtcdKeyNotFound, KeyError):
+                pass
+        return existing
 
+    def exists(self, key):
+        """
+        Checks a key in etcd itself, keys written with a TTL may have expired since a mirror read them.
+        """
         try:
-            client.read("/services/{name}".format(name=name))
+            self.client.read(key)
+            return True
         except (etcd.EtcdKeyNotFound, KeyError):
-            client.write("/services/{name}".format(name=name), None, dir=True)
-        try:
-            client.read("/services/{name}/backends".format(name=name))
-        except (etcd.EtcdKeyNotFound, KeyError):
-            client.write("/services/{name}/backends".format(name=name), None, dir=True)
-
-        if hosts:
-            client.write("/services/{name}/config".format(name=name), json.dumps({
-                'hosts': hosts,
-                'ports': ports,
-            }))
-        for backend in backends:
-            backend_name = backend.get('name')
-            backend_host = backend['host']
-            if host:
-                backend_host = host
-            if not backend_name:
-                backend_name = backend_host + ':' + backend['port']
+            return False
+
+    def plan(self):
+        """
+        Computes the mutations needed to bring etcd in line with the queued writes and deletes.
+
+        :return: List of (operation, key, value) tuples, operation is either 'delete' or 'write'.
+                 For deletes the value is True if the delete is recursive, None for a directory
+                 which is only removed if it is empty.
+        """
+        if not self.writes and not self.deletes:
+            return []
+        existing = self.read_existing(list(self.writes) + list(self.deletes))
+        mutations = []
+        deletes = []
+
+        # Existing keys by entity, and every directory which holds a written key
+        existing_by_root = {}
+        for existing_key in existing:
+            existing_by_root.setdefault(entity_root(existing_key), []).append(existing_key)
+        parents = ancestor_keys(self.writes)
+
+        # Figure out which existing keys must go, a delete never removes a key which is also written
+        dirs = set()
+        for key, recursive in self.deletes.items():
+            prefix = key + '/'
+            root = entity_root(key)
+            # Keys above an entity, e.g. a whole ALB, span several entities
+            candidates = existing_by_root.get(root, ()) if entity_root(prefix + 'x') == root else existing
+            below = [existing_key for existing_key in candidates if existing_key.startswith(prefix)]
+            if key in self.writes or key in parents:
+                for existing_key in below:
+                    if existing_key not in self.writes:
+                        deletes.append(('delete', existing_key, False))
+                        parts = existing_key[len(prefix):].split('/')
+                        dirs.update(prefix + '/'.join(parts[:depth]) for depth in range(1, len(parts)))
+            elif key in existing or below:
+                deletes.append(('delete', key, recursive))
+
+        # Directories left without keys by the leaf deletes go as well, deepest first
+        remaining = ancestor_keys(set(self.writes).union(existing).difference(mutation[1] for mutation in deletes))
+        deletes.extend(('delete', directory, None) for directory in sorted(dirs, key=lambda d: -d.count('/'))
+                       if directory not in remaining)
+
+        # Stale keys are removed after the writes so the ALB never sees an entity without its rules,
+        # except a value which is in the way of a key written below it, etcd cannot turn it into a directory
+        mutations.extend(mutation for mutation in deletes if mutation[1] in parents)
+        deletes = [mutation for mutation in deletes if mutation[1] not in parents]
+
+        # Entities are written in the order they were queued, within an entity the deepest keys
+        # are written first and the keys which make the entity visible to the ALB last
+        entity_order = {}
+        for key in self.writes:
+            entity_order.setdefault(entity_root(key), len(entity_order))
+
+        def write_order(key):
+            return entity_order[entity_root(key)], key.rsplit('/', 1)[-1] in GATE_KEYS, -key.count('/')
+
+        for key in sorted(self.writes, key=write_order):
+            value = self.writes[key]
+            if existing.get(key) == value:
+                self.skipped += 1
+                continue
+            if key in self.conditions and not any(self.exists(condition) for condition in self.conditions[key]):
+                continue
+            mutations.append(('write', key, value))
+        return mutations + deletes
+
+    def apply(self, mutations=None):
+        """
+        Applies all queued mutations and clears the batch.
+
+        :param mutations: Mutations previously returned by plan(), if None a new plan is made.
+        :return: Number of mutations sent to etcd.
+        """
+        if mutations is None:
+            mutations = self.plan()
+        for operation, key, value in mutations:
+            if operation == 'write':
+                if key in self.ttls:
+                    self.client.write(key, value, ttl=self.ttls[key])
+                else:
+                    self.client.write(key, value)
+                self.written += 1
+            else:
+                try:
+                    if value:
+                        self.client.delete(key, recursive=True, dir=True)
+                    elif value is None:
+                        self.client.delete(key, dir=True)
+                    else:
+                        self.client.delete(key)
+                    self.deleted += 1
+                except (etcd.EtcdKeyNotFound, etcd.EtcdDirNotEmpty, KeyError):
+                    pass
+            if self.mirror is not None:
+                self.mirror.update(operation, key, value)
+
+        self.writes.clear()
+        self.deletes.clear()
+        self.ttls.clear()
+        self.conditions.clear()
+        return len(mutations)
+
+
+class StateMirror(object):
+    def __init__(self, client: etcd.Client, prefixes):
+        """
+        In-memory copy of the registration state below a set of key prefixes, kept up to date by the
+        batches applied with it. Lets a long-running process skip the reads before each write.
+
+        :param client: etcd client used to load the state.
+        :param prefixes: Key prefixes to mirror, e.g. /alb/vhost and /target_group.
+        """
+        self.client = client
+        self.prefixes = tuple(prefix.rstrip('/') for prefix in prefixes)
+        self.entities = {}  # type: Dict[str, Dict[str, str]]
+        self.loaded = None
+
+    def load(self):
+        """
+        Reads all mirrored prefixes from etcd, one recursive read per prefix.
+        """
+        entities = {}
+        for prefix in self.prefixes:
             try:
-                client.read("/services/{name}/backends/{backend}".format(name=name, backend=backend_name))
+                for node in self.client.read(prefix, recursive=True).leaves:
+                    if not node.dir:
+                        entities.setdefault(entity_root(node.key), {})[node.key] = node.value
             except (etcd.EtcdKeyNotFound, KeyError):
-                client.write("/services/{name}/backends/{backend}".format(name=name, backend=backend_name), None, dir=True)
-            client.write("/services/{name}/backends/{backend}/config".format(
-                name=name, backend=backend_name), json.dumps({
-                    'host': backend_host,
-                    'port': backend['port'],
-                }))
+                pass
+        self.entities = entities
+        self.loaded = time.time()
+
+    def covers(self, key):
+        return self.loaded is not None and any(key == prefix or key.startswith(prefix + '/')
+                                               for prefix in self.prefixes)
+
+    def entity(self, root):
+        return self.entities.get(root, {})
+
+    def update(self, operation, key, value):
+        """
+        Records a mutation which has been applied to etcd.
+        """
+        if not self.covers(key):
+            return
+        root = entity_root(key)
+        if operation == 'write':
+            self.entities.setdefault(root, {})[key] = value
+            return
+        prefix = key + '/'
+        for entity_key in [entity_key for entity_key in self.entities if entity_key == key or
+                           entity_key.startswith(prefix)]:
+            del self.entities[entity_key]
+        values = self.entities.get(root)
+        if values:
+            for value_key in [value_key for value_key in values if value_key == key or
+                              value_key.startswith(prefix)]:
+                del values[value_key]
+
+
+def ancestor_keys(keys):
+    """
+    Returns the directories which hold keys, at every depth.
+    """
+    ancestors = set()
+    for key in keys:
+        parts = key.split('/')
+        ancestors.update('/'.join(parts[:depth]) for depth in range(1, len(parts)))
+    return ancestors
+
+
+def entity_root(key):
+    """
+    Returns the key of the entity which contains key, e.g. the listener for a rule or the
+    target group for a target.
+    """
+    parts = key.strip('/').split('/')
+    depth = 4 if parts[0] == 'alb' else 2
+    return '/' + '/'.join(parts[:depth])
+
+
+@contextmanager
+def write_batch(client):
+    """
+    Context manager which yields a WriteBatch and applies it on exit.
+    If client is already a batch then mutations are added to it and it is left for the owner to apply.
+    """
+    if isinstance(client, WriteBatch):
+        yield client
+        return
+    batch = WriteBatch(client)
+    yield batch
+    batch.apply()
+
 
+DEFAULT_HEALTH_CHECK = {
+    'protocol': 'http',
+    'path': '/',
+    # traffic port is the port of the first target
+    'port': 'traffic',
+    'healthy': 2,
+    'unhealthy': 10,
+    'timeout': 4,
+    'interval': 5,
+    'success': 200,
+}
 
-def register_target_group(client: etcd.Client, identifier, name, targets, protocol="http"):
+
+def lease_path(lease):
+    return "{prefix}/{lease}".format(prefix=LEASE_PREFIX, lease=lease)
+
+
+def target_key(identifier, target, lease=None):
+    """
+    Returns the key for a target in a target group, leased targets are stored below the lease.
+    """
+    name = "{}:{}".format(target['host'], target['port'])
+    if lease:
+        return "{lease_path}/targets/{identifier}/{name}".format(lease_path=lease_path(lease), identifier=identifier,
+                                                                name=name)
+    return "/target_group/{identifier}/targets/{name}".format(identifier=identifier, name=name)
+
+
+def keep_lease_alive(client: etcd.Client, lease, ttl=DEFAULT_LEASE_TTL):
+    """
+    Creates a lease or refreshes its TTL. A lease is a directory with a TTL, when it expires etcd
+    removes it together with all targets registered under it. Refreshing costs a single request
+    no matter how many targets the lease holds, so one lease per host is enough.
+
+    :return: True if the lease was refreshed, False if it had expired (or never existed) and was created.
+    """
+    key = lease_path(lease)
     try:
-        client.read("/target_group/{identifier}".format(identifier=identifier))
-    except (etcd.EtcdKeyNotFound, KeyError):
-        client.write("/target_group/{identifier}".format(identifier=identifier), None, dir=True)
-    client.write("/target_group/{identifier}/name".format(identifier=identifier), name)
-    client.write("/target_group/{identifier}/id".format(identifier=identifier), identifier)
-    # only http for now
-    client.write("/target_group/{identifier}/protocol".format(identifier=identifier), 'http')
-    # Health check config is hardcoded for now
-    client.write("/target_group/{identifier}/healthcheck".format(identifier=identifier), json.dumps({
-        'protocol': 'http',
-        'path': '/',
-        # traffic port is the port of the first target
-        'port': 'traffic',
-        'healthy': 2,
-        'unhealthy': 10,
-        'timeout': 4,
-        'interval': 5,
-        'success': 200,
-    }))
+        client.write(key, None, ttl=ttl, dir=True, prevExist=True, refresh=True)
+        return True
+    except etcd.EtcdKeyNotFound:
+        pass
+    try:
+        client.write(key, None, ttl=ttl, dir=True, prevExist=False)
+    except etcd.EtcdAlreadyExist:
+        # Someone else created it in the meantime
+        client.write(key, None, ttl=ttl, dir=True, prevExist=True, refresh=True)
+    return False
+
 
+def count_lease_targets(client: etcd.Client, lease):
     try:
-        client.read("/target_group/{identifier}/targets".format(identifier=identifier))
+        return sum(1 for node in client.read(lease_path(lease) + '/targets', recursive=True).leaves if not node.dir)
     except (etcd.EtcdKeyNotFound, KeyError):
-        client.write("/target_group/{identifier}/targets".format(identifier=identifier), None, dir=True)
-    for target in targets:
-        host = target['host']
-        port = target['port']
-        alb = target.get('alb')
-        # TODO: If the target is an ALB, then we need to register this ALB as the listener
-        # in the target ALB. We also need to transfer any rules from the target to the listener
-        client.write(
-            "/target_group/{identifier}/targets/{name}".format(identifier=identifier, name="{}:{}".format(host, port)),
-            json.dumps({
-                'host': host,
-                'port': port,
-            }))
+        return 0
+
+
+def target_value(target, draining=False):
+    """
+    Returns the value stored for a target, a draining target gets no new requests.
+    """
+    config = {
+        'host': target['host'],
+        'port': target['port'],
+    }
+    config.update(normalize_capacity(target, names=TARGET_CAPACITY_NAMES) or {})
+    if draining:
+        config['draining'] = True
+    return json.dumps(config)
+
+
+def register_target_group(client: etcd.Client, identifier, name, targets, protocol="http", health_check=None,
+                          lease=None, capacity=None, slowstart=None):
+    """
+    :param targets: List of dicts with host and port, and optionally maxconn and maxqueue for the target.
+    :param lease: Name of lease to register targets under, the targets expire with the lease.
+    :param capacity: Capacity as returned by normalize_capacity, None removes any capacity settings.
+    :param slowstart: Seconds over which new targets ramp up to full weight, None or 0 to disable.
+    """
+    with write_batch(client) as batch:
+        # Targets are queued first so leased targets are in place before the target group appears
+        for target in targets:
+            alb = target.get('alb')
+            # TODO: If the target is an ALB, then we need to register this ALB as the listener
+            # in the target ALB. We also need to transfer any rules from the target to the listener
+            # Written without a TTL, which also ends a drain of the target
+            batch.write(target_key(identifier, target, lease=lease), target_value(target))
+
+        batch.write("/target_group/{identifier}/name".format(identifier=identifier), name)
+        batch.write("/target_group/{identifier}/id".format(identifier=identifier), identifier)
+        # only http for now
+        batch.write("/target_group/{identifier}/protocol".format(identifier=identifier), 'http')
+        batch.write("/target_group/{identifier}/healthcheck".format(identifier=identifier),
+                    json.dumps(health_check or DEFAULT_HEALTH_CHECK, sort_keys=True))
+        if capacity:
+            batch.write("/target_group/{identifier}/capacity".format(identifier=identifier),
+                        json.dumps(capacity, sort_keys=True))
+        else:
+            batch.delete("/target_group/{identifier}/capacity".format(identifier=identifier))
+        if slowstart:
+            batch.write("/target_group/{identifier}/slowstart".format(identifier=identifier), slowstart)
+        else:
+            batch.delete("/target_group/{identifier}/slowstart".format(identifier=identifier))
 
 
-def unregister_targets(client: etcd.Client, identifier, targets):
+def unregister_targets(client: etcd.Client, identifier, targets, lease=None, drain_timeout=None):
+    """
+    :param drain_timeout: Seconds to drain the targets before they are removed, None or 0 removes them at once.
+    """
+    if drain_timeout:
+        drain_targets(client, identifier, targets, drain_timeout, lease=lease)
+        return
+    with write_batch(client) as batch:
+        for target in targets:
+            alb = target.get('alb')
+            batch.delete(target_key(identifier, target))
+            if lease:
+                batch.delete(target_key(identifier, target, lease=lease))
+
+
+def has_other_targets(client: etcd.Client, identifier, targets, lease=None):
+    """
+    Checks if a target group has targets besides the given ones, registered directly or under any lease.
+    Targets which are draining are not counted, they are on their way out.
+
+    :param lease: Name of lease the given targets were registered under, if any.
+    """
+    own = {target_key(identifier, target) for target in targets}
+    if lease:
+        own.update(target_key(identifier, target, lease=lease) for target in targets)
+    nodes = []
     try:
-        client.read("/target_group/{identifier}/targets".format(identifier=identifier))
+        nodes.extend(client.read("/target_group/{identifier}/targets".format(identifier=identifier),
+                                 recursive=True).leaves)
     except (etcd.EtcdKeyNotFound, KeyError):
-        return
-    for target in targets:
-        host = target['host']
-        port = target['port']
-        alb = target.get('alb')
+        pass
+    try:
+        for node in client.read(LEASE_PREFIX, recursive=True).leaves:
+            # leases/<lease>/targets/<target group>/<host:port>
+            parts = node.key[1:].split("/")
+            if len(parts) == 5 and parts[2] == 'targets' and parts[3] == identifier:
+                nodes.append(node)
+    except (etcd.EtcdKeyNotFound, KeyError):
+        pass
+    for node in nodes:
+        if node.dir or node.key in own:
+            continue
         try:
-            client.delete("/target_group/{identifier}/targets/{name}".format(identifier=identifier,
-                                                                             name="{}:{}".format(host, port)))
-        except (etcd.EtcdKeyNotFound, KeyError):
+            if json.loads(node.value).get('draining') is True:
+                continue
+        except (TypeError, ValueError, AttributeError):
             pass
+        return True
+    return False
+
+
+def drain_targets(client: etcd.Client, identifier, targets, drain_timeout=DEFAULT_DRAIN_TIMEOUT, lease=None):
+    """
+    Marks targets as draining, haproxy keeps their connections but sends them no new requests.
+    The target is moved out of the lease and written with a TTL, etcd removes it after drain_timeout
+    seconds. Targets which are not registered are left alone.
+    """
+    with write_batch(client) as batch:
+        for target in targets:
+            key = target_key(identifier, target)
+            leased_key = target_key(identifier, target, lease=lease) if lease else None
+            batch.write(key, target_value(target, draining=True), ttl=drain_timeout,
+                        if_exists=(key, leased_key) if lease else (key,))
+            if lease:
+                batch.delete(leased_key)
+
+
+def undrain_targets(client: etcd.Client, identifier, targets, lease=None):
+    """
+    Puts draining targets back in service before etcd removes them, other targets are left alone.
+    """
+    with write_batch(client) as batch:
+        for target in targets:
+            key = target_key(identifier, target)
+            if lease:
+                batch.write(target_key(identifier, target, lease=lease), target_value(target), if_exists=(key,))
+                batch.delete(key)
+            else:
+                batch.write(key, target_value(target), if_exists=(key,))
 
 
 def remove_listener(client: etcd.Client, alb, identifier):
-    try:
-        client.delete("/alb/{alb}/listeners/{identifier}".format(alb=alb, identifier=identifier), recursive=True)
-    except (etcd.EtcdKeyNotFound, KeyError):
-        pass
+    with write_batch(client) as batch:
+        batch.delete("/alb/{alb}/listeners/{identifier}".format(alb=alb, identifier=identifier), recursive=True)
 
 
 def register_listener(client: etcd.Client, alb, identifier, name, port, protocol, rules, certificate_name=None):
-    try:
-        client.read("/alb/{alb}/listeners/{identifier}".format(alb=alb, identifier=identifier))
-    except (etcd.EtcdKeyNotFound, KeyError):
-        client.write("/alb/{alb}/listeners/{identifier}".format(alb=alb, identifier=identifier), None, dir=True)
-    client.write("/alb/{alb}/listeners/{identifier}/name".format(alb=alb, identifier=identifier), name)
-    client.write("/alb/{alb}/listeners/{identifier}/protocol".format(alb=alb, identifier=identifier), protocol)
-    client.write("/alb/{alb}/listeners/{identifier}/port".format(alb=alb, identifier=identifier), port)
-    client.write("/alb/{alb}/listeners/{identifier}/certificate_name".format(alb=alb, identifier=identifier),
-                 certificate_name)
-    try:
-        client.read("/alb/{alb}/listeners/{identifier}/rules".format(alb=alb, identifier=identifier))
-    except (etcd.EtcdKeyNotFound, KeyError):
-        client.write("/alb/{alb}/listeners/{identifier}/rules".format(alb=alb, identifier=identifier), None, dir=True)
-
-    for rule in rules:
-        rule_id = rule['id']
-        rule_host = rule.get('host')
-        rule_path = rule.get('path')
-        action = rule.get('action')
-        try:
-            client.read(
-                "/alb/{alb}/listeners/{identifier}/rules/{rule}".format(alb=alb, identifier=identifier, rule=rule_id))
-        except (etcd.EtcdKeyNotFound, KeyError):
-            client.write(
-                "/alb/{alb}/listeners/{identifier}/rules/{rule}".format(alb=alb, identifier=identifier, rule=rule_id),
-                None, dir=True)
-        client.write(
-            "/alb/{alb}/listeners/{identifier}/rules/{rule}/config".format(
-                alb=alb, identifier=identifier, rule=rule_id),
-            json.dumps({
-                'host': rule_host,
-                'path': rule_path,
-                'action': action,
-            }))
+    with write_batch(client) as batch:
+        listener_path = "/alb/{alb}/listeners/{identifier}".format(alb=alb, identifier=identifier)
+        batch.write(listener_path + "/name", name)
+        batch.write(listener_path + "/protocol", protocol)
+        batch.write(listener_path + "/port", port)
+        batch.write(listener_path + "/certificate_name", certificate_name)
+
+        for rule in rules:
+            rule_id = rule['id']
+            rule_host = rule.get('host')
+            rule_path = rule.get('path')
+            action = rule.get('action')
+            batch.write(
+                listener_path + "/rules/{rule}/config".format(rule=rule_id),
+                json.dumps({
+                    'host': rule_host,
+                    'path': rule_path,
+                    'action': action,
+                }))
 
 
 def register_listener_group(client: etcd.Client, alb, listener_id, domains=None, listeners=None,
-                            certificate_name=None, use_certbot=False):
+                            certificate_name=None, use_certbot=False, limits=None):
+    """
+    :param limits: Traffic limits as returned by normalize_limits, None removes any limits.
+    """
+    with write_batch(client) as batch:
+        lg_path = "/alb/{alb}/listener_groups/{identifier}".format(alb=alb, identifier=listener_id)
+        # batch.write(lg_path + "/name", name)
+        batch.write(lg_path + "/domains", json.dumps(domains))
+        batch.write(lg_path + "/listeners", json.dumps(listeners))
+        batch.write(lg_path + "/certificate_name", certificate_name)
+        batch.write(lg_path + "/certbot_managed", 'true' if use_certbot else 'false')
+        if limits:
+            batch.write(lg_path + "/limits", json.dumps(limits, sort_keys=True))
+        else:
+            batch.delete(lg_path + "/limits")
+
+
+def normalize_limits(limits):
+    """
+    Validates traffic limits for a listener group.
+
+    :param limits: Dictionary with rate (requests per second per source IP), conn (concurrent connections
+                   per source IP), maxconn (concurrent connections for the group) and action (deny or
+                   tarpit). Unset or zero values mean no limit.
+    :return: Dictionary with the limits that are set, or None if there are none.
+    :raises ValueError: If a limit is not a positive number or the action is unknown.
+    """
+    if not limits:
+        return None
+    normalized = positive_ints(limits, LIMIT_NAMES, 'Limit')
+    if not normalized:
+        return None
+    action = limits.get('action') or 'deny'
+    if action not in LIMIT_ACTIONS:
+        raise ValueError("Limit action '{}' must be one of {}".format(action, ', '.join(LIMIT_ACTIONS)))
+    normalized['action'] = action
+    return normalized
+
+
+def normalize_capacity(capacity, names=CAPACITY_NAMES):
+    """
+    Validates the capacity of a target group, or with names=TARGET_CAPACITY_NAMES the overrides of a target.
+
+    :param capacity: Dictionary with maxconn (concurrent requests per target), maxqueue (requests queued
+                     per target) and queue_timeout (seconds in the queue). Unset or zero values mean no limit.
+    :return: Dictionary with the values that are set, or None if there are none.
+    :raises ValueError: If a value is not a positive number.
+    """
+    if not capacity:
+        return None
+    return positive_ints(capacity, names, 'Capacity') or None
+
+
+def normalize_seconds(value, name):
+    """
+    :return: Number of seconds, or None if value is unset.
+    :raises ValueError: If value is not a number or is negative.
+    """
+    if value in (None, ''):
+        return None
     try:
-        client.read("/alb/{alb}/listener_groups/{identifier}".format(alb=alb, identifier=listener_id))
-    except (etcd.EtcdKeyNotFound, KeyError):
-        client.write("/alb/{alb}/listener_groups/{identifier}".format(alb=alb, identifier=listener_id), None, dir=True)
-    # client.write("/alb/{alb}/listener_groups/{identifier}/name".format(alb=alb, identifier=listener_id), name)
-    client.write("/alb/{alb}/listener_groups/{identifier}/domains".format(alb=alb, identifier=listener_id),
-                 json.dumps(domains))
-    client.write("/alb/{alb}/listener_groups/{identifier}/listeners".format(alb=alb, identifier=listener_id),
-                 json.dumps(listeners))
-    client.write("/alb/{alb}/listener_groups/{identifier}/certificate_name".format(alb=alb, identifier=listener_id),
-                 certificate_name)
-    client.write("/alb/{alb}/listener_groups/{identifier}/certbot_managed".format(alb=alb, identifier=listener_id),
-                 'true' if use_certbot else 'false')
+        seconds = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("{} must be a number of seconds, got '{}'".format(name, value))
+    if seconds < 0:
+        raise ValueError("{} must not be negative".format(name))
+    return seconds
+
+
+def positive_ints(values, names, kind):
+    """
+    :return: Dictionary of the names which are set to a number above zero in values.
+    :raises ValueError: If a value is not a number or is negative.
+    """
+    normalized = {}
+    for name in names:
+        value = values.get(name)
+        if value in (None, ''):
+            continue
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError("{} {} must be a number, got '{}'".format(kind, name, value))
+        if value < 0:
+            raise ValueError("{} {} must not be negative".format(kind, name))
+        if value:
+            normalized[name] = value
+    return normalized
 
 
 def register_certbot(client: etcd.Client, alb, listener_id, domains, target, certificate_name=None):
@@ -210,32 +630,22 @@ def register_certbot(client: etcd.Client, alb, listener_id, domains, target, cer
     Register a certbot for a given listener, this creates special rules for
     this listener for allowing the certbot to verify the domain.
     """
-    try:
-        client.read("/alb/{alb}/certbot/{identifier}".format(alb=alb, identifier=listener_id))
-    except (etcd.EtcdKeyNotFound, KeyError):
-        client.write("/alb/{alb}/certbot/{identifier}".format(alb=alb, identifier=listener_id), None, dir=True)
-    client.write("/alb/{alb}/certbot/{identifier}/enabled".format(alb=alb, identifier=listener_id),
-                 'true')
-    client.write("/alb/{alb}/certbot/{identifier}/ready".format(alb=alb, identifier=listener_id),
-                 'false')
-    client.write("/alb/{alb}/certbot/{identifier}/certificate_name".format(alb=alb, identifier=listener_id),
-                 certificate_name)
-    client.write("/alb/{alb}/certbot/{identifier}/domains".format(alb=alb, identifier=listener_id),
-                 json.dumps(domains))
-    client.write("/alb/{alb}/certbot/{identifier}/target".format(alb=alb, identifier=listener_id),
-                 json.dumps(target))
+    with write_batch(client) as batch:
+        certbot_path = "/alb/{alb}/certbot/{identifier}".format(alb=alb, identifier=listener_id)
+        batch.write(certbot_path + "/enabled", 'true')
+        batch.write(certbot_path + "/ready", 'false')
+        batch.write(certbot_path + "/certificate_name", certificate_name)
+        batch.write(certbot_path + "/domains", json.dumps(domains))
+        batch.write(certbot_path + "/target", json.dumps(target))
 
 
 def mark_certbot_ready(client: etcd.Client, alb, cerbot_id, is_ready=True):
     """
     Tell system a certbot is ready
     """
-    try:
-        client.read("/alb/{alb}/certbot/{identifier}".format(alb=alb, identifier=cerbot_id))
-    except (etcd.EtcdKeyNotFound, KeyError):
-        client.write("/alb/{alb}/certbot/{identifier}".format(alb=alb, identifier=cerbot_id), None, dir=True)
-    client.write("/alb/{alb}/certbot/{identifier}/ready".format(alb=alb, identifier=cerbot_id),
-                 'true' if is_ready else 'false')
+    with write_batch(client) as batch:
+        batch.write("/alb/{alb}/certbot/{identifier}/ready".format(alb=alb, identifier=cerbot_id),
+                    'true' if is_ready else 'false')
 
 
 def wait_certbot_ready(client: etcd.Client, alb, listener_id):
@@ -254,11 +664,8 @@ def unregister_certbot(client: etcd.Client, alb, listener_id):
     Removes a registered certbot for a given listener. If no certbot has been previously registered
     nothing happens.
     """
-    try:
-        client.delete("/alb/{alb}/certbot/{identifier}".format(alb=alb, identifier=listener_id), recursive=True,
-                      dir=True)
-    except KeyError as e:
-        logger.exception("Failed to unregister certbot: %s: %s", type(e).__name__, e)
+    with write_batch(client) as batch:
+        batch.delete("/alb/{alb}/certbot/{identifier}".format(alb=alb, identifier=listener_id), recursive=True)
 
 
 def has_certificate(client: etcd.Client, certificate_name: str):
@@ -277,27 +684,16 @@ def register_certificate(client: etcd.Client, certificate_name: str, domains: li
     """
     Register a certificate with optional data, domains, email and modification date.
     """
-    try:
-        client.read("/certs/{name}".format(name=certificate_name))
-    except (etcd.EtcdKeyNotFound, KeyError):
-        client.write("/certs/{name}".format(name=certificate_name), None, dir=True)
-    client.write("/certs/{name}/email".format(name=certificate_name),
-                 email)
-    client.write("/certs/{name}/data".format(name=certificate_name),
-                 data)
-    if not modified:
-        modified = datetime.now()
-    client.write("/certs/{name}/modified".format(name=certificate_name),
-                 modified.isoformat())
-    client.write("/certs/{name}/domains".format(name=certificate_name),
-                 json.dumps(domains))
-    # TODO: Verify certificate data with ssl
-    if data:
-        client.write("/certs/{name}/is_valid".format(name=certificate_name),
-                     'true')
-    else:
-        client.write("/certs/{name}/is_valid".format(name=certificate_name),
-                     'false')
+    with write_batch(client) as batch:
+        cert_path = "/certs/{name}".format(name=certificate_name)
+        batch.write(cert_path + "/email", email)
+        batch.write(cert_path + "/data", data)
+        if not modified:
+            modified = datetime.now()
+        batch.write(cert_path + "/modified", modified.isoformat())
+        batch.write(cert_path + "/domains", json.dumps(domains))
+        # TODO: Verify certificate data with ssl
+        batch.write(cert_path + "/is_valid", 'true' if data else 'false')
 
 
 def unregister_certificate(client: etcd.Client, certificate_name: str):
@@ -305,75 +701,34 @@ def unregister_certificate(client: etcd.Client, certificate_name: str):
     Removes a registered certificate. If no certificate has been previously registered
     nothing happens.
     """
-    try:
-        client.delete("/certs/{name}".format(name=certificate_name), recursive=True,
-                      dir=True)
-    except KeyError:
-        pass
+    with write_batch(client) as batch:
+        batch.delete("/certs/{name}".format(name=certificate_name), recursive=True)
 
 
 def upload_certificate_file(client: etcd.Client, certificate_name, certificate_file, modified: datetime = None):
-    try:
-        client.read("/certs/{cert_name}".format(cert_name=certificate_name))
-    except (etcd.EtcdKeyNotFound, KeyError):
-        client.write("/certs/{cert_name}".format(cert_name=certificate_name), None, dir=True)
     if isinstance(certificate_file, str):
         with open(certificate_file) as cert_fh:
             certificate_content = cert_fh.read()
     else:
         certificate_content = certificate_file.read()
-    client.write("/certs/{cert_name}/cert".format(cert_name=certificate_name), certificate_content)
-    if not modified:
-        modified = datetime.now()
-    client.write("/certs/{name}/modified".format(name=certificate_name),
-                 modified.isoformat())
-    # TODO: Verify certificate data with ssl
-    if certificate_content:
-        client.write("/certs/{name}/is_valid".format(name=certificate_name),
-                     'true')
-    else:
-        client.write("/certs/{name}/is_valid".format(name=certificate_name),
-                     'false')
+    upload_certificate_data(client, certificate_name, certificate_content, modified=modified)
 
 
-def upload_certificate_data(client: etcd.Client, certificate_name, data, modified: datetime = None):
-    try:
-        client.read("/certs/{cert_name}".format(cert_name=certificate_name))
-    except (etcd.EtcdKeyNotFound, KeyError):
-        client.write("/certs/{cert_name}".format(cert_name=certificate_name), None, dir=True)
-    client.write("/certs/{cert_name}/cert".format(cert_name=certificate_name), data)
-    if not modified:
-        modified = datetime.now()
-    client.write("/certs/{name}/modified".format(name=certificate_name),
-                 modified.isoformat())
-    # TODO: Verify certificate data with ssl
-    if data:
-        client.write("/certs/{name}/is_valid".format(name=certificate_name),
-                     'true')
-    else:
-        client.write("/certs/{name}/is_valid".format(name=certificate_name),
-                     'false')
-
-
-def auto_register_docker(args):
-    etcd_host = os.environ.get("ETCD_HOST", args.etcd_host)
-    backend_host = os.environ.get("HOST_IP")
-    if not etcd_host:
-        logger.error("ETCD_HOST not set")
-        sys.exit(1)
-
-    port = 4001
-    host = etcd_host
-
-    if ":" in etcd_host:
-        host, port = etcd_host.split(":")
-
-    sys.path.insert(0, '/tmp')
-
-    client = etcd.Client(host=host, port=int(port))
-
-    config_module = load_config()
-    send_config(client, config_module.services, host=backend_host)
+def upload_certificate_data(client: etcd.Client, certificate_name, data, modified: datetime = None,
+                            domains: list = None):
+    """
+    Stores new data for a certificate, domains replaces the stored domains if the certificate now covers others.
+    """
+    with write_batch(client) as batch:
+        cert_path = "/certs/{cert_name}".format(cert_name=certificate_name)
+        batch.write(cert_path + "/cert", data)
+        if not modified:
+            modified = datetime.now()
+        batch.write(cert_path + "/modified", modified.isoformat())
+        if domains is not None:
+            batch.write(cert_path + "/domains", json.dumps(domains))
+        # TODO: Verify certificate data with ssl
+        batch.write(cert_path + "/is_valid", 'true' if data else 'false')
 
 
 def etcd_client(etcd_host=None):
@@ -407,16 +762,102 @@ def register_vhost(args):
     main_domain = listener_domains[0]
     tg_id = args.id or ('vhost-' + main_domain)
     listener_id = tg_id
-    tg_name = 'VirtualHost: ' + main_domain
-    alb_identifier = 'vhost'
+    alb_identifier = os.environ.get('ALB_ID', args.alb_id)
 
     certificate = args.certificate
     certificate_name = args.certificate_name or listener_id
     use_certbot = args.certbot
+    limits = {'rate': args.rate_limit, 'conn': args.conn_limit, 'maxconn': args.max_connections,
+              'action': args.limit_action}
+    capacity = {'maxconn': args.target_maxconn, 'maxqueue': args.target_maxqueue,
+                'queue_timeout': args.queue_timeout}
+    lease = None
+    if args.ttl:
+        lease = args.lease or socket.gethostname()
+
+    try:
+        with span('parse_targets', targets=args.target.count(',') + 1):
+            targets, removed_targets = parse_targets(args.target, dockerhost_ip=dockerhost_ip)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        if lease:
+            with span('keep_lease_alive', lease=lease):
+                keep_lease_alive(client, lease, ttl=args.ttl)
+        with span('register_vhost_config', vhost=tg_id):
+            register_vhost_config(client, alb=alb_identifier, identifier=tg_id, domains=listener_domains,
+                                  port_mode=listener_port, targets=targets, removed_targets=removed_targets,
+                                  certificate_name=certificate_name, use_certbot=use_certbot,
+                                  certificate=certificate, lease=lease, limits=limits, capacity=capacity,
+                                  slowstart=args.slowstart, drain_timeout=args.drain_timeout)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
 
+
+def drain_vhost(args):
+    """
+    Drains targets of a virtual-host with 'listener drain', or puts them back with 'listener undrain'.
+    """
+    client = etcd_client(args.etcd_host)
+    main_domain = args.virtual_host.split(",")[0]
+    tg_id = args.id or ('vhost-' + main_domain)
+    try:
+        targets, removed_targets = parse_targets(args.target, dockerhost_ip=os.environ.get("DOCKERHOST_IP"))
+        if args.listener_cmd == 'drain':
+            drain_timeout = normalize_seconds(args.drain_timeout, 'Drain timeout')
+            unregister_targets(client, tg_id, targets + removed_targets, lease=args.lease,
+                               drain_timeout=drain_timeout)
+        else:
+            undrain_targets(client, tg_id, targets + removed_targets, lease=args.lease)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+def heartbeat(args):
+    """
+    Keeps the lease for this host alive, targets registered with --ttl expire if this stops.
+    """
+    client = etcd_client(args.etcd_host)
+    lease = args.lease or socket.gethostname()
+    interval = args.interval or max(1.0, args.ttl / 3.0)
+    while True:
+        start = time.perf_counter()
+        requests = 1
+        try:
+            with span('keep_lease_alive', lease=lease):
+                alive = keep_lease_alive(client, lease, ttl=args.ttl)
+            if not alive:
+                requests += 1
+                logger.warning("Lease %s was missing, targets must be registered again", lease)
+            elapsed = (time.perf_counter() - start) * 1000
+            if args.verbosity >= 1:
+                # Counting needs an extra read so it is only done when the result is shown
+                count = count_lease_targets(client, lease)
+                logger.info("Lease %s refreshed with %d requests in %.1f ms, %d targets, %.3f ms per 1000 targets",
+                            lease, requests, elapsed, count, elapsed * 1000 / count if count else 0.0)
+        except etcd.EtcdException as e:
+            logger.error("Failed to refresh lease %s: %s", lease, e)
+        if args.once:
+            return
+        time.sleep(interval)
+
+
+def parse_targets(target_spec, dockerhost_ip=None, resolve=socket.gethostbyname):
+    """
+    Parses a comma separated list of targets, either <host>:<port> or just <host> which
+    defaults to port 80. Targets prefixed with - are to be removed.
+
+    :param dockerhost_ip: IP to use for the special host dockerhost.
+    :param resolve: Function which turns a hostname in to an IP address.
+    :return: Tuple of targets to add and targets to remove, each a list of dicts with host and port.
+    """
     targets = []
     removed_targets = []
-    for target in args.target.split(","):  # type: str
+    for target in target_spec.split(","):  # type: str
         host, port = (target.split(":", 1) + ["80"])[0:2]
         to_remove = False
         if host[:1] == '-':
@@ -428,11 +869,10 @@ def register_vhost(args):
         if host == 'dockerhost':
             # Special case which exposes the dockerhost ip
             if not dockerhost_ip:
-                print("No docker host IP set, please set env DOCKERHOST_IP", file=sys.stderr)
-                sys.exit(1)
+                raise ValueError("No docker host IP set, please set env DOCKERHOST_IP")
             host = dockerhost_ip
         else:
-            host = socket.gethostbyname(host)
+            host = resolve(host)
         if to_remove:
             removed_targets.append({
                 'host': host,
@@ -443,119 +883,177 @@ def register_vhost(args):
                 'host': host,
                 'port': port,
             })
+    return targets, removed_targets
 
-    # Remove targets from target group
-    unregister_targets(client, identifier=tg_id, targets=removed_targets)
 
-    # First the target group which will receive the requests
-    register_target_group(client, identifier=tg_id, name=tg_name, targets=targets)
+def vhost_listener_ids(main_domain, port_mode):
+    """
+    Returns the identifiers of the listeners used for a virtual-host with the given port mode.
+    """
+    port_num = parse_port_mode(port_mode)
+    if port_mode == 'http':
+        return ['http-' + main_domain]
+    elif port_mode in ('https', 'mixed'):
+        return ['https-' + main_domain, 'http-' + main_domain]
+    return ['custom-{}-{}'.format(port_num, main_domain)]
 
-    # Then setup listeners for all incoming ports, each listener has a set of
-    # rules made from the registered domains. Each domain may also have a path
-    # specified.
-    listener_port_num = None
-    try:
-        listener_port_num = int(listener_port)
-        if listener_port_num == 80:
-            listener_port = 'http'
-        elif listener_port_num == 443:
-            listener_port = 'https'
-    except ValueError:
-        pass
 
-    listeners = []
-    if listener_port == 'http':
-        remove_listener(client, alb=alb_identifier, identifier='http-' + main_domain)
-        remove_listener(client, alb=alb_identifier, identifier='https-' + main_domain)
-        rules = []
-        for domain in listener_domains:
-            domain, path = (domain.split('/', 1) + [None])[0:2]
-            rules.append({
-                'id': 'vhost-' + domain,
-                'host': domain,
-                'path': path,
-                'action': 'tg:' + tg_id,
-            })
-        register_listener(client, alb=alb_identifier, identifier='http-' + main_domain, name='HTTP 80', port=80,
-                          protocol='http', rules=rules)
-        listeners.append('http-' + main_domain)
-    elif listener_port == 'https':
-        remove_listener(client, alb=alb_identifier, identifier='http-' + main_domain)
-        remove_listener(client, alb=alb_identifier, identifier='https-' + main_domain)
-        https_rules = []
-        http_rules = []
-        for domain in listener_domains:
+def parse_port_mode(port_mode):
+    """
+    Normalizes the port mode of a virtual-host, port 80 and 443 are turned into http and https.
+
+    :return: The port number for a custom port, otherwise None.
+    :raises ValueError: If the port mode is not a number or one of http, https and mixed.
+    """
+    if port_mode in ('http', 'https', 'mixed'):
+        return None
+    try:
+        return int(port_mode)
+    except (TypeError, ValueError):
+        raise ValueError("Listener port number '{}' must be a number or one of 'http', 'https', 'mixed'".format(
+            port_mode))
+
+
+def normalize_port_mode(port_mode):
+    port_num = parse_port_mode(port_mode)
+    if port_num == 80:
+        return 'http'
+    elif port_num == 443:
+        return 'https'
+    elif port_num is not None:
+        return str(port_num)
+    return port_mode
+
+
+def register_vhost_config(client: etcd.Client, alb, identifier, domains, port_mode='https', targets=None,
+                          removed_targets=None, name=None, health_check=None, certificate_name=None,
+                          use_certbot=False, certificate=None, lease=None, limits=None, capacity=None,
+                          slowstart=None, drain_timeout=DEFAULT_DRAIN_TIMEOUT):
+    """
+    Queues all writes for a virtual-host: the target group, the listeners for the port mode and the
+    listener group. Listeners for other port modes of the same virtual-host are removed.
+
+    :param domains: Domains for the virtual-host, each may contain a path, the primary domain is first.
+    :param port_mode: http, https, mixed or a custom port number.
+    :param targets: Targets to add to the target group, a list of dicts with host and port, and optionally
+                    maxconn and maxqueue.
+    :param removed_targets: Targets to remove from the target group, they are drained first.
+    :param health_check: Health check configuration for the target group or None for default.
+    :param certificate: Optional path to certificate file (pem) to upload.
+    :param lease: Name of lease to register targets under, see keep_lease_alive.
+    :param limits: Traffic limits for the listener group, see normalize_limits.
+    :param capacity: Capacity of the target group, see normalize_capacity.
+    :param slowstart: Seconds over which new targets ramp up to full weight.
+    :param drain_timeout: Seconds removed targets are drained, 0 removes them at once.
+    :raises ValueError: If the port mode, limits, capacity or timings are invalid.
+    """
+    limits = normalize_limits(limits)
+    capacity = normalize_capacity(capacity)
+    slowstart = normalize_seconds(slowstart, 'Slowstart')
+    drain_timeout = normalize_seconds(drain_timeout, 'Drain timeout')
+    for target in targets or []:
+        # Checked before anything is queued
+        normalize_capacity(target, names=TARGET_CAPACITY_NAMES)
+    # A sharded pool places each virtual-host on one of its ALBs
+    alb = resolve_alb(client.client if isinstance(client, WriteBatch) else client, alb, identifier)
+    port_mode = normalize_port_mode(port_mode)
+    port_num = parse_port_mode(port_mode)
+    main_domain = domains[0]
+    tg_id = identifier
+    tg_name = name or ('VirtualHost: ' + main_domain)
+    certificate_name = certificate_name or identifier
+
+    with write_batch(client) as batch:
+        # Remove targets from target group
+        unregister_targets(batch, identifier=tg_id, targets=removed_targets or [], lease=lease,
+                           drain_timeout=drain_timeout)
+
+        # First the target group which will receive the requests
+        register_target_group(batch, identifier=tg_id, name=tg_name, targets=targets or [],
+                              health_check=health_check, lease=lease, capacity=capacity, slowstart=slowstart)
+
+        # Then setup listeners for all incoming ports, each listener has a set of
+        # rules made from the registered domains. Each domain may also have a path
+        # specified.
+        remove_listener(batch, alb=alb, identifier='http-' + main_domain)
+        remove_listener(batch, alb=alb, identifier='https-' + main_domain)
+        if port_num is not None:
+            remove_listener(batch, alb=alb, identifier='custom-{}-{}'.format(port_num, main_domain))
+
+        forward_rules = []
+        redirect_rules = []
+        for domain in domains:
             domain, path = (domain.split('/', 1) + [None])[0:2]
-            https_rules.append({
+            forward_rules.append({
                 'id': 'vhost-' + domain,
                 'host': domain,
                 'path': path,
                 'action': 'tg:' + tg_id,
             })
-            http_rules.append({
+            redirect_rules.append({
                 'id': 'vhost-https-' + domain,
                 'host': domain,
                 'path': path,
                 'action': 'https',
             })
-        register_listener(client, alb=alb_identifier, identifier='https-' + main_domain, name='HTTPS 443', port=443,
-                          protocol='https', rules=https_rules, certificate_name=certificate_name)
-        register_listener(client, alb=alb_identifier, identifier='http-' + main_domain, name='HTTP 80', port=80,
-                          protocol='http', rules=http_rules)
-        listeners.append('https-' + main_domain)
-        listeners.append('http-' + main_domain)
-        # TODO: Add a rule which upgrades http to https
-    elif listener_port == 'mixed':
-        remove_listener(client, alb=alb_identifier, identifier='http-' + main_domain)
-        remove_listener(client, alb=alb_identifier, identifier='https-' + main_domain)
-        rules = []
-        for domain in listener_domains:
-            domain, path = (domain.split('/', 1) + [None])[0:2]
-            rules.append({
-                'id': 'vhost-' + domain,
-                'host': domain,
-                'path': path,
-                'action': 'tg:' + tg_id,
-            })
-        register_listener(client, alb=alb_identifier, identifier='http-' + main_domain, name='HTTP 80', port=80,
-                          protocol='http', rules=rules)
-        register_listener(client, alb=alb_identifier, identifier='https-' + main_domain, name='HTTPS 443', port=443,
-                          protocol='https', rules=rules, certificate_name=certificate_name)
-    else:
-        try:
-            remove_listener(client, alb=alb_identifier,
-                            identifier='custom-{}-{}'.format(listener_port_num, main_domain))
-            rules = []
-            for domain in listener_domains:
-                domain, path = (domain.split('/', 1) + [None])[0:2]
-                rules.append({
-                    'id': 'vhost-' + domain,
-                    'host': domain,
-                    'path': path,
-                    'action': 'tg:' + tg_id,
-                })
-            register_listener(client, alb=alb_identifier,
-                              identifier='custom-{}-{}'.format(listener_port_num, main_domain), name='HTTP 80',
-                              port=listener_port_num,
+
+        if port_mode == 'http':
+            register_listener(batch, alb=alb, identifier='http-' + main_domain, name='HTTP 80', port=80,
+                              protocol='http', rules=forward_rules)
+        elif port_mode == 'https':
+            register_listener(batch, alb=alb, identifier='https-' + main_domain, name='HTTPS 443', port=443,
+                              protocol='https', rules=forward_rules, certificate_name=certificate_name)
+            # Plain http requests are redirected to https
+            register_listener(batch, alb=alb, identifier='http-' + main_domain, name='HTTP 80', port=80,
+                              protocol='http', rules=redirect_rules)
+        elif port_mode == 'mixed':
+            register_listener(batch, alb=alb, identifier='http-' + main_domain, name='HTTP 80', port=80,
+                              protocol='http', rules=forward_rules)
+            register_listener(batch, alb=alb, identifier='https-' + main_domain, name='HTTPS 443', port=443,
+                              protocol='https', rules=forward_rules, certificate_name=certificate_name)
+        else:
+            register_listener(batch, alb=alb,
+                              identifier='custom-{}-{}'.format(port_num, main_domain), name='HTTP 80',
+                              port=port_num,
                               protocol='http',
-                              rules=rules)
-            listeners.append('custom-{}-{}'.format(listener_port_num, main_domain))
-        except ValueError:
-            print("Listener port number '{}' must be a number or one of 'http', 'https', 'mixed'".format(listener_port),
-                  file=sys.stderr)
-            sys.exit(1)
+                              rules=forward_rules)
+
+        # Register listener groups, contains all domains and listeners
+        host_domains = [(domain.split('/', 1) + [None])[0] for domain in domains]
+        register_listener_group(batch, alb, identifier, domains=host_domains,
+                                listeners=vhost_listener_ids(main_domain, port_mode),
+                                certificate_name=certificate_name, use_certbot=use_certbot, limits=limits)
 
-    # Register listener groups, contains all domains and listeners
-    domains = []
-    for domain in listener_domains:
-        domain, path = (domain.split('/', 1) + [None])[0:2]
-        domains.append(domain)
+        if certificate and not use_certbot:
+            upload_certificate_file(batch, certificate_name, certificate)
 
-    register_listener_group(client, alb_identifier, listener_id, domains=domains, listeners=listeners,
-                            certificate_name=certificate_name, use_certbot=use_certbot)
 
-    if certificate and not use_certbot:
-        upload_certificate_file(client, certificate_name, certificate)
+def unregister_vhost_config(client: etcd.Client, alb, identifier, domains, port_mode='https', lease=None,
+                            with_target_group=True):
+    """
+    Queues removal of a virtual-host: its listeners, listener group and target group.
+    For a sharded pool it is removed from every ALB of the pool, also those it was placed on before
+    a rebalance.
+
+    :param lease: Name of lease the targets were registered under, if any.
+    :param with_target_group: If False the target group and its targets are kept, e.g. when only the
+                              listeners are renamed.
+    """
+    port_mode = normalize_port_mode(port_mode)
+    main_domain = domains[0]
+    albs = pool_albs(client.client if isinstance(client, WriteBatch) else client, alb)
+    with write_batch(client) as batch:
+        for alb in albs:
+            for listener_id in vhost_listener_ids(main_domain, port_mode):
+                remove_listener(batch, alb=alb, identifier=listener_id)
+            batch.delete("/alb/{alb}/listener_groups/{identifier}".format(alb=alb, identifier=identifier),
+                         recursive=True)
+        if not with_target_group:
+            return
+        batch.delete("/target_group/{identifier}".format(identifier=identifier), recursive=True)
+        if lease:
+            batch.delete("{lease_path}/targets/{identifier}".format(lease_path=lease_path(lease),
+                                                                   identifier=identifier), recursive=True)
 
 
 def upload_certificate(args):
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+import http.server
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from subprocess import call
+
+import etcd
+
+from .manager import get_alb, get_certificate
+from .register import register_certbot, unregister_certbot, has_certificate, register_certificate, \
+    upload_certificate_data, write_batch, etcd_client, wait_certbot_ready
+from .services import ListenerGroup, NoListeners, NoTargetGroups
+from .shards import pool_albs
+from .utils import ConfigurationError
+
+logger = logging.getLogger('docker-alb')
+
+RENEW_AFTER_DAYS = 60
+READY_TIMEOUT = 3 * 60
+READY_POLL_INTERVAL = 1.0
+
+
+class RenewalResult(object):
+    def __init__(self, identifier: str, certificate_name: str, domains: list = None, status: str = 'pending',
+                 message: str = None):
+        """
+        Outcome of a certificate renewal for a single listener group.
+
+        :param identifier: Identifier of the listener group.
+        :param certificate_name: Name of certificate entry which receives the certificate.
+        :param domains: Domains requested for the certificate.
+        :param status: One of pending, renewed, failed or skipped.
+        :param message: Reason for failure or skip.
+        """
+        self.identifier = identifier
+        self.certificate_name = certificate_name
+        self.domains = list(domains or [])
+        self.status = status
+        self.message = message
+        self.duration = None
+
+    def __repr__(self):
+        return "RenewalResult({!r},certificate_name={!r},status={!r},message={!r})".format(
+            self.identifier, self.certificate_name, self.status, self.message)
+
+
+class ChallengeHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves files from the ACME webroot, only the challenge path is exposed.
+    """
+    def do_GET(self):
+        if not self.path.startswith('/.well-known/acme-challenge/'):
+            self.send_error(404)
+            return
+        super().do_GET()
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def log_message(self, format, *args):
+        logger.debug("challenge server: " + format, *args)
+
+
+def start_challenge_server(webroot, port):
+    """
+    Starts a threaded HTTP server which serves ACME challenges written to webroot by certbot.
+    All certbot processes share this server so they can run concurrently.
+    """
+    def handler(*args, **kwargs):
+        return ChallengeHandler(*args, directory=webroot, **kwargs)
+
+    server = http.server.ThreadingHTTPServer(('', int(port)), handler)
+    thread = threading.Thread(target=server.serve_forever, name='acme-challenge', daemon=True)
+    thread.start()
+    return server
+
+
+def is_renewal_due(client: etcd.Client, listener_group: ListenerGroup, renew_after_days=RENEW_AFTER_DAYS):
+    """
+    Check if the certificate for a listener group must be (re)issued.
+
+    :return: Reason for renewal as a string, or None if it is not due.
+    """
+    certificate_name = listener_group.certificate_name or listener_group.identifier
+    certificate = get_certificate(certificate_name, client=client)
+    if certificate is None:
+        return "no certificate"
+    if not certificate.is_valid:
+        return "certificate not valid"
+    if set(certificate.domains or []) != set(listener_group.domains):
+        return "domains changed"
+    if certificate.modified is None:
+        return "unknown age"
+    modified = certificate.modified
+    if datetime.now(modified.tzinfo) - modified >= timedelta(days=renew_after_days):
+        return "older than {} days".format(renew_after_days)
+    return None
+
+
+def wait_certbots_ready(client: etcd.Client, alb, listener_ids, timeout=READY_TIMEOUT):
+    """
+    Waits until the ALB has marked all certbots as ready. This only requires a single
+    reload of the ALB as all certbots are registered before waiting.
+
+    :return: Set of listener ids which are ready.
+    """
+    pending = set(listener_ids)
+    ready = set()
+    deadline = time.time() + timeout
+    certbot_prefix = "/alb/{alb}/certbot".format(alb=alb)
+    while pending and time.time() < deadline:
+        try:
+            for node in client.read(certbot_prefix, recursive=True).leaves:
+                parts = node.key[len(certbot_prefix) + 1:].split('/')
+                if len(parts) == 2 and parts[1] == 'ready' and parts[0] in pending and node.value == 'true':
+                    pending.discard(parts[0])
+                    ready.add(parts[0])
+        except (etcd.EtcdKeyNotFound, KeyError):
+            pass
+        if pending:
+            time.sleep(READY_POLL_INTERVAL)
+    return ready
+
+
+def read_certbot_pem(config_dir, certificate_name):
+    """
+    Reads the issued full chain and private key and combines them in to a single PEM.
+    """
+    live_path = os.path.join(config_dir, 'live', certificate_name)
+    pem_data = ""
+    with open(os.path.join(live_path, 'fullchain.pem')) as full_chain_file:
+        pem_data += full_chain_file.read().strip() + "\n"
+    with open(os.path.join(live_path, 'privkey.pem')) as private_key_file:
+        pem_data += private_key_file.read().strip() + "\n"
+    return pem_data
+
+
+def run_certbot(result: RenewalResult, email, webroot, work_dir, force=False):
+    """
+    Runs certbot for a single listener group in webroot mode. Each certificate uses its own
+    config, work and log directories so multiple certbot processes do not share a lock.
+
+    :return: PEM data if successful, otherwise None with the result marked as failed.
+    """
+    cert_dir = os.path.join(work_dir, result.certificate_name)
+    domain_args = sum([["-d", domain] for domain in result.domains], [])
+    certbot_args = ["certbot", "certonly", "--noninteractive", "--webroot", "-w", webroot,
+                    "--agree-tos", "--email", email, "--expand",
+                    "--force-renewal" if force else "--keep-until-expiring",
+                    "--config-dir", os.path.join(cert_dir, 'config'),
+                    "--work-dir", os.path.join(cert_dir, 'work'),
+                    "--logs-dir", os.path.join(cert_dir, 'logs'),
+                    "--cert-name", result.certificate_name] + domain_args
+    logger.debug("certbot command: %s", " ".join(certbot_args))
+    proc = subprocess.run(certbot_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if proc.returncode != 0:
+        output = (proc.stdout or '').strip().splitlines()
+        result.status = 'failed'
+        result.message = "certbot exited with {}: {}".format(proc.returncode, output[-1] if output else '')
+        return None
+    try:
+        return read_certbot_pem(os.path.join(cert_dir, 'config'), result.certificate_name)
+    except OSError as e:
+        result.status = 'failed'
+        result.message = "could not read issued certificate: {}".format(e)
+        return None
+
+
+def renew_certificates_batch(client: etcd.Client, alb_id, host_ip, host_port, email, concurrency=4,
+                             renew_after_days=RENEW_AFTER_DAYS, force=False, listen_port=80,
+                             work_dir='/etc/letsencrypt/nap', ready_timeout=READY_TIMEOUT):
+    """
+    Renews all due certbot managed certificates for an ALB in one pass.
+
+    All certbot routes are registered at once, then it waits for a single ALB reload
+    before issuing certificates with bounded concurrency. Issued certificates are
+    uploaded and all certbot routes unregistered at the end.
+
+    :return: List of RenewalResult objects, one per certbot managed listener group.
+    """
+    alb_config = get_alb(alb_id, with_listener_group=True, raw=True)
+    results = []
+    due = []
+    for listener_group in alb_config.listener_groups:  # type: ListenerGroup
+        if not listener_group.use_certbot or not listener_group.domains:
+            continue
+        result = RenewalResult(listener_group.identifier,
+                               certificate_name=listener_group.certificate_name or listener_group.identifier,
+                               domains=listener_group.domains)
+        results.append(result)
+        reason = "forced" if force else is_renewal_due(client, listener_group, renew_after_days=renew_after_days)
+        if reason is None:
+            result.status = 'skipped'
+            result.message = "not due"
+            continue
+        logger.debug("Certificate %s is due for renewal: %s", result.certificate_name, reason)
+        due.append(result)
+
+    if not due:
+        return results
+
+    webroot = tempfile.mkdtemp(prefix='nap-acme-')
+    server = start_challenge_server(webroot, listen_port)
+    registered = []
+    try:
+        with write_batch(client) as batch:
+            for result in due:
+                register_certbot(batch, alb=alb_id, listener_id=result.identifier, domains=result.domains,
+                                 target=[host_ip, host_port], certificate_name=result.certificate_name)
+                registered.append(result)
+
+        logger.debug("Waiting for %d certbots in ALB %s to be setup", len(registered), alb_id)
+        ready = wait_certbots_ready(client, alb_id, [result.identifier for result in registered],
+                                    timeout=ready_timeout)
+        runnable = []
+        for result in registered:
+            if result.identifier in ready:
+                runnable.append(result)
+            else:
+                result.status = 'failed'
+                result.message = "ALB did not set up certbot route within {} seconds".format(ready_timeout)
+
+        def issue(result: RenewalResult):
+            start = time.time()
+            pem_data = run_certbot(result, email=email, webroot=webroot, work_dir=work_dir, force=force)
+            result.duration = time.time() - start
+            return result, pem_data
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            for result, pem_data in executor.map(issue, runnable):
+                if pem_data is None:
+                    continue
+                if has_certificate(client, result.certificate_name):
+                    upload_certificate_data(client, result.certificate_name, pem_data, domains=result.domains)
+                else:
+                    register_certificate(client, result.certificate_name, domains=result.domains, email=email,
+                                         data=pem_data, modified=datetime.now())
+                result.status = 'renewed'
+    finally:
+        # Certbots done or failed, unregister all routes in one pass
+        with write_batch(client) as batch:
+            for result in registered:
+                unregister_certbot(batch, alb=alb_id, listener_id=result.identifier)
+        server.shutdown()
+        server.server_close()
+
+    return results
+
+
+def format_renewal_report(results):
+    """
+    Creates a human readable summary of a batch renewal.
+    """
+    lines = []
+    counts = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+        line = "{}: {} ({})".format(result.status, result.certificate_name, ", ".join(result.domains))
+        if result.message:
+            line += " - " + result.message
+        if result.duration is not None:
+            line += " [{:.1f}s]".format(result.duration)
+        lines.append(line)
+    lines.append("Total: {}, renewed: {}, failed: {}, skipped: {}".format(
+        len(results), counts.get('renewed', 0), counts.get('failed', 0), counts.get('skipped', 0)))
+    return "\n".join(lines)
+
+
+def cli_renew_certs(args):
+    verbosity = args.verbosity
+    alb_id = args.alb_id or os.environ.get('ALB_ID')
+    host_name = args.host_name or os.environ.get('HOST_NAME')
+    host_port = args.host_port or os.environ.get('HOST_PORT')
+    if not host_name:
+        logger.error("No host IP set, use --host-ip option or set HOST_NAME environment variable")
+        sys.exit(1)
+    if not host_port:
+        logger.error("No host port set, use --host-port option or set HOST_PORT environment variable")
+        sys.exit(1)
+    email = args.email or os.environ.get("EMAIL")
+    if not email:
+        logger.error("No email address set, use --email or set EMAIL environment variable")
+        sys.exit(1)
+
+    host_ip = socket.gethostbyname(host_name)
+
+    client = etcd_client(args.etcd_host)
+
+    if args.batch:
+        results = []
+        try:
+            # A sharded pool has its virtual-hosts spread over several ALBs, each is renewed in turn
+            for alb_identifier in pool_albs(client, alb_id or 'vhost'):
+                try:
+                    results.extend(renew_certificates_batch(
+                        client, alb_identifier, host_ip=host_ip, host_port=host_port, email=email,
+                        concurrency=args.concurrency, renew_after_days=args.renew_after_days, force=args.force,
+                        listen_port=args.listen_port, work_dir=args.work_dir, ready_timeout=args.ready_timeout))
+                except NoListeners:
+                    continue
+        except (NoListeners, NoTargetGroups):
+            if verbosity >= 1:
+                print("No configuration found")
+            return
+        except ConfigurationError as e:
+            if verbosity >= 0:
+                print("Etcd host is not defined: ", e, file=sys.stderr)
+            sys.exit(1)
+        if verbosity >= 0:
+            print(format_renewal_report(results))
+        if any(result.status == 'failed' for result in results):
+            sys.exit(1)
+        return
+
+    def scan_alb(alb_identifier):
+        alb_config = get_alb(alb_identifier, with_listener_group=True)
+        for listener_group in alb_config.listener_groups:  # type: ListenerGroup
+            logger.debug(listener_group)
+            if not listener_group.use_certbot or not listener_group.domains:
+                continue
+            # certbot = listener_group.certbot  # type: CertBot
+            try:
+                register_certbot(client, alb=alb_identifier, listener_id=listener_group.identifier,
+                                 domains=listener_group.domains, target=[host_ip, host_port],
+                                 certificate_name=listener_group.certificate_name)
+                logger.debug("Waiting for certbot %s in ALB %s to be setup", listener_group.identifier, alb_identifier)
+                if not wait_certbot_ready(client, alb=alb_identifier, listener_id=listener_group.identifier):
+                    logger.error("Failed to wait for ALB '{}' to setup up certbot config for id={}, domains={}".format(
+                        alb_identifier, listener_group.identifier, listener_group.domains))
+                    unregister_certbot(client, alb=alb_identifier, listener_id=listener_group.identifier)
+                    continue
+
+                register_certificate(client, certificate_name=listener_group.identifier, domains=listener_group.domains,
+                                     email=email, modified=datetime.now())
+                domain_args = sum([["-d", domain] for domain in listener_group.domains], [])
+                certbot_args = ["certbot", "certonly", "--verbose", "--noninteractive", "--standalone",
+                                "--preferred-challenges", "http", "--agree-tos", "--email", email,
+                                "--cert-name", listener_group.identifier] + domain_args
+                logger.debug("certbot command: %s", " ".join(certbot_args))
+                call(certbot_args)
+            finally:
+                # Certbot done or failed, unregister from listener
+                unregister_certbot(client, alb=alb_identifier, listener_id=listener_group.identifier)
+
+    try:
+        # A sharded pool has its virtual-hosts spread over several ALBs
+        for alb_identifier in pool_albs(client, alb_id):
+            try:
+                scan_alb(alb_identifier)
+            except NoListeners:
+                continue
+    except (NoListeners, NoTargetGroups):
+        if verbosity >= 1:
+            print("No configuration found")
+    except ConfigurationError as e:
+        if verbosity >= 0:
+            print("Etcd host is not defined: ", e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import re
+import sys
+
+from .accesslog import parse_line
+from .haproxy import backend_name
+from .manager import get_alb
+from .snapshot import read_snapshot, SnapshotError
+from .services import LoadBalancerConfig, Listener, Rule
+
+# Backends the generated config uses besides those of target groups
+REDIRECT_BACKEND = 'redir_https_backend'
+DEFAULT_BACKEND = 'no_http_service'
+FRONTEND_PORT_RE = re.compile(r'^listener_group_lg_(\d+)$')
+# Number of hosts whose candidate rules are cached per port, cleared when full
+HOST_CACHE_SIZE = 100000
+
+
+class Route(object):
+    __slots__ = ('port', 'listener', 'rule', 'position', 'acl', 'backend', 'path')
+
+    def __init__(self, port, listener: Listener = None, rule: Rule = None, position=None, acl=None,
+                 backend=DEFAULT_BACKEND):
+        """
+        Where haproxy sends a request.
+
+        :param position: Order of the use_backend line in the frontend, the lowest matching one wins.
+        :param acl: Prefix of the ACL names in the generated config, e.g. listener3_rule1.
+        :param backend: Name of haproxy backend, no_http_service if no rule matched.
+        """
+        self.port = port
+        self.listener = listener
+        self.rule = rule
+        self.position = position
+        self.acl = acl
+        self.backend = backend
+        # Lower case path prefix the rule matches, None if it matches any path
+        self.path = rule.path_prefix.lower() if rule is not None and rule.path else None
+
+    def __repr__(self):
+        return "Route(port={!r},acl={!r},backend={!r})".format(self.port, self.acl, self.backend)
+
+    @property
+    def target_group(self):
+        return self.rule.target_group if self.rule is not None and self.rule.action_type == 'forward' else None
+
+    def as_dict(self):
+        rule = self.rule
+        target_group = self.target_group
+        return {
+            'port': self.port,
+            'listener': self.listener.identifier if self.listener else None,
+            'acl': self.acl,
+            'host': rule.host if rule else None,
+            'path': rule.path_prefix if rule else None,
+            'action': rule.action if rule else None,
+            'target_group': target_group.identifier if target_group else None,
+            'targets': len(target_group.targets) if target_group else None,
+            'backend': self.backend,
+        }
+
+
+class HostNode(object):
+    __slots__ = ('children', 'routes')
+
+    def __init__(self):
+        self.children = {}
+        # Routes whose host ends at this node, ordered by position
+        self.routes = []
+
+
+class PortRoutes(object):
+    def __init__(self, port):
+        """
+        Routing rules of one frontend. Hosts are matched as prefixes of the Host header
+        (hdr_beg(host) -i) with a character trie, paths as prefixes of the path (path_beg -i).
+        """
+        self.port = port
+        self.root = HostNode()
+        self.host_cache = {}
+
+    def add(self, route: Route):
+        node = self.root
+        for char in (route.rule.host or '').lower():
+            node = node.children.setdefault(char, HostNode())
+        node.routes.append(route)
+
+    def candidates(self, host):
+        """
+        :return: Routes whose host is a prefix of host, ordered by position.
+        """
+        routes = self.host_cache.get(host)
+        if routes is not None:
+            return routes
+        node = self.root
+        routes = list(node.routes)
+        for char in host.lower():
+            node = node.children.get(char)
+            if node is None:
+                break
+            routes.extend(node.routes)
+        routes.sort(key=lambda route: route.position)
+        if len(self.host_cache) >= HOST_CACHE_SIZE:
+            self.host_cache.clear()
+        self.host_cache[host] = routes
+        return routes
+
+    def lookup(self, host, path):
+        lower_path = None
+        for route in self.candidates(host or ''):
+            if route.path is None:
+                return route
+            if lower_path is None:
+                lower_path = (path or '').lower()
+            if lower_path.startswith(route.path):
+                return route
+        return Route(self.port)
+
+
+class RoutingTable(object):
+    def __init__(self, alb_config: LoadBalancerConfig):
+        """
+        Indexed copy of the routing rules in the generated haproxy config. Frontends, listeners and
+        rules are walked in the same order as the template, so the first matching rule here is the
+        first matching use_backend in haproxy.
+        """
+        self.ports = {}
+        for port_group in alb_config.port_groups:
+            if port_group.protocol not in ('http', 'https'):
+                # The template has no bind for other protocols
+                continue
+            port_routes = self.ports[port_group.port] = PortRoutes(port_group.port)
+            position = 0
+            for listener_index, listener in enumerate(port_group.listeners, 1):
+                for rule_index, rule in enumerate(listener.rules, 1):
+                    if rule.action_type == 'forward' and rule.target_group is not None:
+                        backend = backend_name(rule.target_group)
+                    elif rule.action_type == 'https' and listener.protocol == 'http':
+                        backend = REDIRECT_BACKEND
+                    else:
+                        # No use_backend is rendered for the rule
+                        continue
+                    position += 1
+                    port_routes.add(Route(port_group.port, listener=listener, rule=rule, position=position,
+                                          acl='listener{}_rule{}'.format(listener_index, rule_index),
+                                          backend=backend))
+        if not self.ports:
+            # Without listeners the config only has a frontend on port 80 which serves 503
+            self.ports[80] = PortRoutes(80)
+
+    def lookup(self, host, path='/', port=80):
+        """
+        :return: Route for the request, or None if haproxy does not listen on port.
+        """
+        port_routes = self.ports.get(port)
+        if port_routes is None:
+            return None
+        return port_routes.lookup(host, path)
+
+
+def parse_request(line):
+    """
+    Parses a line for route verification, either a haproxy HTTP log line or 'host path [port]'.
+
+    :return: Tuple of host, path, port and the backend haproxy logged (None if not a log line), or
+             None if the line cannot be used.
+    """
+    entry = parse_line(line)
+    if entry is not None:
+        match = FRONTEND_PORT_RE.match(entry['frontend'])
+        if match is None or not entry['host'] or not entry['path']:
+            return None
+        return entry['host'], entry['path'], int(match.group(1)), entry['backend']
+    parts = line.split()
+    if not parts:
+        return None
+    try:
+        port = int(parts[2]) if len(parts) > 2 else 80
+    except ValueError:
+        return None
+    return parts[0], parts[1] if len(parts) > 1 else '/', port, None
+
+
+def verify_requests(table: RoutingTable, lines, on_mismatch=None):
+    """
+    Routes each request and compares with the backend haproxy logged.
+
+    :param on_mismatch: Called with the line, the logged backend and the Route for each mismatch.
+    :return: Dictionary of counts: lines, routed, skipped, matched and mismatched.
+    """
+    counts = {'lines': 0, 'routed': 0, 'skipped': 0, 'matched': 0, 'mismatched': 0}
+    for line in lines:
+        counts['lines'] += 1
+        request = parse_request(line)
+        if request is None:
+            counts['skipped'] += 1
+            continue
+        host, path, port, logged_backend = request
+        route = table.lookup(host, path, port)
+        counts['routed'] += 1
+        if logged_backend is None:
+            continue
+        backend = route.backend if route is not None else None
+        if backend == logged_backend:
+            counts['matched'] += 1
+        else:
+            counts['mismatched'] += 1
+            if on_mismatch is not None:
+                on_mismatch(line, logged_backend, route)
+    return counts
+
+
+def format_route(route: Route):
+    if route is None:
+        return "no frontend on this port"
+    values = route.as_dict()
+    if route.rule is None:
+        return "port {port}: no rule matched, backend {backend}".format(**values)
+    return "port {port}: listener {listener} ({acl}) host {host} path {path} action {action} -> backend {backend}" \
+        .format(**{key: '-' if value is None else value for key, value in values.items()})
+
+
+def cli_route(args):
+    if args.snapshot:
+        try:
+            alb_config = read_snapshot(args.snapshot)
+        except SnapshotError as e:
+            print(e, file=sys.stderr)
+            sys.exit(2)
+    else:
+        alb_config = get_alb(os.environ.get('ALB_ID', args.alb_id), with_listener_group=True)
+    table = RoutingTable(alb_config)
+
+    if args.file:
+        stream = sys.stdin if args.file == '-' else open(args.file, encoding='utf8', errors='replace')
+        shown = [0]
+
+        def on_mismatch(line, logged_backend, route):
+            if shown[0] < args.max_mismatches:
+                shown[0] += 1
+                print("logged {} routed {}: {}".format(logged_backend, route.backend if route else '-',
+                                                       line.rstrip()))
+
+        with stream:
+            counts = verify_requests(table, stream, on_mismatch=on_mismatch)
+        print(json.dumps(counts, sort_keys=True) if args.format == 'json' else
+              "{lines} lines, {routed} routed, {skipped} skipped, {matched} matched, {mismatched} mismatched"
+              .format(**counts))
+        if counts['mismatched']:
+            sys.exit(1)
+        return
+
+    if not args.host:
+        print("Specify a host or --file", file=sys.stderr)
+        sys.exit(2)
+    route = table.lookup(args.host, args.path, args.port)
+    if args.format == 'json':
+        print(json.dumps(route.as_dict() if route else None, sort_keys=True))
+    else:
+        print(format_route(route))
+    if route is None or route.rule is None:
+        sys.exit(1)
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import logging
+import sys
+from operator import attrgetter
 from datetime import datetime
 
 logger = logging.getLogger('docker-alb')
 
+# Seconds the request rate per source is measured over, short periods make bursts trip the limit
+RATE_PERIOD = 10
+# Stick table holding connection and trigger counters per listener group
+LIMIT_GROUPS_TABLE = 'nap_limit_groups'
+
 
 class NoListeners(Exception):
     pass
@@ -66,26 +73,95 @@ class LoadBalancerConfig(object):
         """
         return list(self.target_groups_map.values())
 
+    @property
+    def traffic_limits(self):
+        """
+        Limits of all listener groups with listeners in a frontend, each listed once.
+
+        :rtype: List[TrafficLimits]
+        """
+        limits = {}
+        for port_group in self.port_groups:
+            for group_limits in port_group.traffic_limits:
+                limits[group_limits.group] = group_limits
+        return [limits[group] for group in sorted(limits)]
+
+
+class Value(object):
+    """
+    Base for immutable configuration values.
+
+    Fields are stored in __slots__, values compare equal when they are the same object or their identity
+    fields are equal. Hashes are computed from the identity fields when asked for, nothing is cached on the
+    value. Use replace() to get a modified copy.
+    """
+    __slots__ = ()
+    # Fields passed to __init__, used by replace()
+    _init_fields = ()
+    # Fields which make up the identity of the value, used for equality and hashing
+    _fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # attrgetter builds the key tuple in C
+        cls._key = attrgetter(*cls._fields)
+
+    def _set(self, **values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable, use replace()".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __hash__(self):
+        return hash(self._key(self))
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._key(self) == self._key(other)
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self._init_fields}
+        values.update(changes)
+        return type(self)(**values)
+
+
+def intern_value(value):
+    """
+    Interns strings, identifiers and protocols repeat across many listeners and rules.
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def freeze_list(values):
+    return tuple(values) if values is not None else None
+
+
+class Listener(Value):
+    __slots__ = ('identifier', 'port', 'rules', 'protocol', 'certificate_name', 'certificate', 'limits')
+    _init_fields = __slots__
+    _fields = ('identifier', 'port', 'rules', 'protocol', 'certificate', 'limits')
 
-class Listener(object):
     def __init__(self, identifier: str, port: int = None, rules: list = None, protocol='http',
-                 certificate_name: str = None, certificate: "Certificate" = None):
-        self.identifier = identifier
-        self.port = port
-        self.rules = list(rules or [])
-        self.protocol = protocol
+                 certificate_name: str = None, certificate: "Certificate" = None, limits: "TrafficLimits" = None):
+        """
+        :param limits: Traffic limits of the listener group the listener belongs to, None for no limits.
+        """
         if not certificate_name and certificate:
             certificate_name = certificate.identifier
-        self.certificate_name = certificate_name
-        self.certificate = certificate
-
-    def __eq__(self, other: "Listener"):
-        return self.identifier == other.identifier and self.port == other.port and self.rules == other.rules and \
-               self.protocol == other.protocol and self.certificate == other.certificate
+        self._set(identifier=intern_value(identifier), port=port, rules=tuple(rules or ()),
+                  protocol=intern_value(protocol), certificate_name=intern_value(certificate_name),
+                  certificate=certificate, limits=limits)
 
     def __repr__(self):
         return "Listener({!r},port={!r},rules={!r},protocol={!r},certificate={!r})".format(
-            self.identifier, self.port, self.rules, self.protocol, self.certificate)
+            self.identifier, self.port, list(self.rules), self.protocol, self.certificate)
 
     @property
     def slug(self):
@@ -97,6 +173,47 @@ class Listener(object):
                 yield rule.target_group_id
 
 
+class TrafficLimits(Value):
+    __slots__ = ('group', 'rate', 'conn', 'maxconn', 'action')
+    _init_fields = __slots__
+    _fields = __slots__
+
+    def __init__(self, group: str, rate: int = None, conn: int = None, maxconn: int = None, action: str = None):
+        """
+        Per listener group limits, rendered as haproxy stick tables.
+
+        :param group: Identifier of the listener group.
+        :param rate: Max requests per second from a single source IP, averaged over RATE_PERIOD seconds.
+        :param conn: Max concurrent connections from a single source IP.
+        :param maxconn: Max concurrent connections to the listener group from all sources.
+        :param action: deny (429) or tarpit for requests over the per source limits, defaults to deny.
+        """
+        self._set(group=intern_value(group), rate=rate or None, conn=conn or None, maxconn=maxconn or None,
+                  action=intern_value(action or 'deny'))
+
+    def __repr__(self):
+        return "TrafficLimits({!r},rate={!r},conn={!r},maxconn={!r},action={!r})".format(
+            self.group, self.rate, self.conn, self.maxconn, self.action)
+
+    @property
+    def slug(self):
+        return self.group.replace(".", "_").replace("-", "_")
+
+    @property
+    def source_table(self):
+        """
+        Name of the stick table with per source counters, None if there are no per source limits.
+        """
+        return 'nap_limit_' + self.slug if self.rate or self.conn else None
+
+    @property
+    def rate_requests(self):
+        """
+        Requests allowed within RATE_PERIOD seconds.
+        """
+        return self.rate * RATE_PERIOD if self.rate else None
+
+
 class PortGroup(object):
     def __init__(self, identifier: str, port: int = None, listeners: list = None, protocol='http'):
         """
@@ -124,10 +241,23 @@ class PortGroup(object):
     def slug(self):
         return self.identifier.replace(".", "_").replace("-", "_")
 
+    @property
+    def traffic_limits(self):
+        """
+        Limits of the listener groups with listeners on this port, in listener order.
+
+        :rtype: List[TrafficLimits]
+        """
+        limits = {}
+        for listener in self.listeners:
+            if listener.limits is not None:
+                limits.setdefault(listener.limits.group, listener.limits)
+        return list(limits.values())
+
 
 class ListenerGroup(object):
     def __init__(self, identifier: str, listeners: list = None, domains: list = None, certificate_name: str = None,
-                 use_certbot: bool = False, certbot: "CertBot" = None):
+                 use_certbot: bool = False, certbot: "CertBot" = None, limits: TrafficLimits = None):
         """
         Groups configuration for a set of listeners and domains.
 
@@ -137,6 +267,7 @@ class ListenerGroup(object):
         :param certificate_name: Name of certificate entry which holds the certificate file
         :param use_certbot: If True then certificates are managed by certbot.
         :param certbot: Configuration for certbot or None if unset.
+        :param limits: Traffic limits for the listeners or None if unlimited.
         """
         self.identifier = identifier
         self.listeners = list(listeners or [])
@@ -144,24 +275,32 @@ class ListenerGroup(object):
         self.certificate_name = certificate_name
         self.use_certbot = use_certbot
         self.certbot = certbot
+        self.limits = limits
 
     def __eq__(self, other: "ListenerGroup"):
         return self.identifier == other.identifier and self.domains == other.domains and \
                self.listeners == other.listeners and self.certificate_name == other.certificate_name and \
-               self.use_certbot == other.use_certbot and self.certbot == other.certbot
+               self.use_certbot == other.use_certbot and self.certbot == other.certbot and \
+               self.limits == other.limits
 
     def __repr__(self):
         return "ListenerGroup({!r},domains={!r},listeners={!r},certificate_name={!r},use_certbot={!r}," \
-               "certbot={!r})".format(
-                self.identifier, self.domains, self.listeners, self.certificate_name, self.use_certbot, self.certbot)
+               "certbot={!r},limits={!r})".format(
+                self.identifier, self.domains, self.listeners, self.certificate_name, self.use_certbot, self.certbot,
+                self.limits)
 
     @property
     def slug(self):
         return self.identifier.replace(".", "_").replace("-", "_")
 
 
-class Rule(object):
-    def __init__(self, host: str = None, path: str = None, action: str = None, target_group: "Target" = None,
+class Rule(Value):
+    __slots__ = ('host', 'path', 'action', 'target_group', 'pri', 'target_group_id', 'action_type', 'status_code')
+    _init_fields = ('host', 'path', 'action', 'target_group', 'pri')
+    # The target group is resolved from the action and is not part of the identity
+    _fields = ('host', 'path', 'action', 'pri')
+
+    def __init__(self, host: str = None, path: str = None, action: str = None, target_group: "TargetGroup" = None,
                  pri: int = 0):
         """
 
@@ -171,111 +310,141 @@ class Rule(object):
         :param target_group:
         :param pri: Priority value, higher values have higher priority and will be run first.
         """
-        self.host = host
-        self.path = path
-        self.action = action
-        self.target_group = target_group
-        self.target_group_id = None
+        target_group_id = None
+        action_type = None
+        status_code = None
         if action and action.startswith("tg:"):
-            self.action_type = "forward"
-            self.target_group_id = action[3:]
+            action_type = "forward"
+            target_group_id = intern_value(action[3:])
         elif action == 'https':
-            self.action_type = "https"
+            action_type = "https"
         elif action and action.startswith("status:"):
-            self.action_type = "status"
-            self.status_code = action[7:]
-        self.pri = pri
-
-    def __eq__(self, other: "Rule"):
-        return self.path == other.path and self.host == other.host and self.action == other.action and \
-               self.pri == other.pri
+            action_type = "status"
+            status_code = action[7:]
+        self._set(host=host, path=path, action=intern_value(action), target_group=target_group, pri=pri,
+                  target_group_id=target_group_id, action_type=action_type, status_code=status_code)
 
     def __repr__(self):
         return "Rule(host={!r},path={!r},action={!r},pri={!r})".format(self.host, self.path, self.action, self.pri)
 
+    @property
+    def path_prefix(self):
+        """
+        The path as haproxy matches it, registered paths are stored without the leading slash.
+        """
+        return '/' + self.path.lstrip('/') if self.path else None
+
 
-class HealthCheck(object):
-    protocol = 'http'
-    path = '/'
-    port = 'traffic'
-    healthy = 2
-    unhealthy = 10
-    timeout = 4
-    interval = 5
-    success = []
+class HealthCheck(Value):
+    __slots__ = ('protocol', 'path', 'port', 'healthy', 'unhealthy', 'timeout', 'interval', 'success')
+    _init_fields = __slots__
+    _fields = __slots__
 
     def __init__(self, protocol: str = None, path: str = None, port: str = None, healthy: int = None,
                  unhealthy: int = None, timeout: int = None, interval: int = None, success: list = None):
-        if protocol:
-            self.protocol = protocol
-        if path:
-            self.path = path
-        if port:
-            self.port = port
-        if healthy:
-            self.healthy = healthy
-        if unhealthy:
-            self.unhealthy = unhealthy
-        if timeout:
-            self.timeout = timeout
-        if interval:
-            self.interval = interval
-        self.success = list(success or [200])
-
-    def __eq__(self, other: "HealthCheck"):
-        return self.protocol == other.protocol and self.path == other.path and self.port == other.port and \
-               self.healthy == other.healthy and self.unhealthy == other.unhealthy and self.timeout == other.timeout \
-               and self.interval == other.interval and self.success == other.success
+        self._set(protocol=intern_value(protocol or 'http'), path=path or '/', port=port or 'traffic',
+                  healthy=healthy or 2, unhealthy=unhealthy or 10, timeout=timeout or 4, interval=interval or 5,
+                  success=tuple(success or (200,)))
 
     def __repr__(self):
         return "services.HealthCheck(protocol={!r},path={!r},port={!r},health={!r},unhealth={!r},timeout={!r}," \
                "interval={!r},success={!r})".format(
                 self.protocol, self.path, self.port, self.healthy, self.unhealthy, self.timeout, self.interval,
-                self.success
+                list(self.success)
                 )
 
 
-class TargetGroup(object):
-    identifier = None
-    protocol = 'http'
-    health_check = None
-    targets = []
+class Capacity(Value):
+    __slots__ = ('maxconn', 'maxqueue', 'queue_timeout')
+    _init_fields = __slots__
+    _fields = __slots__
 
-    def __init__(self, identifier: str, targets: list = None, protocol: str = None, health_check: HealthCheck = None):
-        self.identifier = identifier
-        self.targets = targets or []
-        self.protocol = protocol
-        self.health_check = health_check
+    def __init__(self, maxconn: int = None, maxqueue: int = None, queue_timeout: int = None):
+        """
+        How much concurrency the targets of a target group take, requests over it wait in haproxy.
 
-    def __eq__(self, other: "TargetGroup"):
-        return self.identifier == other.identifier and self.targets == other.targets and \
-               self.protocol == other.protocol and self.health_check == other.health_check
+        :param maxconn: Max concurrent requests sent to each target, further requests are queued.
+        :param maxqueue: Max requests queued for each target, further requests go to other targets.
+        :param queue_timeout: Seconds a request may wait in the queue before it gets a 503.
+        """
+        self._set(maxconn=maxconn or None, maxqueue=maxqueue or None, queue_timeout=queue_timeout or None)
 
     def __repr__(self):
-        return "TargetGroup({!r},targets={!r},protocol={!r},health_check={!r})".format(
-            self.identifier, self.targets, self.protocol, self.health_check)
+        return "Capacity(maxconn={!r},maxqueue={!r},queue_timeout={!r})".format(
+            self.maxconn, self.maxqueue, self.queue_timeout)
+
+
+class TargetGroup(Value):
+    __slots__ = ('identifier', 'targets', 'protocol', 'health_check', 'capacity', 'slowstart')
+    _init_fields = __slots__
+    _fields = __slots__
+
+    def __init__(self, identifier: str, targets: list = None, protocol: str = None, health_check: HealthCheck = None,
+                 capacity: Capacity = None, slowstart: int = None):
+        """
+        Targets are kept sorted on host and port, the order they are listed in is not part of the group.
+
+        :param slowstart: Seconds over which a new target ramps up to its full share of requests.
+        """
+        targets = tuple(sorted(targets or (), key=lambda target: (str(target.host), str(target.port))))
+        self._set(identifier=intern_value(identifier), targets=targets, protocol=intern_value(protocol),
+                  health_check=health_check, capacity=capacity, slowstart=slowstart or None)
+
+    def __repr__(self):
+        return "TargetGroup({!r},targets={!r},protocol={!r},health_check={!r},capacity={!r},slowstart={!r})".format(
+            self.identifier, list(self.targets), self.protocol, self.health_check, self.capacity, self.slowstart)
 
     @property
     def slug(self):
         return self.identifier.replace(".", "_").replace("-", "_")
 
+    def target_capacity(self, target: "Target"):
+        """
+        :return: Tuple of maxconn and maxqueue for a target, its own values override those of the group.
+        """
+        capacity = self.capacity
+        return (target.maxconn or (capacity.maxconn if capacity else None),
+                target.maxqueue or (capacity.maxqueue if capacity else None))
 
-class Target(object):
-    host = None
-    port = None
 
-    def __init__(self, host: str = None, port: str = None):
-        self.host = host
-        self.port = port
+class Target(Value):
+    __slots__ = ('host', 'port', 'maxconn', 'maxqueue', 'draining')
+    _init_fields = __slots__
+    _fields = __slots__
 
-    def __eq__(self, other: "Target"):
-        return self.port == other.port and self.host == other.host
+    def __init__(self, host: str = None, port: str = None, maxconn: int = None, maxqueue: int = None,
+                 draining: bool = False):
+        """
+        :param maxconn: Overrides maxconn of the target group for this target.
+        :param maxqueue: Overrides maxqueue of the target group for this target.
+        :param draining: If True the target keeps its connections but gets no new requests.
+        """
+        self._set(host=host, port=port, maxconn=maxconn or None, maxqueue=maxqueue or None, draining=bool(draining))
 
     def __repr__(self):
-        return "Target(host={!r},port={!r})".format(self.host, self.port)
+        extra = ''
+        if self.maxconn or self.maxqueue:
+            extra += ",maxconn={!r},maxqueue={!r}".format(self.maxconn, self.maxqueue)
+        if self.draining:
+            extra += ",draining=True"
+        return "Target(host={!r},port={!r}{})".format(self.host, self.port, extra)
+
+    def __eq__(self, other):
+        # Target groups hold most of the values, compare fields directly rather than building key tuples
+        if self is other:
+            return True
+        if type(other) is not Target:
+            return NotImplemented
+        return self.host == other.host and self.port == other.port and self.maxconn == other.maxconn and \
+            self.maxqueue == other.maxqueue and self.draining == other.draining
+
+    __hash__ = Value.__hash__
 
     @property
     def hash(self):
+        """
+        Stable identifier for the target, used as server name in haproxy.
+        """
         m = hashlib.md5()
         m.update("{}:{}".format(self.host, self.port).encode('utf8'))
         return m.hexdigest()
@@ -313,7 +482,11 @@ class CertBot(object):
         return self.identifier.replace(".", "_").replace("-", "_")
 
 
-class Certificate(object):
+class Certificate(Value):
+    __slots__ = ('identifier', 'pem_data', 'email', 'domains', 'modified', 'is_valid')
+    _init_fields = __slots__
+    _fields = __slots__
+
     def __init__(self, identifier: str, pem_data: str = None, email: str = None, domains: list = None,
                  modified: datetime = None, is_valid=None):
         """
@@ -326,17 +499,8 @@ class Certificate(object):
         :param email: Email address of owner of certificate.
         :param is_valid: Determines if the certificate is valid for usage. If None it is determined from pem data.
         """
-        self.identifier = identifier
-        self.domains = domains
-        self.modified = modified
-        self.pem_data = pem_data
-        self.email = email
-        self.is_valid = bool(pem_data) if is_valid is None else is_valid
-
-    def __eq__(self, other: "Certificate"):
-        return self.identifier == other.identifier and self.domains == other.domains and \
-               self.pem_data == other.pem_data and self.email == other.email and \
-               self.modified == other.modified and self.is_valid == other.is_valid
+        self._set(identifier=intern_value(identifier), pem_data=pem_data, email=email, domains=freeze_list(domains),
+                  modified=modified, is_valid=bool(pem_data) if is_valid is None else is_valid)
 
     def __repr__(self):
         return "Certificate({!r},pem_data={!r},email={!r},domains={!r},modified={!r},is_valid={!r})".format(
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import threading
+import time
+
+import etcd
+
+SHARDS_PREFIX = '/shards'
+# Seconds a shard map is cached by long-running registration processes
+SHARD_MAP_TTL = 5.0
+
+
+def shards_path(pool):
+    return "{prefix}/{pool}".format(prefix=SHARDS_PREFIX, pool=pool)
+
+
+def shard_score(alb, identifier):
+    return int.from_bytes(hashlib.md5("{}\0{}".format(alb, identifier).encode('utf8')).digest()[:8], 'big')
+
+
+class ShardMap(object):
+    def __init__(self, pool, albs, placement=None):
+        """
+        Assigns the listener groups registered in a pool to a set of ALB identifiers. Explicit
+        placements win, every other listener group goes to the ALB with the highest rendezvous hash
+        score. Adding an ALB only moves the listener groups which now score highest on it, removing
+        one only moves the groups it had.
+
+        :param pool: Name registrations use as ALB identifier, e.g. vhost.
+        :param albs: ALB identifiers to spread listener groups over.
+        :param placement: Dictionary of listener group id to ALB identifier.
+        """
+        self.pool = pool
+        self.albs = tuple(sorted(set(albs)))
+        self.placement = dict(placement or {})
+
+    def __repr__(self):
+        return "ShardMap({!r},albs={!r},placement={!r})".format(self.pool, list(self.albs), self.placement)
+
+    def __eq__(self, other):
+        return isinstance(other, ShardMap) and (self.pool, self.albs, self.placement) == \
+            (other.pool, other.albs, other.placement)
+
+    @property
+    def all_albs(self):
+        """
+        All ALBs which may hold listener groups of the pool, including the pool itself.
+        """
+        return sorted(set(self.albs) | set(self.placement.values()) | {self.pool})
+
+    def place(self, identifier):
+        alb = self.placement.get(identifier)
+        if alb:
+            return alb
+        if not self.albs:
+            return self.pool
+        return max(self.albs, key=lambda alb: shard_score(alb, identifier))
+
+
+def read_shard_map(client: etcd.Client, pool):
+    """
+    Reads the shards of a pool with a single recursive read.
+
+    :return: ShardMap or None if the pool is not sharded.
+    """
+    prefix = shards_path(pool)
+    albs = []
+    placement = {}
+    try:
+        for node in client.read(prefix, recursive=True).leaves:
+            if node.dir:
+                continue
+            name = node.key[len(prefix) + 1:]
+            if name == 'albs':
+                try:
+                    albs = json.loads(node.value) or []
+                except (TypeError, ValueError):
+                    albs = []
+            elif name.startswith('placement/') and node.value:
+                placement[name[len('placement/'):]] = node.value
+    except (etcd.EtcdKeyNotFound, KeyError):
+        return None
+    if not albs and not placement:
+        return None
+    return ShardMap(pool, albs, placement)
+
+
+def write_shard_albs(client: etcd.Client, pool, albs):
+    """
+    Sets the ALBs of a pool, an empty list turns sharding off for new registrations.
+    """
+    if albs:
+        client.write(shards_path(pool) + '/albs', json.dumps(sorted(set(albs))))
+        return
+    try:
+        client.delete(shards_path(pool) + '/albs')
+    except etcd.EtcdKeyNotFound:
+        pass
+
+
+def write_placement(client: etcd.Client, pool, identifier, alb=None):
+    """
+    Pins a listener group to an ALB, or removes the pin if alb is None.
+    """
+    key = "{path}/placement/{identifier}".format(path=shards_path(pool), identifier=identifier)
+    if alb:
+        client.write(key, alb)
+        return
+    try:
+        client.delete(key)
+    except etcd.EtcdKeyNotFound:
+        pass
+
+
+class ShardMapCache(object):
+    def __init__(self, ttl=SHARD_MAP_TTL):
+        """
+        Caches shard maps per pool, keeps registration daemons from reading them for every request.
+        """
+        self.ttl = ttl
+        self.cache = {}  # type: Dict[str, Tuple[ShardMap, float]]
+        self.lock = threading.Lock()
+
+    def __call__(self, client: etcd.Client, pool):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(pool)
+        if cached and cached[1] > now:
+            return cached[0]
+        shard_map = read_shard_map(client, pool)
+        with self.lock:
+            self.cache[pool] = (shard_map, now + self.ttl)
+        return shard_map
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+
+get_shard_map = ShardMapCache()
+
+
+def resolve_alb(client: etcd.Client, alb, identifier):
+    """
+    :return: ALB the listener group is placed on, alb itself unless it is a sharded pool.
+    """
+    shard_map = get_shard_map(client, alb)
+    return shard_map.place(identifier) if shard_map is not None else alb
+
+
+def pool_albs(client: etcd.Client, alb):
+    """
+    :return: List of ALBs which may hold listener groups registered with alb.
+    """
+    shard_map = get_shard_map(client, alb)
+    return shard_map.all_albs if shard_map is not None else [alb]
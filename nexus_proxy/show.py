@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+from .manager import get_alb
+from .services import NoListeners, NoTargetGroups
+from .utils import ConfigurationError
+
+
+def cli_show_config(args):
+    verbosity = args.verbosity
+    alb_id = os.environ.get('ALB_ID', args.alb_id)
+
+    try:
+        alb_config = get_alb(alb_id, with_listener_group=True)
+
+        if args.show_haproxy:
+            # Only the rendered config needs jinja2
+            from .generator import generate_config
+            print(generate_config(alb_config))
+        else:
+            print("ALB: {}".format(alb_config.identifier))
+            print("Listeners:")
+            for listener in alb_config.listeners:
+                print("`- {}".format(listener.identifier))
+                print("   port: {}".format(listener.port))
+                print("   rules:")
+                for rule in listener.rules:
+                    print("   `- host: {}, path: {}, action: {}".format(rule.host or '-', rule.path or '-',
+                                                                        rule.action))
+            print("Listener groups:")
+            for listener_group in alb_config.listener_groups:
+                print("`- {}".format(listener_group.identifier))
+                print("   domains: {}".format(listener_group.domains))
+                print("   listeners: {}".format(listener_group.listeners))
+                print("   certificate name: {}".format(listener_group.certificate_name))
+                print("   use certbot: {}".format(listener_group.use_certbot))
+            print("Target Groups:")
+            for target_group in alb_config.target_groups:
+                print("`- {}".format(target_group.identifier))
+                if target_group.health_check:
+                    health = target_group.health_check
+                    print("  `- Health check: ")
+                    print("    `- protocol: {}".format(health.protocol))
+                    print("    `- path: {}".format(health.path))
+                    print("    `- port: {}".format(health.port))
+                    print("    `- healthy: {}".format(health.healthy))
+                    print("    `- unhealthy: {}".format(health.unhealthy))
+                    print("    `- timeout: {}".format(health.timeout))
+                    print("    `- interval: {}".format(health.interval))
+                    print("    `- success: {}".format(health.success))
+                else:
+                    print("  `- No health check")
+                capacity = target_group.capacity
+                if capacity:
+                    print("  `- Capacity: maxconn: {}, maxqueue: {}, queue timeout: {}".format(
+                        capacity.maxconn or '-', capacity.maxqueue or '-', capacity.queue_timeout or '-'))
+                for target in target_group.targets:
+                    maxconn, maxqueue = target_group.target_capacity(target)
+                    print("   `- {}:{}{}{}".format(target.host, target.port,
+                                                  ", maxconn: {}".format(maxconn) if maxconn else '',
+                                                  ", maxqueue: {}".format(maxqueue) if maxqueue else ''))
+
+    except (NoListeners, NoTargetGroups):
+        if verbosity >= 1:
+            print("No configuration found")
+    except ConfigurationError as e:
+        if verbosity >= 0:
+            print("Etcd host is not defined: ", e, file=sys.stderr)
+        sys.exit(1)
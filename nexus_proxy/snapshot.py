@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from datetime import datetime
+
+from .services import LoadBalancerConfig, Listener, Rule, TargetGroup, Target, HealthCheck, Certificate, \
+    ListenerGroup, CertBot, TrafficLimits, Capacity
+
+SNAPSHOT_FORMAT = 'nap-alb-snapshot'
+SNAPSHOT_VERSION = 1
+# Snapshot of the configuration haproxy is running with, written by 'alb run' after each apply
+RUNNING_SNAPSHOT = '/etc/haproxy.snapshot.json'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def get_running_snapshot_path():
+    return os.environ.get('ALB_SNAPSHOT', RUNNING_SNAPSHOT)
+
+
+def certificate_to_dict(certificate: Certificate):
+    if certificate is None:
+        return None
+    return {
+        'identifier': certificate.identifier,
+        'email': certificate.email,
+        'domains': list(certificate.domains) if certificate.domains is not None else None,
+        'modified': certificate.modified.isoformat() if certificate.modified else None,
+        'is_valid': certificate.is_valid,
+    }
+
+
+def certificate_from_dict(data):
+    if data is None:
+        return None
+    modified = data.get('modified')
+    return Certificate(data['identifier'], email=data.get('email'), domains=data.get('domains'),
+                       modified=datetime.fromisoformat(modified) if modified else None, is_valid=data.get('is_valid'))
+
+
+def target_to_list(target: Target):
+    if target.draining:
+        return [target.host, target.port, target.maxconn, target.maxqueue, True]
+    if target.maxconn or target.maxqueue:
+        return [target.host, target.port, target.maxconn, target.maxqueue]
+    return [target.host, target.port]
+
+
+def limits_to_dict(limits: TrafficLimits):
+    if limits is None:
+        return None
+    return {name: getattr(limits, name) for name in TrafficLimits._fields}
+
+
+def limits_from_dict(data):
+    if data is None:
+        return None
+    return TrafficLimits(**data)
+
+
+def config_to_dict(alb: LoadBalancerConfig):
+    """
+    Turns a loaded ALB configuration into JSON compatible data. PEM data is never included.
+    """
+    listeners = {}
+    for listener in alb.listeners:
+        listeners[listener.identifier] = {
+            'port': listener.port,
+            'protocol': listener.protocol,
+            'certificate_name': listener.certificate_name,
+            'certificate': certificate_to_dict(listener.certificate),
+            'rules': [[rule.host, rule.path, rule.action, rule.pri] for rule in listener.rules],
+            'limits': limits_to_dict(listener.limits),
+        }
+    target_groups = {}
+    for target_group in alb.target_groups:
+        health = target_group.health_check
+        target_groups[target_group.identifier] = {
+            'protocol': target_group.protocol,
+            'health_check': {name: getattr(health, name) for name in HealthCheck._fields} if health else None,
+            'capacity': {name: getattr(target_group.capacity, name) for name in Capacity._fields}
+            if target_group.capacity else None,
+            'slowstart': target_group.slowstart,
+            'targets': [target_to_list(target) for target in target_group.targets],
+        }
+    listener_groups = []
+    for listener_group in alb.listener_groups:
+        certbot = listener_group.certbot
+        listener_groups.append({
+            'identifier': listener_group.identifier,
+            'listeners': listener_group.listeners,
+            'domains': listener_group.domains,
+            'certificate_name': listener_group.certificate_name,
+            'use_certbot': listener_group.use_certbot,
+            'certbot': {
+                'target_ip': certbot.target_ip,
+                'target_port': certbot.target_port,
+                'domains': certbot.domains,
+                'certificate_name': certbot.certificate_name,
+            } if certbot else None,
+            'limits': limits_to_dict(listener_group.limits),
+        })
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'alb': alb.identifier,
+        'listeners': listeners,
+        'target_groups': target_groups,
+        'listener_groups': listener_groups,
+    }
+
+
+def config_from_dict(data) -> LoadBalancerConfig:
+    """
+    Creates an ALB configuration from data written by config_to_dict, rules are linked to their target groups.
+    """
+    if data.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError("Not an ALB snapshot")
+    if data.get('version', 0) > SNAPSHOT_VERSION:
+        raise SnapshotError("Unsupported snapshot version: {}".format(data.get('version')))
+
+    target_groups = {}
+    for identifier, group in data.get('target_groups', {}).items():
+        health = group.get('health_check')
+        capacity = group.get('capacity')
+        target_groups[identifier] = TargetGroup(
+            identifier, protocol=group.get('protocol'),
+            health_check=HealthCheck(**health) if health is not None else None,
+            capacity=Capacity(**capacity) if capacity is not None else None,
+            slowstart=group.get('slowstart'),
+            targets=[Target(*target) for target in group.get('targets', [])])
+
+    listeners = {}
+    for identifier, listener in data.get('listeners', {}).items():
+        rules = []
+        for host, path, action, pri in listener.get('rules', []):
+            target_group = target_groups.get(action[3:]) if action and action.startswith('tg:') else None
+            rules.append(Rule(host=host, path=path, action=action, pri=pri, target_group=target_group))
+        listeners[identifier] = Listener(identifier, port=listener.get('port'), rules=rules,
+                                         protocol=listener.get('protocol'),
+                                         certificate_name=listener.get('certificate_name'),
+                                         certificate=certificate_from_dict(listener.get('certificate')),
+                                         limits=limits_from_dict(listener.get('limits')))
+
+    listener_groups = []
+    for group in data.get('listener_groups', []):
+        certbot = group.get('certbot')
+        listener_groups.append(ListenerGroup(
+            group['identifier'], listeners=group.get('listeners'), domains=group.get('domains'),
+            certificate_name=group.get('certificate_name'), use_certbot=group.get('use_certbot', False),
+            certbot=CertBot(group['identifier'], **certbot) if certbot else None,
+            limits=limits_from_dict(group.get('limits'))))
+
+    return LoadBalancerConfig(data.get('alb'), listeners=listeners, listener_groups=listener_groups,
+                              target_groups=target_groups)
+
+
+def write_snapshot(alb: LoadBalancerConfig, filename):
+    """
+    Writes a snapshot atomically, readers never see a partial file.
+    """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as snapshot_file:
+        json.dump(config_to_dict(alb), snapshot_file, sort_keys=True)
+    os.replace(temp_filename, filename)
+
+
+def read_snapshot(filename) -> LoadBalancerConfig:
+    try:
+        with open(filename) as snapshot_file:
+            return config_from_dict(json.load(snapshot_file))
+    except (OSError, ValueError) as e:
+        raise SnapshotError("Cannot read snapshot {}: {}".format(filename, e))
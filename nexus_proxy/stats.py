@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import etcd
+
+from .diff import target_name
+from .haproxy import RuntimeClient, RuntimeAPIError, backend_name, server_name, show_stat, show_info, \
+    show_table
+from .metrics import LabeledGauge, Gauge
+from .register import etcd_client
+from .services import LoadBalancerConfig, LIMIT_GROUPS_TABLE
+
+logger = logging.getLogger('docker-alb')
+
+STATS_PREFIX = '/stats'
+DEFAULT_STATS_INTERVAL = 10
+# Order of values in a rollup entry, keeps the etcd value compact
+ROLLUP_FIELDS = ('request_rate', 'queue', 'response_ms', 'error_ratio', 'servers_up', 'servers', 'queue_ms')
+
+TG_REQUEST_RATE = LabeledGauge('nap_target_group_request_rate', "Sessions per second to a target group",
+                               ['target_group'])
+TG_QUEUE = LabeledGauge('nap_target_group_queue', "Requests queued for a target group", ['target_group'])
+TG_QUEUE_SECONDS = LabeledGauge('nap_target_group_queue_seconds',
+                                "Average time requests to a target group waited in the queue over the last 1024 "
+                                "requests", ['target_group'])
+TG_RESPONSE_SECONDS = LabeledGauge('nap_target_group_response_seconds',
+                                   "Average response time of a target group over the last 1024 requests",
+                                   ['target_group'])
+TG_ERROR_RATIO = LabeledGauge('nap_target_group_error_ratio',
+                              "Share of sessions which ended in a 5xx, connection or response error",
+                              ['target_group'])
+TG_SERVERS_UP = LabeledGauge('nap_target_group_servers_up', "Targets which are up", ['target_group'])
+TG_SERVERS = LabeledGauge('nap_target_group_servers', "Targets in a target group", ['target_group'])
+TARGET_UP = LabeledGauge('nap_target_up', "1 if the target is up, 0 if it is down or in maintenance",
+                         ['target_group', 'target'])
+TARGET_SESSIONS = LabeledGauge('nap_target_sessions', "Current sessions to a target", ['target_group', 'target'])
+TARGET_QUEUE = LabeledGauge('nap_target_queue', "Requests queued for a target", ['target_group', 'target'])
+TARGET_SESSION_LIMIT = LabeledGauge('nap_target_session_limit', "Max concurrent sessions to a target, 0 if unlimited",
+                                    ['target_group', 'target'])
+LG_CONNECTIONS = LabeledGauge('nap_listener_group_connections', "Current connections to a limited listener group",
+                              ['listener_group'])
+LG_LIMIT_TRIGGERS = LabeledGauge('nap_listener_group_limit_triggers',
+                                 "Requests refused or tarpitted by the limits of a listener group, "
+                                 "starts over when haproxy reloads", ['listener_group'])
+HAPROXY_CONNECTIONS = Gauge('nap_haproxy_connections', "Current connections in haproxy")
+HAPROXY_IDLE = Gauge('nap_haproxy_idle_ratio', "Share of time the haproxy process was idle")
+
+
+def get_stats_interval():
+    interval = os.environ.get('STATS_INTERVAL')
+    return float(interval) if interval else None
+
+
+def server_map(alb_config: LoadBalancerConfig):
+    """
+    Maps haproxy names back to NAP names.
+
+    :return: Dictionary of backend name to tuple of target group id and dictionary of server name to host:port.
+    """
+    return {backend_name(target_group): (target_group.identifier,
+                                         {server_name(target): target_name(target)
+                                          for target in target_group.targets})
+            for target_group in alb_config.target_groups}
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def is_up(status):
+    # Servers without health checks report 'no check', transitions are reported as 'UP 1/3'
+    return status.startswith('UP') or status == 'no check'
+
+
+class GroupStats(object):
+    __slots__ = ('identifier', 'request_rate', 'queue', 'response_ms', 'error_ratio', 'servers_up', 'servers',
+                 'queue_ms', 'targets')
+
+    def __init__(self, identifier):
+        """
+        Traffic of a single target group as seen by this haproxy.
+
+        :param identifier: Target group id.
+        """
+        self.identifier = identifier
+        self.request_rate = 0.0
+        self.queue = 0
+        self.response_ms = 0
+        self.error_ratio = 0.0
+        self.servers_up = 0
+        self.servers = 0
+        self.queue_ms = 0
+        # host:port to tuple of haproxy status, current sessions, queued requests and session limit
+        self.targets = {}
+
+    def __repr__(self):
+        return "GroupStats({!r},request_rate={!r},servers_up={!r}/{!r})".format(
+            self.identifier, self.request_rate, self.servers_up, self.servers)
+
+    def as_list(self):
+        return [round(getattr(self, name), 3) for name in ROLLUP_FIELDS]
+
+
+class StatsCollector(object):
+    def __init__(self, runtime: RuntimeClient, interval=DEFAULT_STATS_INTERVAL, client: etcd.Client = None,
+                 alb_id=None, node=None):
+        """
+        Scrapes the haproxy stats socket on an interval and exports per target group metrics.
+
+        :param runtime: Client for the haproxy stats socket.
+        :param interval: Seconds between scrapes.
+        :param client: If set a rollup is written to /stats/<alb>/<node> after each scrape.
+        :param alb_id: Identifier of the ALB, used for the rollup key.
+        :param node: Name of this node, defaults to the hostname.
+        """
+        self.runtime = runtime
+        self.interval = interval
+        self.client = client
+        self.alb_id = alb_id
+        self.node = node or socket.gethostname()
+        self.servers = {}
+        self.limited_groups = ()
+        # Backend name to tuple of time, sessions and errors from the previous scrape
+        self.previous = {}
+
+    def update_config(self, alb_config: LoadBalancerConfig):
+        """
+        Sets the configuration haproxy is running with, the map is swapped in one step so the
+        scraper thread never sees a partial one.
+        """
+        self.servers = server_map(alb_config)
+        self.limited_groups = tuple(limits.group for limits in alb_config.traffic_limits)
+
+    def collect(self, now=None):
+        """
+        :return: Dictionary of target group id to GroupStats.
+        """
+        now = now or time.monotonic()
+        servers = self.servers
+        groups = {}
+        for row in show_stat(self.runtime):
+            backend = row.get('pxname')
+            if backend not in servers:
+                continue
+            group_id, names = servers[backend]
+            group = groups.get(group_id)
+            if group is None:
+                group = groups[group_id] = GroupStats(group_id)
+            if row.get('svname') == 'BACKEND':
+                sessions = to_int(row.get('stot'))
+                errors = to_int(row.get('hrsp_5xx')) + to_int(row.get('econ')) + to_int(row.get('eresp'))
+                previous_time, previous_sessions, previous_errors = self.previous.get(backend, (None, 0, 0))
+                if sessions < previous_sessions:
+                    # Counters start over after a reload
+                    previous_sessions, previous_errors = 0, 0
+                if previous_time is not None and now > previous_time:
+                    group.request_rate = (sessions - previous_sessions) / (now - previous_time)
+                if sessions > previous_sessions:
+                    group.error_ratio = (errors - previous_errors) / (sessions - previous_sessions)
+                self.previous[backend] = (now, sessions, errors)
+                group.queue = to_int(row.get('qcur'))
+                group.response_ms = to_int(row.get('rtime'))
+                group.queue_ms = to_int(row.get('qtime'))
+                continue
+            name = names.get(row.get('svname'))
+            if name is None:
+                continue
+            status = row.get('status') or ''
+            group.servers += 1
+            if is_up(status):
+                group.servers_up += 1
+            group.targets[name] = (status, to_int(row.get('scur')), to_int(row.get('qcur')), to_int(row.get('slim')))
+        return groups
+
+    def export(self, groups: dict):
+        TG_REQUEST_RATE.replace({(group.identifier, ): group.request_rate for group in groups.values()})
+        TG_QUEUE.replace({(group.identifier, ): group.queue for group in groups.values()})
+        TG_QUEUE_SECONDS.replace({(group.identifier, ): group.queue_ms / 1000.0 for group in groups.values()})
+        TG_RESPONSE_SECONDS.replace({(group.identifier, ): group.response_ms / 1000.0 for group in groups.values()})
+        TG_ERROR_RATIO.replace({(group.identifier, ): group.error_ratio for group in groups.values()})
+        TG_SERVERS_UP.replace({(group.identifier, ): group.servers_up for group in groups.values()})
+        TG_SERVERS.replace({(group.identifier, ): group.servers for group in groups.values()})
+        TARGET_UP.replace({(group.identifier, name): 1 if is_up(target[0]) else 0
+                           for group in groups.values() for name, target in group.targets.items()})
+        TARGET_SESSIONS.replace({(group.identifier, name): target[1]
+                                 for group in groups.values() for name, target in group.targets.items()})
+        TARGET_QUEUE.replace({(group.identifier, name): target[2]
+                              for group in groups.values() for name, target in group.targets.items()})
+        TARGET_SESSION_LIMIT.replace({(group.identifier, name): target[3]
+                                      for group in groups.values() for name, target in group.targets.items()})
+
+    def export_limits(self):
+        """
+        Exports the counters haproxy keeps per limited listener group.
+        """
+        limited_groups = self.limited_groups
+        entries = show_table(self.runtime, LIMIT_GROUPS_TABLE) if limited_groups else {}
+        LG_CONNECTIONS.replace({(group, ): to_int(entries.get(group, {}).get('conn_cur'))
+                                for group in limited_groups})
+        LG_LIMIT_TRIGGERS.replace({(group, ): to_int(entries.get(group, {}).get('gpc0'))
+                                   for group in limited_groups})
+
+    def write_rollup(self, groups: dict):
+        """
+        Writes a compact summary for this node, it expires if the node stops reporting.
+        """
+        rollup = {
+            'time': int(time.time()),
+            'groups': {group.identifier: group.as_list() for group in groups.values()},
+        }
+        self.client.write(rollup_key(self.alb_id, self.node), json.dumps(rollup, separators=(',', ':')),
+                          ttl=int(self.interval * 3))
+
+    def scrape(self):
+        groups = self.collect()
+        self.export(groups)
+        self.export_limits()
+        info = show_info(self.runtime)
+        HAPROXY_CONNECTIONS.set(to_int(info.get('CurrConns')))
+        HAPROXY_IDLE.set(to_int(info.get('Idle_pct')) / 100.0)
+        if self.client is not None:
+            self.write_rollup(groups)
+        return groups
+
+    def run(self):
+        while True:
+            try:
+                self.scrape()
+            except RuntimeAPIError as e:
+                logger.warning("Could not read haproxy stats: %s", e)
+            except etcd.EtcdException as e:
+                logger.warning("Could not write stats rollup: %s", e)
+            time.sleep(self.interval)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='haproxy-stats', daemon=True)
+        thread.start()
+        return thread
+
+
+def rollup_key(alb_id, node):
+    return "{prefix}/{alb}/{node}".format(prefix=STATS_PREFIX, alb=alb_id, node=node)
+
+
+def read_rollups(client: etcd.Client, alb_id):
+    """
+    Reads the rollups of all nodes running an ALB with a single recursive read.
+
+    :return: Dictionary of node name to rollup.
+    """
+    prefix = "{prefix}/{alb}/".format(prefix=STATS_PREFIX, alb=alb_id)
+    rollups = {}
+    try:
+        for node in client.read(prefix.rstrip('/'), recursive=True).leaves:
+            if node.dir or not node.key.startswith(prefix):
+                continue
+            try:
+                rollups[node.key[len(prefix):]] = json.loads(node.value)
+            except (TypeError, ValueError):
+                continue
+    except (etcd.EtcdKeyNotFound, KeyError):
+        pass
+    return rollups
+
+
+def merge_rollups(rollups: dict):
+    """
+    Combines the rollups of all nodes. Rates, queues and servers are summed, response time, queue
+    time and error ratio are weighted by request rate.
+
+    :return: Dictionary of target group id to dictionary of ROLLUP_FIELDS values and number of nodes.
+    """
+    merged = {}
+    for rollup in rollups.values():
+        for group_id, values in (rollup.get('groups') or {}).items():
+            values = dict(zip(ROLLUP_FIELDS, values))
+            total = merged.setdefault(group_id, dict({name: 0 for name in ROLLUP_FIELDS}, nodes=0))
+            rate = values.get('request_rate', 0)
+            total['nodes'] += 1
+            for name in ('queue', 'servers_up', 'servers'):
+                total[name] += values.get(name, 0)
+            for name in ('response_ms', 'queue_ms', 'error_ratio'):
+                total[name] += values.get(name, 0) * rate
+            total['request_rate'] += rate
+    for total in merged.values():
+        rate = total['request_rate']
+        for name in ('response_ms', 'queue_ms', 'error_ratio'):
+            total[name] = total[name] / rate if rate else 0
+    return merged
+
+
+def format_stats(merged: dict):
+    lines = ["{:<40} {:>6} {:>9} {:>6} {:>8} {:>8} {:>7} {:>9}".format(
+        'target group', 'nodes', 'req/s', 'queue', 'qt ms', 'rt ms', 'err %', 'up')]
+    for group_id, total in sorted(merged.items()):
+        lines.append("{:<40} {:>6} {:>9.1f} {:>6} {:>8.0f} {:>8.0f} {:>7.2f} {:>9}".format(
+            group_id, total['nodes'], total['request_rate'], total['queue'], total['queue_ms'], total['response_ms'],
+            total['error_ratio'] * 100, "{}/{}".format(total['servers_up'], total['servers'])))
+    return "\n".join(lines)
+
+
+def cli_show_stats(args):
+    client = etcd_client(args.etcd_host)
+    alb_id = os.environ.get('ALB_ID', args.alb_id)
+    rollups = read_rollups(client, alb_id)
+    if args.format == 'json':
+        json.dump({'nodes': rollups, 'target_groups': merge_rollups(rollups)}, sys.stdout, indent=1,
+                  sort_keys=True)
+        sys.stdout.write("\n")
+        return
+    if not rollups:
+        if args.verbosity >= 0:
+            print("No stats reported for ALB {}".format(alb_id), file=sys.stderr)
+        return
+    print(format_stats(merge_rollups(rollups)))
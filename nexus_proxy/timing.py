@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('docker-alb')
+
+# Set with enable_spans(), checked once per span so disabled spans only cost a function call
+spans_enabled = False
+
+
+def enable_spans(enabled=True):
+    global spans_enabled
+    spans_enabled = enabled
+
+
+def get_spans_enabled():
+    return os.environ.get('NAP_SPANS', '') in ('yes', 'true', '1')
+
+
+def format_fields(fields):
+    return "".join(" {}={}".format(key, value) for key, value in sorted(fields.items()))
+
+
+class Span(object):
+    __slots__ = ('name', 'metric', 'fields', 'start')
+
+    def __init__(self, name, metric=None, fields=None):
+        """
+        Times a stage of a command, use span() to create it.
+
+        :param name: Name of stage, e.g. get_alb.
+        :param metric: Histogram which receives the duration in seconds.
+        :param fields: Extra key/values included in the log line.
+        """
+        self.name = name
+        self.metric = metric
+        self.fields = fields
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.monotonic() - self.start
+        if self.metric is not None:
+            self.metric.observe(duration)
+        if spans_enabled:
+            fields = dict(self.fields or {})
+            if exc_type is not None:
+                fields['error'] = exc_type.__name__
+            logger.info("span=%s ms=%.1f%s", self.name, duration * 1000, format_fields(fields))
+        return False
+
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, metric=None, **fields):
+    """
+    Context manager which times a stage and logs it as a structured line when spans are enabled:
+
+        span=get_alb ms=12.3 alb=vhost cycle=4
+
+    The duration is always recorded in metric if set.
+    """
+    if metric is None and not spans_enabled:
+        return NULL_SPAN
+    return Span(name, metric=metric, fields=fields)
+
+
+class CycleProfiler(object):
+    def __init__(self, filename, cycles=5):
+        """
+        Profiles a number of cycles of a loop with cProfile and writes the result to filename,
+        it can be inspected with 'python3 -m pstats <filename>'.
+
+        :param cycles: Number of cycles to profile, profiling stops after that.
+        """
+        self.filename = filename
+        self.cycles = cycles
+        self.count = 0
+        self.profiler = cProfile.Profile()
+
+    @property
+    def active(self):
+        return self.count < self.cycles
+
+    def start(self):
+        if self.active:
+            self.profiler.enable()
+
+    def stop(self):
+        """
+        Ends a cycle started with start(), the profile is written after the last cycle.
+        """
+        if not self.active:
+            return
+        self.profiler.disable()
+        self.count += 1
+        if not self.active:
+            self.profiler.dump_stats(self.filename)
+            logger.info("Wrote profile of %d cycles to %s", self.count, self.filename)
+
+
+@contextmanager
+def profile_command(filename):
+    """
+    Profiles the whole block and writes the result to filename, does nothing if filename is None.
+    """
+    if not filename:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
+        logger.info("Wrote profile to %s", filename)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
-import json
 import os
+import socket
+import threading
+import time
 
 POLL_TIMEOUT = 5
 NO_SERVICES_TIMEOUT = 5.0
@@ -25,3 +27,28 @@ def get_etcd_addr():
         host, port = etcd_host.split(":")
 
     return host, port
+
+
+class HostResolver(object):
+    def __init__(self, ttl=60.0, resolve=socket.gethostbyname):
+        """
+        Resolves hostnames to IP addresses and caches the result.
+
+        :param ttl: Number of seconds to cache an address.
+        :param resolve: Function which does the actual lookup.
+        """
+        self.ttl = ttl
+        self.resolve = resolve
+        self.cache = {}  # type: Dict[str, Tuple[str, float]]
+        self.lock = threading.Lock()
+
+    def __call__(self, host):
+        now = time.time()
+        with self.lock:
+            cached = self.cache.get(host)
+        if cached and cached[1] > now:
+            return cached[0]
+        address = self.resolve(host)
+        with self.lock:
+            self.cache[host] = (address, now + self.ttl)
+        return address